@@ -1,23 +1,26 @@
-"""Backup Elasticsearch documents to a datastore. Currently, only S3 is
-supported.
+"""Backup Elasticsearch documents to a storage backend and restore them again.
+See :mod:`companion.api.storage` for the available backends.
 
 """
+import io
 import os
 import json
+import time
 import shutil
 import logging
+import tarfile
+import zipfile
 import datetime
 import tempfile
+import concurrent.futures
 
-import boto3
 from elasticsearch import helpers
 
-from . import util
+from . import util, scan, storage as backup_storage
 from .. import error
 
-__all__ = ['s3']
+__all__ = ['backup', 's3', 'local', 'restore']
 logger = logging.getLogger(__name__)
-now = datetime.datetime.utcnow()
 
 
 def _cleanup(tmpdir):
@@ -48,7 +51,18 @@ def _save_hit(root_path, hit):
     return doc_path
 
 
-def _fetch_and_tar(url, index_name):
+def _source_filter(source_include=None, source_exclude=None):
+    """Build the scan arguments for source filtering."""
+    kwargs = {}
+    if source_include:
+        kwargs['_source_include'] = list(source_include)
+    if source_exclude:
+        kwargs['_source_exclude'] = list(source_exclude)
+    return kwargs
+
+
+def _fetch_and_tar(url, index_name, source_include=None, source_exclude=None,
+                   scan_engine=None):
     client = util.get_client(url)
     if not client.indices.exists(index_name):
         logger.warn('Index "{}" does not exist, ignoring it'.format(index_name))
@@ -58,33 +72,36 @@ def _fetch_and_tar(url, index_name):
     logger.info('Fetching index documents {}'.format(index_name))
     logger.info('Storing documents in {}'.format(tmpdir))
     body = {'size': 1000}
-    hits_iter = helpers.scan(client,
-                             index=index_name,
-                             query=body,
-                             scroll='5m')
-    index_dirs = set()
-    for hit in hits_iter:
-        doc_path = _save_hit(tmpdir, hit)
-        index_dirs.add(os.path.dirname(doc_path))
-    tar_files = []
-    logger.info('Done fetching documents. Creating {} tar archives'
-                .format(len(index_dirs)))
-    for index_dir in index_dirs:
-        tar_files.append(util.tar_gz_directory(index_dir, tmpdir))
-    logger.info('Done creating tar files')
-    return tmpdir, tar_files
-
-
-def _flush_zips(index_dirs, target_dir):
-    zip_files = []
-    for index_dir in index_dirs:
-        zip_files.append(util.zip_directory(index_dir, target_dir,
-                                            delete_original=True,
-                                            append=True))
-    return zip_files
-
-
-def _fetch_and_zip(url, index_name, batch_size=10000):
+    scan_engine = scan_engine or scan.ScrollEngine()
+    hits_iter = scan_engine(client,
+                            index=index_name,
+                            query=body,
+                            **_source_filter(source_include, source_exclude))
+
+    # Documents are written straight into one archive per index_doctype pair,
+    # with the same layout as util.tar_gz_directory.
+    archives = {}
+    try:
+        for hit in hits_iter:
+            name = '{}_{}'.format(hit['_index'], hit['_type'])
+            if name not in archives:
+                archives[name] = tarfile.open(
+                    '{}/{}.tar.gz'.format(tmpdir, name), 'w:gz')
+            data = json.dumps(hit).encode('utf-8')
+            info = tarfile.TarInfo('{}/{}_{}.json'.format(name, name,
+                                                          hit['_id']))
+            info.size = len(data)
+            info.mtime = time.time()
+            archives[name].addfile(info, io.BytesIO(data))
+    finally:
+        for archive in archives.values():
+            archive.close()
+    logger.info('Done fetching documents and creating tar files')
+    return tmpdir, [archive.name for archive in archives.values()]
+
+
+def _fetch_and_zip(url, index_name, batch_size=10000, source_include=None,
+                   source_exclude=None, scan_engine=None):
     client = util.get_client(url)
     if not client.indices.exists(index_name):
         logger.warn('Index "{}" does not exist, ignoring it'.format(index_name))
@@ -96,28 +113,118 @@ def _fetch_and_zip(url, index_name, batch_size=10000):
     logger.info('Storing documents in {}'.format(tmpdir))
 
     body = {'size': 1000}
-    hits_iter = helpers.scan(client,
-                             index=index_name,
-                             query=body,
-                             scroll='5m')
-    index_dirs = set()
+    scan_engine = scan_engine or scan.ScrollEngine()
+    hits_iter = scan_engine(client,
+                            index=index_name,
+                            query=body,
+                            **_source_filter(source_include, source_exclude))
+
+    # Documents are written straight into one archive per index_doctype pair,
+    # with the same layout as util.zip_directory. The archives are closed
+    # every batch_size documents, which flushes their central directories.
+    archives = {}
     zip_files = set()
     processed_in_batch = 0
-    for hit in hits_iter:
-        doc_path = _save_hit(tmpdir, hit)
-        index_dirs.add(os.path.dirname(doc_path))
-        processed_in_batch += 1
-        if processed_in_batch == batch_size:
-            zip_files.update(_flush_zips(index_dirs, tmpdir))
-            processed_in_batch = 0
-            index_dirs.clear()
-    zip_files.update(_flush_zips(index_dirs, tmpdir))
+    try:
+        for hit in hits_iter:
+            name = '{}_{}'.format(hit['_index'], hit['_type'])
+            if name not in archives:
+                zip_path = '{}/{}.zip'.format(tmpdir, name)
+                mode = 'a' if zip_path in zip_files else 'w'
+                archives[name] = zipfile.ZipFile(
+                    zip_path, mode=mode, compression=zipfile.ZIP_DEFLATED)
+                zip_files.add(zip_path)
+            archives[name].writestr(
+                '{}/{}_{}.json'.format(name, name, hit['_id']),
+                json.dumps(hit))
+            processed_in_batch += 1
+            if processed_in_batch == batch_size:
+                for archive in archives.values():
+                    archive.close()
+                archives.clear()
+                processed_in_batch = 0
+    finally:
+        for archive in archives.values():
+            archive.close()
     logger.info('Done fetching documents and creating zip files')
     return tmpdir, list(zip_files)
 
 
+def _timed_transfer(transfer, key, path, description):
+    """Run a storage upload_file or download_file call and log the rate."""
+    start = time.time()
+    size = transfer(key, path)
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info('{} {}: {} bytes in {:.1f}s ({:.1f} MB/s)'
+                .format(description, key, size, elapsed, size / elapsed / 1e6))
+    return size
+
+
+def backup(url, index_name, storage, filetype='zip', parallel_files=4,
+           source_include=None, source_exclude=None, scan_engine=None):
+    """Make a backup of an Elasticsearch index and store the data in a storage
+    backend. The data format can be either tar.gz-files or zip-files.
+
+    :param url: The full Elasticsearch url
+    :type url: str
+    :param index_name: The name of the index to backup.
+    :type index_name: str
+    :param storage: The storage backend, see :mod:`companion.api.storage`.
+    :type storage: companion.api.storage.Storage
+    :param filetype: Type of file to store.
+    :type filetype: str
+    :param parallel_files: The number of files to upload concurrently.
+    :type parallel_files: int
+    :param source_include: Only backup these source fields.
+    :type source_include: list
+    :param source_exclude: Do not backup these source fields.
+    :type source_exclude: list
+    :param scan_engine: The engine that reads the documents, see
+        :mod:`companion.api.scan`. Default is a scroll.
+    :returns: The name of the backup, which is the key prefix of the stored
+        files, or None if there was nothing to backup.
+
+    """
+    logger.info('Starting backup for index {} to {}'
+                .format(index_name, storage))
+
+    fetch_kwargs = {'source_include': source_include,
+                    'source_exclude': source_exclude,
+                    'scan_engine': scan_engine}
+    if filetype == 'zip':
+        tmpdir, files = _fetch_and_zip(url, index_name, **fetch_kwargs)
+    elif filetype == 'tar':
+        tmpdir, files = _fetch_and_tar(url, index_name, **fetch_kwargs)
+    else:
+        raise error.CompanionException('Unknown filetype {}'.format(filetype))
+
+    if not files:
+        return logger.warn('No files to upload, exiting')
+
+    backup_dir = 'clibackup/{:%Y/%m/%d_%H%M%S}'.format(
+        datetime.datetime.utcnow())
+    logger.info('Starting upload to {}'.format(backup_dir))
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=parallel_files) as executor:
+        futures = []
+        for f in files:
+            object_key = '{}_{}'.format(backup_dir, os.path.basename(f))
+            futures.append(executor.submit(_timed_transfer,
+                                           storage.upload_file, object_key, f,
+                                           'Uploaded'))
+        total_bytes = sum(future.result() for future in futures)
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info('Done uploading {} bytes in {:.1f}s ({:.1f} MB/s). '
+                'Starting cleanup'
+                .format(total_bytes, elapsed, total_bytes / elapsed / 1e6))
+    _cleanup(tmpdir)
+    return backup_dir
+
+
 def s3(url, index_name, region, bucket_name, user_key, secret_key,
-       filetype='zip'):
+       filetype='zip', parallel_files=4, transfer_settings=None,
+       source_include=None, source_exclude=None, scan_engine=None):
     """Make a backup of an Elasticsearch index and send the data to
     to Amazon S3. The data format can be either tar.gz-files or zip-files.
 
@@ -135,32 +242,113 @@ def s3(url, index_name, region, bucket_name, user_key, secret_key,
     :type secret_key: str
     :param filetype: Type of file to send to S3.
     :type filetype: str
+    :param parallel_files: The number of files to upload concurrently.
+    :type parallel_files: int
+    :param transfer_settings: Multipart and retry settings, passed on to
+        :class:`companion.api.storage.S3Storage`.
+    :type transfer_settings: dict
+    :param source_include: Only backup these source fields.
+    :type source_include: list
+    :param source_exclude: Do not backup these source fields.
+    :type source_exclude: list
+    :param scan_engine: The engine that reads the documents, see
+        :mod:`companion.api.scan`. Default is a scroll.
 
     """
-    logger.info('Starting S3 backup for index {}'.format(index_name))
+    storage = backup_storage.S3Storage(bucket_name,
+                                       region=region,
+                                       user_key=user_key,
+                                       secret_key=secret_key,
+                                       **(transfer_settings or {}))
+    return backup(url, index_name, storage, filetype=filetype,
+                  parallel_files=parallel_files,
+                  source_include=source_include,
+                  source_exclude=source_exclude,
+                  scan_engine=scan_engine)
 
-    if filetype == 'zip':
-        tmpdir, files = _fetch_and_zip(url, index_name)
-    elif filetype == 'tar':
-        tmpdir, files = _fetch_and_tar(url, index_name)
+
+def local(url, index_name, path, filetype='zip', source_include=None,
+          source_exclude=None, scan_engine=None):
+    """Make a backup of an Elasticsearch index to a local directory. The
+    directory can also be a mounted network volume.
+
+    :param url: The full Elasticsearch url
+    :type url: str
+    :param index_name: The name of the index to backup.
+    :type index_name: str
+    :param path: The directory to store the backup in.
+    :type path: str
+    :param filetype: Type of file to store.
+    :type filetype: str
+    :param source_include: Only backup these source fields.
+    :type source_include: list
+    :param source_exclude: Do not backup these source fields.
+    :type source_exclude: list
+    :param scan_engine: The engine that reads the documents, see
+        :mod:`companion.api.scan`. Default is a scroll.
+
+    """
+    storage = backup_storage.LocalStorage(path)
+    return backup(url, index_name, storage, filetype=filetype,
+                  source_include=source_include,
+                  source_exclude=source_exclude,
+                  scan_engine=scan_engine)
+
+
+def _read_archive(path):
+    """Read all hits stored in a zip or tar.gz archive."""
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            for name in zf.namelist():
+                if name.endswith('.json'):
+                    yield json.loads(zf.read(name).decode('utf-8'))
     else:
-        raise error.CompanionException('Unknown filetype {}'.format(filetype))
+        with tarfile.open(path) as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith('.json'):
+                    yield json.loads(
+                        tar.extractfile(member).read().decode('utf-8'))
 
-    if not files:
-        return logger.warn('No files to upload, exiting')
 
-    backup_dir = 'clibackup/{:%Y/%m/%d_%H%M%S}'.format(now)
-    logger.info('Starting s3 upload to {}'.format(backup_dir))
-    s3 = boto3.resource('s3',
-                        region_name=region,
-                        aws_access_key_id=user_key,
-                        aws_secret_access_key=secret_key)
-    bucket = s3.Bucket(bucket_name)
-    for f in files:
-        filename = os.path.basename(f)
-        logger.info('Uploading object to s3: {}'.format(filename))
-        object_key = '{}_{}'.format(backup_dir, filename)
-        with open(f, 'rb') as data:
-            bucket.put_object(Key=object_key, Body=data)
-    logger.info('Done uploading objects to s3. Starting cleanup')
-    _cleanup(tmpdir)
+def restore(url, storage, backup_name, index_name=None):
+    """Restore a backup made with :func:`backup`. The archives are
+    downloaded and indexed one at a time.
+
+    :param url: The full Elasticsearch url
+    :type url: str
+    :param storage: The storage backend, see :mod:`companion.api.storage`.
+    :type storage: companion.api.storage.Storage
+    :param backup_name: The name of the backup, e.g.
+        "clibackup/2017/01/02_120000".
+    :type backup_name: str
+    :param index_name: The index to restore to. Defaults to the index that the
+        documents were backed up from.
+    :type index_name: str
+    :returns: The result of an iterating bulk operation.
+
+    """
+    keys = [k for k in storage.list(backup_name)
+            if k.endswith('.zip') or k.endswith('.tar.gz')]
+    if not keys:
+        raise error.CompanionException(
+            'No backup files found for {}'.format(backup_name))
+
+    logger.info('Restoring {} files from {}'.format(len(keys), backup_name))
+    client = util.get_client(url)
+    tmpdir = tempfile.mkdtemp()
+
+    def _docs_to_operations():
+        for key in keys:
+            path = os.path.join(tmpdir, key.rsplit('/', 1)[-1])
+            _timed_transfer(storage.download_file, key, path, 'Downloaded')
+            for hit in _read_archive(path):
+                if index_name:
+                    hit['_index'] = index_name
+                yield hit
+            os.remove(path)
+
+    try:
+        return helpers.bulk(client, _docs_to_operations(), chunk_size=1000,
+                            stats_only=True)
+    finally:
+        _cleanup(tmpdir)
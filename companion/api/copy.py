@@ -0,0 +1,188 @@
+"""Copy documents from one cluster to another, for example for migrations
+between major versions or from hot to warm clusters.
+
+Each side has its own client and connection pool. The source is read with a
+sliced scroll, one thread per slice, and every scroll page is turned into a
+bulk request body by the thread that read it. The bodies are sent to the
+target from a pool of threads, so reads and writes overlap and the slower
+cluster sets the pace.
+
+In raw mode, the scroll responses are not decoded into documents. The
+_source of each hit is shipped as the original JSON text, which skips
+serializing the documents again and keeps them exactly as they were indexed.
+
+"""
+import re
+import json
+import time
+import logging
+
+from . import util, scan, pipeline, record
+
+__all__ = ['copy']
+logger = logging.getLogger(__name__)
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'\s*')
+_HITS = re.compile(r'"hits"\s*:\s*\[')
+_SCROLL_ID = re.compile(r'"_scroll_id"\s*:\s*"([^"]*)"')
+
+
+def _skip(text, pos):
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _raw_hits(text):
+    """Parse the hits of a search response, but not their sources.
+
+    :param text: The JSON text of a search response.
+    :type text: str
+    :returns: A list of (meta, source) tuples, where meta is a dict of the
+        other hit fields and source is the JSON text of the _source.
+
+    """
+    match = _HITS.search(text)
+    if match is None:
+        return []
+    hits = []
+    pos = _skip(text, match.end())
+    while text[pos] != ']':
+        if text[pos] == ',':
+            pos = _skip(text, pos + 1)
+        # Parse one hit object, key by key.
+        pos = _skip(text, pos + 1)
+        meta = {}
+        source = None
+        while text[pos] != '}':
+            if text[pos] == ',':
+                pos = _skip(text, pos + 1)
+            key, pos = json.decoder.scanstring(text, pos + 1)
+            pos = _skip(text, _skip(text, pos) + 1)
+            value_start = pos
+            value, pos = _decoder.raw_decode(text, pos)
+            if key == '_source':
+                source = text[value_start:pos]
+            else:
+                meta[key] = value
+            pos = _skip(text, pos)
+        hits.append((meta, source))
+        pos = _skip(text, pos + 1)
+    return hits
+
+
+def _bulk_body(hits, target_index_name):
+    """Build a bulk request body of index actions from (meta, source)
+    tuples.
+
+    """
+    lines = []
+    for meta, source in hits:
+        doc = record.Doc.from_hit(meta, source=source)
+        if target_index_name:
+            doc.index = target_index_name
+        action, source = doc.expand()
+        lines.append(json.dumps(action))
+        lines.append(source)
+    return '\n'.join(lines) + '\n'
+
+
+def _raw_scroll(client, index, body, scroll, size, stop):
+    """Scroll through an index without decoding the documents. Yields lists
+    of (meta, source) tuples, one per page.
+
+    """
+    connection = client.transport.get_connection()
+    _, _, text = connection.perform_request(
+        'POST', '/{}/_search'.format(index),
+        params={'scroll': scroll, 'size': size},
+        body=json.dumps(body).encode('utf-8'))
+    scroll_id = None
+    try:
+        while not stop.is_set():
+            match = _SCROLL_ID.search(text)
+            scroll_id = match.group(1) if match else None
+            hits = _raw_hits(text)
+            if not hits or scroll_id is None:
+                return
+            yield hits
+            _, _, text = connection.perform_request(
+                'POST', '/_search/scroll',
+                body=json.dumps({'scroll': scroll,
+                                 'scroll_id': scroll_id}).encode('utf-8'))
+    finally:
+        if scroll_id is not None:
+            client.clear_scroll(body={'scroll_id': [scroll_id]},
+                                ignore=(404,))
+
+
+def _decoded_scroll(client, index, body, scroll, size, stop):
+    """Scroll through an index with the scan helper. Yields lists of
+    (meta, source) tuples, one per page.
+
+    """
+    engine = scan.ScrollEngine(scroll=scroll, size=size)
+    for page in pipeline.batched(engine(client, index=index, query=body),
+                                 size):
+        if stop.is_set():
+            return
+        yield [(hit, json.dumps(hit['_source'])) for hit in page]
+
+
+def copy(source_url, target_url, source_index_name, target_index_name=None,
+         query=None, slices=4, size=1000, bulk_threads=4, raw=False,
+         scroll='5m'):
+    """Copy all documents in an index to another cluster. The IDs, types and
+    routing of the documents are kept. The target indexes are not created
+    first, so create them or add index templates to get the right mappings.
+
+    :param source_url: The url of the cluster to read from.
+    :type source_url: str
+    :param target_url: The url of the cluster to write to.
+    :type target_url: str
+    :param source_index_name: The name or pattern of the indexes to copy.
+    :type source_index_name: str
+    :param target_index_name: The index to write to. Default is the same
+        index that each document was read from.
+    :type target_index_name: str
+    :param query: A query for the documents to copy.
+    :type query: dict
+    :param slices: The number of scroll slices to read in parallel. Sliced
+        scrolls need Elasticsearch 5 or later, so use 1 to copy from older
+        clusters.
+    :type slices: int
+    :param size: The number of documents per shard per scroll page.
+    :type size: int
+    :param bulk_threads: The number of bulk requests to send in parallel.
+    :type bulk_threads: int
+    :param raw: Ship the sources as the original JSON text, without decoding
+        and encoding them again.
+    :type raw: bool
+    :param scroll: The scroll keepalive.
+    :type scroll: str
+    :returns: The number of copied documents.
+
+    """
+    logger.info('Copying {} from {} to {}'.format(source_index_name,
+                                                  source_url, target_url))
+    source = util.get_client(source_url)
+    target = util.get_client(target_url)
+    read = _raw_scroll if raw else _decoded_scroll
+
+    def _reader(slice_id):
+        def _read(stop):
+            body = dict(query or {}, sort=['_doc'])
+            if slices > 1:
+                body['slice'] = {'id': slice_id, 'max': slices}
+            for page in read(source, source_index_name, body, scroll, size,
+                             stop):
+                yield _bulk_body(page, target_index_name)
+        return _read
+
+    start = time.time()
+    bodies = scan._merge([_reader(i) for i in range(slices)],
+                         max_buffered=2 * max(slices, bulk_threads))
+    copied = pipeline.send_bulk(target, bodies, threads=bulk_threads)
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info('Copied {} documents in {:.1f}s ({:.0f} docs/s)'
+                .format(copied, elapsed, copied / elapsed))
+    return copied
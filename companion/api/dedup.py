@@ -0,0 +1,216 @@
+"""Deduplicated backups of Elasticsearch indexes.
+
+Documents are read in _uid order and cut into chunks. A chunk ends after a
+document whose _uid hashes to a boundary value, so inserting or deleting a
+document only changes the chunk it belongs to. Each chunk is stored once under
+the SHA-256 of its contents and a backup is a small manifest listing the chunks
+it consists of. Chunks that did not change since an earlier backup are not
+uploaded again.
+
+The storage layout is:
+
+    chunks/ab/abcdef...       Gzipped NDJSON, one document per line.
+    manifests/INDEX/NAME.json The manifest for a single backup.
+
+"""
+import gzip
+import json
+import hashlib
+import logging
+import datetime
+
+from elasticsearch import helpers
+
+from . import util
+from .. import error
+
+__all__ = ['backup', 'restore', 'gc', 'list_manifests']
+logger = logging.getLogger(__name__)
+
+CHUNK_PREFIX = 'chunks/'
+MANIFEST_PREFIX = 'manifests/'
+
+
+def _is_boundary(hit, avg_chunk_docs):
+    uid = '{}#{}'.format(hit['_type'], hit['_id']).encode('utf-8')
+    digest = hashlib.sha1(uid).digest()
+    return int.from_bytes(digest[:8], 'big') % avg_chunk_docs == 0
+
+
+def _chunk_hits(hits, avg_chunk_docs=1000, max_chunk_docs=10000):
+    """Split an iterable of hits into content defined chunks.
+
+    :param hits: Hits sorted by _uid.
+    :param avg_chunk_docs: The average number of documents per chunk.
+    :type avg_chunk_docs: int
+    :param max_chunk_docs: Hard limit for the number of documents per chunk.
+    :type max_chunk_docs: int
+    :returns: A generator of lists of hits.
+
+    """
+    chunk = []
+    for hit in hits:
+        chunk.append(hit)
+        if (len(chunk) >= max_chunk_docs or
+                _is_boundary(hit, avg_chunk_docs)):
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _serialize_chunk(hits):
+    """Serialize hits to canonical NDJSON. The index name is left out, so the
+    same documents produce the same chunk regardless of the index.
+
+    """
+    lines = []
+    for hit in hits:
+        doc = {'_type': hit['_type'], '_id': hit['_id'],
+               '_source': hit['_source']}
+        lines.append(json.dumps(doc, sort_keys=True, separators=(',', ':')))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def _chunk_key(chunk_id):
+    return '{}{}/{}'.format(CHUNK_PREFIX, chunk_id[:2], chunk_id)
+
+
+def _read_chunk(storage, chunk_id):
+    data = gzip.decompress(storage.get(_chunk_key(chunk_id)))
+    if hashlib.sha256(data).hexdigest() != chunk_id:
+        raise error.CompanionException('Chunk {} is corrupt'.format(chunk_id))
+    for line in data.decode('utf-8').splitlines():
+        yield json.loads(line)
+
+
+def backup(url, index_name, storage, name=None, query=None,
+           avg_chunk_docs=1000):
+    """Make a deduplicated backup of an Elasticsearch index.
+
+    :param url: The full Elasticsearch url
+    :type url: str
+    :param index_name: The name of the index to backup.
+    :type index_name: str
+    :param storage: The storage target, see :mod:`companion.api.storage`.
+    :param name: The backup name. Defaults to the current UTC time.
+    :type name: str
+    :param query: A query to limit the documents in the backup.
+    :type query: dict
+    :param avg_chunk_docs: The average number of documents per chunk.
+    :type avg_chunk_docs: int
+    :returns: The manifest key, or None if the index does not exist.
+
+    """
+    client = util.get_client(url)
+    if not client.indices.exists(index_name):
+        logger.warn('Index "{}" does not exist, ignoring it'.format(index_name))
+        return None
+
+    name = name or '{:%Y%m%dT%H%M%S}'.format(datetime.datetime.utcnow())
+    manifest_key = '{}{}/{}.json'.format(MANIFEST_PREFIX, index_name, name)
+    logger.info('Starting deduplicated backup of {} to {}'
+                .format(index_name, storage))
+
+    known_chunks = set(k.rsplit('/', 1)[-1]
+                       for k in storage.list(CHUNK_PREFIX))
+    body = dict(query or {}, size=1000, sort=['_uid'])
+    hits_iter = helpers.scan(client,
+                             index=index_name,
+                             query=body,
+                             scroll='5m',
+                             preserve_order=True)
+
+    chunks = []
+    uploaded = 0
+    documents = 0
+    for hits in _chunk_hits(hits_iter, avg_chunk_docs=avg_chunk_docs,
+                            max_chunk_docs=avg_chunk_docs * 10):
+        data = _serialize_chunk(hits)
+        chunk_id = hashlib.sha256(data).hexdigest()
+        if chunk_id not in known_chunks:
+            storage.put(_chunk_key(chunk_id), gzip.compress(data))
+            known_chunks.add(chunk_id)
+            uploaded += 1
+        chunks.append({'id': chunk_id, 'documents': len(hits),
+                       'size': len(data)})
+        documents += len(hits)
+
+    manifest = {
+        'index': index_name,
+        'name': name,
+        'created': datetime.datetime.utcnow().isoformat(),
+        'documents': documents,
+        'chunks': chunks
+    }
+    storage.put(manifest_key, json.dumps(manifest).encode('utf-8'))
+    logger.info('Stored {} documents in {} chunks, {} new chunks uploaded'
+                .format(documents, len(chunks), uploaded))
+    return manifest_key
+
+
+def restore(url, storage, manifest_key, index_name=None):
+    """Restore a deduplicated backup.
+
+    :param url: The full Elasticsearch url
+    :type url: str
+    :param storage: The storage target, see :mod:`companion.api.storage`.
+    :param manifest_key: The key of the backup manifest.
+    :type manifest_key: str
+    :param index_name: The index to restore to. Defaults to the index that the
+        backup was made from.
+    :type index_name: str
+    :returns: The result of an iterating bulk operation.
+
+    """
+    manifest = json.loads(storage.get(manifest_key).decode('utf-8'))
+    index_name = index_name or manifest['index']
+    logger.info('Restoring {} documents from {} to {}'
+                .format(manifest['documents'], manifest_key, index_name))
+    client = util.get_client(url)
+
+    def _docs_to_operations():
+        for chunk in manifest['chunks']:
+            for doc in _read_chunk(storage, chunk['id']):
+                doc['_index'] = index_name
+                yield doc
+
+    return helpers.bulk(client, _docs_to_operations(), chunk_size=1000,
+                        stats_only=True)
+
+
+def list_manifests(storage, index_name=None):
+    """List the manifest keys in a storage target, optionally only the ones
+    for a single index.
+
+    """
+    prefix = MANIFEST_PREFIX
+    if index_name:
+        prefix = '{}{}/'.format(MANIFEST_PREFIX, index_name)
+    return storage.list(prefix)
+
+
+def gc(storage, dry_run=False):
+    """Delete all chunks that are not referenced by any manifest.
+
+    Do not run this while a backup to the same storage is in progress, the
+    chunks of that backup are not referenced until its manifest is stored.
+
+    :param storage: The storage target, see :mod:`companion.api.storage`.
+    :param dry_run: Only find the chunks without deleting them.
+    :type dry_run: bool
+    :returns: The list of unreferenced chunk keys.
+
+    """
+    referenced = set()
+    for manifest_key in list_manifests(storage):
+        manifest = json.loads(storage.get(manifest_key).decode('utf-8'))
+        referenced.update(c['id'] for c in manifest['chunks'])
+
+    unreferenced = [k for k in storage.list(CHUNK_PREFIX)
+                    if k.rsplit('/', 1)[-1] not in referenced]
+    logger.info('Found {} unreferenced chunks'.format(len(unreferenced)))
+    if not dry_run:
+        for key in unreferenced:
+            storage.delete(key)
+    return unreferenced
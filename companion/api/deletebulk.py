@@ -3,16 +3,15 @@
 """
 import logging
 
-from elasticsearch import helpers
-
-from . import util
+from . import util, scan, pipeline, record
 
 
 __all__ = ['delete_by_query']
 logger = logging.getLogger(__name__)
 
 
-def delete_by_query(url, index_name, doc_type, query):
+def delete_by_query(url, index_name, doc_type, query, scan_engine=None,
+                    max_memory=None, dead_letter_path=None):
     """Deletes all documents for the given index and document type.
 
     :param url: A full connection url.
@@ -20,33 +19,45 @@ def delete_by_query(url, index_name, doc_type, query):
     :param doc_type: The name of the document type to delete.
     :param query: A query body. If provided as None, all documents will be
     deleted.
+    :param scan_engine: The engine that reads the documents to delete, see
+        :mod:`companion.api.scan`. Default is a scroll.
+    :param max_memory: Limit the hits buffered between the scan and the bulk
+        requests to a share of this many bytes, see
+        :func:`companion.api.pipeline.memory_limits`.
+    :param dead_letter_path: Write failed deletes to this file instead of
+        stopping, see :class:`companion.api.pipeline.DeadLetters`.
+    :returns: The number of deleted and failed documents.
 
     """
     # Inspired by the reindex helper in the elasticsearch lib
     logger.info('Starting delete bulk on index {} and doc type {}'
                 .format(index_name, doc_type))
     client = util.get_client(url)
-    docs = helpers.scan(client,
-                        index=index_name,
-                        doc_type=doc_type,
-                        query=query,
-                        scroll='5m')
-
-    def _docs_to_operations(hits):
-        for h in hits:
-            delete_op = {
-                '_op_type': 'delete',
-                '_index': h['_index'],
-                '_type': h['_type'],
-                '_id': h['_id']
-            }
-            yield delete_op
-
-    kwargs = {
-        'stats_only': True,
-    }
-
-    stats = helpers.bulk(client, _docs_to_operations(docs), chunk_size=1000,
-                         **kwargs)
+    scan_engine = scan_engine or scan.ScrollEngine()
+    # Only the metadata is needed to delete, so the sources are not fetched.
+    docs = scan_engine(client,
+                       index=index_name,
+                       doc_type=doc_type,
+                       query=query,
+                       _source=False)
+    docs = (record.Doc.from_hit(h, op_type='delete') for h in docs)
+
+    kwargs = {}
+    limits = pipeline.memory_limits(max_memory)
+    if limits is not None:
+        docs = pipeline.bounded(docs, limits.queue_bytes)
+        kwargs['max_chunk_bytes'] = limits.chunk_bytes
+
+    dead_letters = None
+    if dead_letter_path is not None:
+        dead_letters = pipeline.DeadLetters(dead_letter_path)
+    try:
+        stats = pipeline.send_actions(client, docs,
+                                      dead_letters=dead_letters,
+                                      chunk_size=1000, **kwargs)
+    finally:
+        if dead_letters is not None:
+            dead_letters.close()
     logger.info('Finished bulk delete, statistics:')
     logger.info(stats)
+    return stats
@@ -0,0 +1,167 @@
+"""Estimate the cost of re-index, delete and backup jobs before running them.
+
+The document counts, store sizes and the date distribution of the source are
+requested in parallel. The duration is predicted from the throughput of
+earlier runs, which the CLI records in ``~/.companion/throughput.json``.
+
+"""
+import os
+import json
+import math
+import logging
+import concurrent.futures
+
+from . import util, reindex
+
+__all__ = ['parallel', 'estimate', 'record_throughput', 'load_throughput']
+logger = logging.getLogger(__name__)
+
+HISTORY_PATH = os.path.join(os.path.expanduser('~'), '.companion',
+                            'throughput.json')
+
+# The approximate size of a delete or update action, which has no source.
+DELETE_ACTION_BYTES = 100
+
+
+def parallel(calls):
+    """Run functions in parallel threads.
+
+    :param calls: A dict of functions without arguments by name.
+    :type calls: dict
+    :returns: A dict of their results by name.
+
+    """
+    with concurrent.futures.ThreadPoolExecutor(max(len(calls), 1)) as pool:
+        futures = {name: pool.submit(func) for name, func in calls.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def load_throughput(path=HISTORY_PATH):
+    """Load the recorded throughput by operation, or an empty dict."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_throughput(operation, docs, seconds, path=HISTORY_PATH):
+    """Record the throughput of a finished job. Earlier runs are averaged
+    with an exponential weight, so the estimate follows changes in the
+    cluster.
+
+    :param operation: "reindex", "delete", "update" or "backup".
+    :type operation: str
+    :param docs: The number of documents that the job processed.
+    :type docs: int
+    :param seconds: The duration of the job.
+    :type seconds: float
+
+    """
+    if not docs or seconds <= 0:
+        return
+    history = load_throughput(path)
+    docs_per_sec = docs / seconds
+    previous = history.get(operation)
+    if previous:
+        docs_per_sec = (previous['docs_per_sec'] + docs_per_sec) / 2
+    history[operation] = {
+        'docs_per_sec': docs_per_sec,
+        'runs': (previous or {}).get('runs', 0) + 1
+    }
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(history, f, indent=2)
+    except OSError as e:
+        logger.warn('Could not record throughput in {}: {}'.format(path, e))
+
+
+def _index_sizes(client, index_name):
+    """Primary document counts and store sizes by index."""
+    res = client.indices.stats(index=index_name, metric='docs,store')
+    sizes = {}
+    for name, stats in res['indices'].items():
+        primaries = stats['primaries']
+        sizes[name] = (primaries['docs']['count'],
+                       primaries['store']['size_in_bytes'])
+    return sizes
+
+
+def estimate(url, operation, index_name, query=None, doc_type=None,
+             target_index_name=None, date_field=None, delete_docs=False,
+             chunk_size=1000, history_path=HISTORY_PATH):
+    """Estimate the size and duration of a job. Document sizes are the
+    average stored size, which includes the indexes and compression, so they
+    are a rough measure of the JSON size.
+
+    :param url: Cluster url
+    :type url: str
+    :param operation: "reindex", "delete", "update" or "backup".
+    :type operation: str
+    :param index_name: The source index name or pattern.
+    :type index_name: str
+    :param query: A query for the source documents.
+    :type query: dict
+    :param doc_type: For delete and update, the document type.
+    :type doc_type: str
+    :param target_index_name: For reindex, the target name or template.
+    :type target_index_name: str
+    :param date_field: For reindex, the date field of the template.
+    :type date_field: str
+    :param delete_docs: For reindex, whether the source documents are
+        deleted too.
+    :type delete_docs: bool
+    :param chunk_size: The number of actions per bulk request.
+    :type chunk_size: int
+    :returns: A dict with "docs", "bytes", "bulk_requests", "targets" as a
+        list of (name, docs, bytes) tuples, "avg_doc_bytes", and "seconds",
+        which is None without earlier runs of the operation.
+
+    """
+    client = util.get_client(url)
+    calls = {'sizes': lambda: _index_sizes(client, index_name)}
+    if operation == 'reindex':
+        calls['plan'] = lambda: reindex.plan_targets(
+            url, index_name, target_index_name, date_field=date_field,
+            query=query)
+    else:
+        calls['count'] = lambda: client.count(index=index_name,
+                                              doc_type=doc_type,
+                                              body=query)['count']
+    results = parallel(calls)
+
+    total_docs = sum(docs for docs, _ in results['sizes'].values())
+    total_bytes = sum(size for _, size in results['sizes'].values())
+    avg_doc_bytes = total_bytes / total_docs if total_docs else 0
+
+    if operation == 'reindex':
+        targets = [(name, count, int(count * avg_doc_bytes))
+                   for name, count in results['plan']]
+        docs = sum(count for _, count in results['plan'])
+        actions = docs * 2 if delete_docs else docs
+        transfer_bytes = int(docs * avg_doc_bytes)
+    elif operation in ('delete', 'update'):
+        targets = []
+        docs = results['count']
+        actions = docs
+        transfer_bytes = docs * DELETE_ACTION_BYTES
+    else:
+        docs = results['count']
+        actions = 0
+        transfer_bytes = int(docs * avg_doc_bytes)
+        targets = [(index_name, docs, transfer_bytes)]
+
+    seconds = None
+    throughput = load_throughput(history_path).get(operation)
+    if throughput and docs:
+        seconds = docs / throughput['docs_per_sec']
+
+    return {
+        'docs': docs,
+        'bytes': transfer_bytes,
+        'avg_doc_bytes': avg_doc_bytes,
+        'bulk_requests': int(math.ceil(actions / chunk_size)),
+        'targets': targets,
+        'seconds': seconds
+    }
@@ -1,11 +1,142 @@
-"""Health API. Thin wrapper around the Elasticsearch health command."""
+"""Health API. Thin wrapper around the Elasticsearch health command, with
+support for watching the health for changes and waiting for a status.
+
+"""
+import time
 import logging
 from . import util
 
-__all__ = ['health']
+__all__ = ['health', 'watch', 'wait_for_status', 'diff']
 logger = logging.getLogger(__name__)
 
+# Only fetch the fields that are watched. On large clusters the full response
+# at shards level is megabytes of JSON.
+COUNTERS = ['status', 'number_of_nodes', 'active_shards', 'relocating_shards',
+            'initializing_shards', 'unassigned_shards']
+FILTER_PATHS = {
+    'cluster': COUNTERS,
+    'indices': COUNTERS + ['indices.*.{}'.format(c) for c in COUNTERS[2:]] +
+    ['indices.*.status'],
+    'shards': COUNTERS + ['indices.*.status',
+                          'indices.*.shards.*.status',
+                          'indices.*.shards.*.unassigned_shards',
+                          'indices.*.shards.*.initializing_shards',
+                          'indices.*.shards.*.relocating_shards']
+}
+
 
 def health(url, level):
     es = util.get_client(url)
-    logger.info(util.pretty(es.cluster.health(level=level)))
+    response = es.cluster.health(level=level)
+    logger.info(util.pretty(response))
+    return response
+
+
+def _flatten(snapshot, prefix=''):
+    """Flatten a nested health response to a dict with dotted keys."""
+    flat = {}
+    for key, value in snapshot.items():
+        path = '{}{}'.format(prefix, key)
+        if isinstance(value, dict):
+            flat.update(_flatten(value, path + '.'))
+        else:
+            flat[path] = value
+    return flat
+
+
+def diff(old, new):
+    """Compare two health snapshots.
+
+    :param old: The previous health response.
+    :type old: dict
+    :param new: The current health response.
+    :type new: dict
+    :returns: A sorted list of (key, old value, new value) tuples for all
+        changed values. Keys use dot notation, e.g.
+        "indices.myindex.shards.0.status". Added and removed keys have None as
+        the old and new value respectively.
+
+    """
+    old_flat = _flatten(old)
+    new_flat = _flatten(new)
+    changes = []
+    for key in sorted(set(old_flat) | set(new_flat)):
+        if old_flat.get(key) != new_flat.get(key):
+            changes.append((key, old_flat.get(key), new_flat.get(key)))
+    return changes
+
+
+def watch(url, level='cluster', interval=5, iterations=None):
+    """Poll the cluster health and log only what changed since the last poll.
+
+    :param url: Cluster url
+    :type url: str
+    :param level: One of cluster, indices or shards.
+    :type level: str
+    :param interval: Seconds between polls.
+    :type interval: float
+    :param iterations: Stop after this many polls. Default is to poll
+        forever.
+    :type iterations: int
+
+    """
+    es = util.get_client(url)
+    filter_path = ','.join(FILTER_PATHS[level])
+    previous = {}
+    polled = 0
+    while iterations is None or polled < iterations:
+        if polled:
+            time.sleep(interval)
+        current = es.cluster.health(level=level, filter_path=filter_path)
+        changes = diff(previous, current)
+        if changes:
+            logger.info('Cluster status {}, {} changes'
+                        .format(current.get('status'), len(changes)))
+        for key, old_value, new_value in changes:
+            logger.info('{}: {} -> {}'.format(key, old_value, new_value))
+        previous = current
+        polled += 1
+
+
+def wait_for_status(url, status, timeout=30, max_wait=None, index=None):
+    """Block until the cluster reaches at least the given status.
+
+    The waiting happens on the cluster with the wait_for_status parameter, so
+    each request is a long poll of up to timeout seconds rather than a
+    client-side sleep loop.
+
+    :param url: Cluster url
+    :type url: str
+    :param status: One of green, yellow or red.
+    :type status: str
+    :param timeout: Seconds for each long poll.
+    :type timeout: int
+    :param max_wait: Give up after this many seconds. Default is to wait
+        forever.
+    :type max_wait: int
+    :param index: Only wait for the health of these indexes.
+    :type index: str
+    :returns: True if the status was reached, False if max_wait passed.
+
+    """
+    es = util.get_client(url)
+    start = time.time()
+    while True:
+        poll_timeout = timeout
+        if max_wait is not None:
+            remaining = max_wait - (time.time() - start)
+            if remaining <= 0:
+                return False
+            poll_timeout = max(1, min(timeout, int(remaining)))
+        # Elasticsearch answers a timed out wait with a 408 and the health.
+        res = es.cluster.health(index=index,
+                                wait_for_status=status,
+                                timeout='{}s'.format(poll_timeout),
+                                filter_path='status,timed_out',
+                                request_timeout=poll_timeout + 10,
+                                ignore=408)
+        if not res['timed_out']:
+            logger.info('Cluster status is {}'.format(res['status']))
+            return True
+        logger.info('Cluster status is {}, waiting for {}'
+                    .format(res['status'], status))
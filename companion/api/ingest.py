@@ -0,0 +1,151 @@
+"""Temporarily optimize index settings for bulk ingestion.
+
+Refreshes and replica writes slow down bulk indexing considerably. While
+documents are written, the target indexes get a refresh_interval of -1 and
+no replicas. Afterwards the original settings are restored, the indexes are
+optionally force merged and the cluster health is awaited.
+
+For Example:
+
+    >>> with IngestSettings(client) as ingest:
+    >>>     ingest.prepare('myindex')
+    >>>     helpers.bulk(client, actions)
+
+"""
+import logging
+import threading
+
+from elasticsearch import TransportError
+
+from .. import error
+
+__all__ = ['IngestSettings']
+logger = logging.getLogger(__name__)
+
+INGEST_SETTINGS = {
+    'index.refresh_interval': '-1',
+    'index.number_of_replicas': 0
+}
+
+# The error types of creating an index that exists, before and after 6.0.
+ALREADY_EXISTS = ('index_already_exists_exception',
+                  'resource_already_exists_exception')
+
+
+class IngestSettings:
+    """Tracks the indexes prepared for ingestion and restores them.
+
+    :param client: An Elasticsearch client.
+    :param force_merge: Force merge the indexes to this number of segments
+        after restoring the settings. Default is to not force merge.
+    :type force_merge: int
+    :param wait_for_status: The cluster health to wait for after restoring the
+        settings, or None to not wait.
+    :type wait_for_status: str
+    :param wait_timeout: How long to wait for the health, e.g. "30m".
+    :type wait_timeout: str
+
+    """
+    def __init__(self, client, force_merge=None, wait_for_status='green',
+                 wait_timeout='30m'):
+        self.client = client
+        self.force_merge = force_merge
+        self.wait_for_status = wait_for_status
+        self.wait_timeout = wait_timeout
+        self.original = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.restore()
+        else:
+            self.restore_after_error()
+
+    def prepare(self, index_name):
+        """Create the index if it does not exist, save its settings and apply
+        the ingest settings. Indexes that were already prepared are skipped.
+        Safe to call from several threads.
+
+        """
+        with self._lock:
+            self._prepare(index_name)
+
+    def _prepare(self, index_name):
+        if index_name in self.original:
+            return
+
+        # Creating the index without a body applies matching templates, so
+        # the saved settings are what the index would have had anyway.
+        try:
+            self.client.indices.create(index=index_name)
+        except TransportError as e:
+            if e.error not in ALREADY_EXISTS:
+                raise
+        response = self.client.indices.get_settings(
+            index=index_name, name=','.join(INGEST_SETTINGS))
+        settings = {}
+        for index_settings in response.values():
+            index_part = index_settings['settings'].get('index', {})
+            for key in INGEST_SETTINGS:
+                # A missing setting is restored to the default with None.
+                settings[key] = index_part.get(key.split('.', 1)[1])
+
+        logger.info('Applying ingest settings to {}'.format(index_name))
+        self.original[index_name] = settings
+        self.client.indices.put_settings(index=index_name,
+                                         body=INGEST_SETTINGS)
+
+    def restore(self):
+        """Restore the original settings of all prepared indexes. Every index
+        is attempted even if some of them fail.
+
+        """
+        failed = []
+        for index_name, settings in self.original.items():
+            logger.info('Restoring settings of {}'.format(index_name))
+            try:
+                self.client.indices.put_settings(index=index_name,
+                                                 body=settings)
+            except Exception:
+                logger.exception('Could not restore settings of {}: {}'
+                                 .format(index_name, settings))
+                failed.append(index_name)
+        restored = [i for i in self.original if i not in failed]
+        self.original = {}
+
+        if restored and self.force_merge is not None:
+            logger.info('Force merging {} indexes'.format(len(restored)))
+            self.client.indices.forcemerge(index=','.join(restored),
+                                           max_num_segments=self.force_merge,
+                                           request_timeout=3600)
+
+        if restored and self.wait_for_status:
+            logger.info('Waiting for status {}'.format(self.wait_for_status))
+            # Elasticsearch answers a timed out wait with a 408 and the
+            # health.
+            res = self.client.cluster.health(
+                index=','.join(restored),
+                wait_for_status=self.wait_for_status,
+                timeout=self.wait_timeout,
+                request_timeout=3600,
+                ignore=408)
+            if res['timed_out']:
+                logger.warn('Timed out waiting for status {}, status is {}'
+                            .format(self.wait_for_status, res['status']))
+
+        if failed:
+            raise error.CompanionException(
+                'Could not restore settings of {}'.format(', '.join(failed)))
+
+    def restore_after_error(self):
+        """Restore the original settings while another error is raised. A
+        failed restore is logged, so it does not replace that error.
+
+        """
+        try:
+            self.restore()
+        except Exception:
+            logger.exception('Could not restore ingest settings')
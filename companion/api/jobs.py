@@ -0,0 +1,511 @@
+"""Run many re-index, delete, backup, verify, health and setup jobs in one
+process.
+
+Jobs are read from a file with one JSON object per line:
+
+    {"id": "backup-2015", "type": "backup",
+     "args": {"index_name": "event-2015", "target": "s3://backups/event"}}
+    {"id": "delete-2015", "type": "delete", "depends_on": ["backup-2015"],
+     "args": {"index_name": "event-2015", "doc_type": "click"}}
+
+The args are the arguments of the API function of the job type, without the
+url. A "url" key on the job overrides the cluster url. Scan jobs also take
+"scan_engine", "sort_field" and "scan_workers" args, see
+:func:`companion.api.scan.get_engine`. Backup jobs take a storage "target"
+url, see :func:`companion.api.storage.get_storage`. Health jobs return the
+cluster health, or wait for a "wait_for_status" and fail if it is not
+reached.
+
+A job starts when all jobs it depends on have succeeded. When a job fails,
+the jobs that depend on it are skipped. Jobs run concurrently within global
+limits on jobs, scroll contexts and bulk threads, and share one client with
+a bounded connection pool per cluster.
+
+Jobs can also be submitted over time to a :class:`Scheduler`, as the job
+service does, see :mod:`companion.api.server`.
+
+"""
+import json
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from . import (util, scan, reindex, deletebulk, backup, verify, pipeline,
+               health, setup, storage as backup_storage)
+from .. import error
+
+__all__ = ['Job', 'Limits', 'Scheduler', 'load_jobs', 'run_jobs']
+logger = logging.getLogger(__name__)
+
+
+def _reindex(url, args, scan_engine):
+    return reindex.date_reindex(url, scan_engine=scan_engine, **args)
+
+
+def _delete(url, args, scan_engine):
+    return deletebulk.delete_by_query(url, args.pop('index_name'),
+                                      args.pop('doc_type', None),
+                                      args.pop('query', None),
+                                      scan_engine=scan_engine, **args)
+
+
+def _backup(url, args, scan_engine):
+    target = backup_storage.get_storage(args.pop('target'))
+    return backup.backup(url, args.pop('index_name'), target,
+                         scan_engine=scan_engine, **args)
+
+
+def _verify(url, args, scan_engine):
+    return verify.verify(url, **args)
+
+
+def _health(url, args, scan_engine):
+    if 'wait_for_status' not in args:
+        return health.health(url, args.get('level', 'cluster'))
+    status = args.pop('wait_for_status')
+    if not health.wait_for_status(url, status, **args):
+        raise error.CompanionException(
+            'Cluster did not reach status {}'.format(status))
+    return {'status': status}
+
+
+def _setup(url, args, scan_engine):
+    return setup.IndexMapper(url, **args).run()
+
+
+JOB_TYPES = {
+    'reindex': _reindex,
+    'delete': _delete,
+    'backup': _backup,
+    'verify': _verify,
+    'health': _health,
+    'setup': _setup
+}
+
+SCAN_ARGS = ('scan_engine', 'sort_field', 'scan_workers')
+# Args that are counted against the limits, which must be positive integers.
+SLOT_ARGS = ('scan_workers', 'slices', 'bulk_threads')
+
+
+class Job:
+    """A job read from a jobs file.
+
+    :param job_id: The unique id of the job.
+    :type job_id: str
+    :param job_type: One of the keys of JOB_TYPES.
+    :type job_type: str
+    :param args: The arguments of the job.
+    :type args: dict
+    :param depends_on: The ids of the jobs that must succeed first.
+    :type depends_on: list
+    :param url: The cluster url, if it differs from the default.
+    :type url: str
+
+    """
+    def __init__(self, job_id, job_type, args=None, depends_on=None,
+                 url=None):
+        if job_type not in JOB_TYPES:
+            raise error.CompanionException(
+                'Unknown type {} of job {}'.format(job_type, job_id))
+        self.id = job_id
+        self.type = job_type
+        self.args = dict(args or {})
+        for key in SLOT_ARGS:
+            value = self.args.get(key, 1)
+            if not isinstance(value, int) or isinstance(value, bool) or \
+                    value < 1:
+                raise error.CompanionException(
+                    'The {} of job {} must be a positive integer: {!r}'
+                    .format(key, job_id, value))
+        self.depends_on = list(depends_on or [])
+        self.url = url
+
+    @classmethod
+    def from_dict(cls, spec):
+        if 'id' not in spec or 'type' not in spec:
+            raise error.CompanionException(
+                'Jobs need an id and a type: {}'.format(spec))
+        return cls(spec['id'], spec['type'], args=spec.get('args'),
+                   depends_on=spec.get('depends_on'), url=spec.get('url'))
+
+    @property
+    def scrolls(self):
+        """The number of scroll contexts that the job keeps open."""
+        if self.type == 'verify':
+            # Both sides are scanned, one after the other.
+            return self.args.get('slices', 4)
+        return self.args.get('scan_workers', 1)
+
+    @property
+    def bulk_threads(self):
+        """The number of bulk requests that the job sends in parallel."""
+        if self.type == 'reindex' and self.args.get('processes') is not None:
+            return self.args.get('bulk_threads', 2)
+        if self.type in ('reindex', 'delete'):
+            return 1
+        return 0
+
+    def run(self, default_url):
+        args = dict(self.args)
+        scan_args = {key: args.pop(key) for key in SCAN_ARGS if key in args}
+        scan_engine = None
+        if scan_args:
+            scan_engine = scan.get_engine(
+                scan_args.get('scan_engine', 'scroll'),
+                sort_field=scan_args.get('sort_field'),
+                workers=scan_args.get('scan_workers', 1))
+        return JOB_TYPES[self.type](self.url or default_url, args,
+                                    scan_engine)
+
+
+class Limits:
+    """Global limits for all jobs of a run.
+
+    :param max_jobs: The number of jobs to run at the same time.
+    :type max_jobs: int
+    :param max_scrolls: The number of scroll contexts open at the same time.
+    :type max_scrolls: int
+    :param max_bulk_threads: The number of bulk requests sent at the same
+        time.
+    :type max_bulk_threads: int
+    :param max_connections: The maximum number of connections per node.
+    :type max_connections: int
+
+    """
+    def __init__(self, max_jobs=4, max_scrolls=16, max_bulk_threads=8,
+                 max_connections=20):
+        self.max_jobs = max_jobs
+        self.max_connections = max_connections
+        self.scrolls = pipeline.Slots(max_scrolls)
+        self.bulk_threads = pipeline.Slots(max_bulk_threads)
+
+
+def load_jobs(path):
+    """Read jobs from a JSON lines file and check their dependencies.
+
+    :returns: A list of :class:`Job` in file order.
+
+    """
+    jobs = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                spec = json.loads(line)
+            except ValueError as e:
+                raise error.CompanionException(
+                    'Invalid job on line {}: {}'.format(line_number, e))
+            jobs.append(Job.from_dict(spec))
+    _check_graph(jobs)
+    return jobs
+
+
+def _check_graph(jobs, known=()):
+    """Raise for duplicate ids, unknown dependencies and cycles.
+
+    :param known: The ids of earlier jobs, which jobs can depend on.
+
+    """
+    by_id = {}
+    for job in jobs:
+        if job.id in by_id or job.id in known:
+            raise error.CompanionException('Duplicate job id {}'
+                                           .format(job.id))
+        by_id[job.id] = job
+    for job in jobs:
+        for dependency in job.depends_on:
+            if dependency not in by_id and dependency not in known:
+                raise error.CompanionException(
+                    'Job {} depends on unknown job {}'.format(job.id,
+                                                              dependency))
+
+    visited = set()
+    visiting = set()
+
+    def _visit(job):
+        if job.id in visited:
+            return
+        if job.id in visiting:
+            raise error.CompanionException(
+                'Dependency cycle through job {}'.format(job.id))
+        visiting.add(job.id)
+        for dependency in job.depends_on:
+            if dependency in by_id:
+                _visit(by_id[dependency])
+        visiting.discard(job.id)
+        visited.add(job.id)
+
+    for job in jobs:
+        _visit(job)
+
+
+def _run_job(job, url, limits, on_start=None):
+    # Slots are always taken in the same order, so jobs cannot deadlock.
+    scrolls = min(job.scrolls, limits.scrolls.size)
+    bulk_threads = min(job.bulk_threads, limits.bulk_threads.size)
+    limits.scrolls.acquire(scrolls)
+    limits.bulk_threads.acquire(bulk_threads)
+    result = {'id': job.id, 'type': job.type}
+    start = time.time()
+    try:
+        if on_start is not None:
+            on_start(start)
+        logger.info('Starting job {}'.format(job.id))
+        result['result'] = job.run(url)
+        result['status'] = 'succeeded'
+    except Exception as e:
+        logger.exception('Job {} failed'.format(job.id))
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        limits.bulk_threads.release(bulk_threads)
+        limits.scrolls.release(scrolls)
+    result['started'] = start
+    result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+# Job statuses before a job finishes.
+ACTIVE = ('pending', 'queued', 'running')
+
+
+class Scheduler:
+    """Runs jobs that are submitted over time, in dependency order and within
+    global limits, on one pool of threads.
+
+    A job is "pending" until its dependencies succeed, "queued" until a
+    thread and its slots are free, "running", and finally "succeeded",
+    "failed", "skipped" when a dependency did not succeed, or "cancelled".
+
+    :param url: The default cluster url.
+    :type url: str
+    :param limits: The global limits. Default is :class:`Limits` defaults.
+    :type limits: Limits
+    :param output: A file object to write a JSON line to for each finished,
+        skipped or cancelled job.
+    :param max_finished: Forget the results of the oldest finished jobs
+        beyond this many. Default is to keep all of them.
+    :type max_finished: int
+
+    """
+    def __init__(self, url, limits=None, output=None, max_finished=None):
+        self.url = url
+        self.limits = limits or Limits()
+        self.output = output
+        self.max_finished = max_finished
+        self.created = time.time()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            self.limits.max_jobs)
+        self._cond = threading.Condition()
+        # The states of the jobs by id, in submit order.
+        self._states = collections.OrderedDict()
+        self._pending = collections.OrderedDict()
+        self._futures = {}
+        self._active = 0
+        # Statuses of forgotten jobs, which later jobs can still depend on.
+        self._forgotten = {}
+        self._counts = collections.Counter()
+
+    def submit(self, jobs):
+        """Add jobs, which may depend on each other and on earlier jobs.
+
+        :param jobs: The jobs to add.
+        :type jobs: list
+        :returns: The states of the added jobs.
+
+        """
+        with self._cond:
+            _check_graph(jobs, known=set(self._states) | set(self._forgotten))
+            for job in jobs:
+                self._states[job.id] = {'id': job.id, 'type': job.type,
+                                        'status': 'pending',
+                                        'submitted': time.time()}
+                self._pending[job.id] = job
+                self._active += 1
+            self._schedule()
+            return [dict(self._states[job.id]) for job in jobs]
+
+    def _status(self, job_id):
+        if job_id in self._states:
+            return self._states[job_id]['status']
+        return self._forgotten[job_id]
+
+    def _schedule(self):
+        for job in list(self._pending.values()):
+            # A job that finishes right away schedules from its callback, so
+            # jobs can leave the pending ones while this loops.
+            if job.id not in self._pending:
+                continue
+            statuses = [self._status(d) for d in job.depends_on]
+            if any(s in ('failed', 'skipped', 'cancelled') for s in statuses):
+                del self._pending[job.id]
+                logger.warn('Skipping job {}, a dependency did not succeed'
+                            .format(job.id))
+                self._states[job.id]['status'] = 'skipped'
+                self._finish(job.id)
+            elif all(s == 'succeeded' for s in statuses):
+                del self._pending[job.id]
+                self._states[job.id]['status'] = 'queued'
+                future = self._pool.submit(_run_job, job, self.url,
+                                           self.limits,
+                                           self._starter(job.id))
+                self._futures[job.id] = future
+                future.add_done_callback(
+                    lambda f, job_id=job.id: self._done(job_id, f))
+
+    def _starter(self, job_id):
+        def _on_start(start):
+            with self._cond:
+                self._states[job_id].update(status='running', started=start)
+        return _on_start
+
+    def _done(self, job_id, future):
+        if future.cancelled():
+            return
+        with self._cond:
+            del self._futures[job_id]
+            try:
+                self._states[job_id].update(future.result())
+            except Exception as e:
+                self._states[job_id].update(
+                    status='failed', error='{}: {}'.format(type(e).__name__, e))
+            self._finish(job_id)
+            self._schedule()
+
+    def _finish(self, job_id):
+        """Record a job that will not run anymore. Called with the lock."""
+        state = self._states[job_id]
+        self._active -= 1
+        self._counts[state['status']] += 1
+        if self.output is not None:
+            self.output.write(json.dumps(state, default=str) + '\n')
+            self.output.flush()
+        if self.max_finished is not None:
+            finished = [i for i, s in self._states.items()
+                        if s['status'] not in ACTIVE]
+            for forget_id in finished[:-self.max_finished or None]:
+                self._forgotten[forget_id] = self._states.pop(forget_id)[
+                    'status']
+        self._cond.notify_all()
+
+    def cancel(self, job_id):
+        """Cancel a job that has not started. Jobs that depend on it are
+        skipped.
+
+        :returns: True if the job was cancelled.
+
+        """
+        with self._cond:
+            if job_id not in self._states:
+                raise error.CompanionException(
+                    'Unknown job {}'.format(job_id))
+            status = self._states[job_id]['status']
+            if status == 'pending':
+                del self._pending[job_id]
+            elif status != 'queued' or not self._futures[job_id].cancel():
+                return False
+            self._futures.pop(job_id, None)
+            self._states[job_id]['status'] = 'cancelled'
+            self._finish(job_id)
+            self._schedule()
+            return True
+
+    def get(self, job_id):
+        """The state of a job, or None for unknown jobs."""
+        with self._cond:
+            state = self._states.get(job_id)
+            return dict(state) if state is not None else None
+
+    def states(self):
+        """The states of all known jobs, in submit order."""
+        with self._cond:
+            return [dict(state) for state in self._states.values()]
+
+    def metrics(self):
+        """The number of jobs by status, the jobs that are running and the
+        slots in use.
+
+        """
+        now = time.time()
+        with self._cond:
+            active = collections.Counter(
+                s['status'] for s in self._states.values()
+                if s['status'] in ACTIVE)
+            running = [{'id': s['id'], 'type': s['type'],
+                        'seconds': round(now - s['started'], 3)}
+                       for s in self._states.values()
+                       if s['status'] == 'running']
+            return {
+                'uptime': round(now - self.created, 3),
+                'active': {status: active[status] for status in ACTIVE},
+                'finished': dict(self._counts),
+                'running': running,
+                'scrolls': {'used': self.limits.scrolls.used,
+                            'size': self.limits.scrolls.size},
+                'bulk_threads': {'used': self.limits.bulk_threads.used,
+                                 'size': self.limits.bulk_threads.size}
+            }
+
+    def wait(self, timeout=None):
+        """Block until all jobs have finished.
+
+        :returns: A dict of the states of the known jobs by id, or None if
+            the timeout passed first.
+
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: not self._active, timeout):
+                return None
+            return {job_id: dict(state)
+                    for job_id, state in self._states.items()}
+
+    def shutdown(self, wait=True):
+        """Cancel the jobs that have not started and stop the threads.
+
+        :param wait: Wait for the running jobs to finish.
+        :type wait: bool
+
+        """
+        with self._cond:
+            for job_id, state in list(self._states.items()):
+                if state['status'] in ('pending', 'queued'):
+                    self.cancel(job_id)
+        self._pool.shutdown(wait=wait)
+
+
+def run_jobs(url, jobs, limits=None, output=None):
+    """Run jobs concurrently in dependency order.
+
+    :param url: The default cluster url.
+    :type url: str
+    :param jobs: The jobs to run, see :func:`load_jobs`.
+    :type jobs: list
+    :param limits: The global limits. Default is :class:`Limits` defaults.
+    :type limits: Limits
+    :param output: A file object to write a JSON line to for each finished
+        or skipped job.
+    :returns: A dict of the result dicts by job id, each with a "status" of
+        "succeeded", "failed" or "skipped", the "seconds" it ran, and the
+        "result" or "error" of the job.
+
+    """
+    limits = limits or Limits()
+    util.enable_client_cache(limits.max_connections)
+    scheduler = Scheduler(url, limits=limits, output=output)
+    try:
+        scheduler.submit(jobs)
+        results = scheduler.wait()
+    finally:
+        scheduler.shutdown()
+        util.disable_client_cache()
+
+    counts = {}
+    for result in results.values():
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    logger.info('Finished {} jobs: {}'.format(
+        len(results), ', '.join('{} {}'.format(n, s)
+                                for s, n in sorted(counts.items()))))
+    return results
@@ -0,0 +1,630 @@
+"""Building blocks for the scan to bulk pipeline of re-index and delete jobs.
+
+Memory use of a pipeline is limited with a budget in bytes, see
+:func:`memory_limits`. The stages between the scan and the bulk sender are
+bounded by the serialized size of what they hold, so large documents slow
+down the scan instead of growing the buffers.
+
+CPU bound stages can run in a pool of processes with :func:`process_map`,
+which typically serializes batches to bulk request bodies that are sent with
+:func:`send_bulk`.
+
+Actions that fail can be written to a dead letter file with
+:class:`DeadLetters` instead of failing the job, see :func:`send_actions`.
+The file can be replayed later with :func:`read_dead_letters`.
+
+"""
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from elasticsearch import helpers, TransportError
+
+from . import record
+
+__all__ = ['ByteBudget', 'Slots', 'MemoryLimits', 'memory_limits',
+           'action_size', 'SizeEstimator', 'bounded',
+           'batched', 'process_map', 'send_bulk', 'DeadLetters',
+           'read_dead_letters', 'send_actions', 'GroupStats',
+           'group_by_target']
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+MemoryLimits = collections.namedtuple(
+    'MemoryLimits', ['scan_bytes', 'queue_bytes', 'group_bytes', 'chunk_bytes'])
+
+
+def memory_limits(max_memory):
+    """Split a memory budget over the pipeline stages.
+
+    Half of the budget is left for the process itself, the scan responses
+    that are being parsed and the serialized bulk request. The other half is
+    shared by the scan buffer, the queue to the bulk sender, the grouping
+    buffer and the bulk chunk.
+
+    :param max_memory: The memory budget in bytes, or None for no limits.
+    :type max_memory: int
+    :returns: A :class:`MemoryLimits` in bytes, or None.
+
+    """
+    if not max_memory:
+        return None
+    share = max_memory // 8
+    return MemoryLimits(scan_bytes=share, queue_bytes=share,
+                        group_bytes=share, chunk_bytes=share)
+
+
+def action_size(action):
+    """The serialized size of a hit, bulk action or
+    :class:`companion.api.record.Doc` in bytes. This serializes decoded
+    sources, use a :class:`SizeEstimator` for streams of items.
+
+    """
+    if isinstance(action, record.Doc):
+        return action.size()
+    return len(json.dumps(action, default=str))
+
+
+class SizeEstimator:
+    """Estimates the serialized size of a stream of hits, bulk actions or
+    :class:`companion.api.record.Doc` objects. Raw sources are measured by
+    their length. Other items are only serialized for a sample, the rest are
+    given the average size of the sample.
+
+    An estimator is not thread safe, use one per thread.
+
+    :param sample_rate: Serialize one in sample_rate items after the first
+        few.
+    :type sample_rate: int
+
+    """
+    SAMPLE_RATE = 100
+    WARMUP = 10
+
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.items = 0
+        self.sampled_items = 0
+        self.sampled_bytes = 0
+
+    def __call__(self, item):
+        if isinstance(item, record.Doc) and (item.source is None or
+                                             item.is_raw):
+            return item.size()
+        self.items += 1
+        if (self.sampled_items < self.WARMUP or
+                self.items % self.sample_rate == 0):
+            n = action_size(item)
+            self.sampled_items += 1
+            self.sampled_bytes += n
+            return n
+        return self.sampled_bytes // self.sampled_items
+
+
+class ByteBudget:
+    """A number of bytes shared by the threads of a pipeline stage.
+
+    :param max_bytes: The number of bytes that can be held at the same time.
+    :type max_bytes: int
+
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.peak = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n, stop=None):
+        """Block until n bytes are available and take them. An item that is
+        larger than the whole budget is let through when nothing else is held.
+
+        :param stop: An event that aborts the wait.
+        :type stop: threading.Event
+        :returns: False if the wait was aborted, True otherwise.
+
+        """
+        with self._cond:
+            while self.used and self.used + n > self.max_bytes:
+                if stop is not None and stop.is_set():
+                    return False
+                self._cond.wait(0.1)
+            self.used += n
+            self.peak = max(self.peak, self.used)
+        return True
+
+    def release(self, n):
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+class Slots:
+    """A counting semaphore that takes several slots at once, e.g. for scroll
+    contexts shared by jobs. A job that needs more slots than there are runs
+    alone.
+
+    :param size: The number of slots.
+    :type size: int
+
+    """
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, n):
+        with self._cond:
+            while self.used and self.used + n > self.size:
+                self._cond.wait()
+            self.used += n
+
+    def release(self, n):
+        with self._cond:
+            self.used -= n
+            self._cond.notify_all()
+
+
+def bounded(items, max_bytes, size=None):
+    """Read items in a background thread, holding at most max_bytes of them
+    until they are consumed. The reader blocks when the budget is used up,
+    which applies backpressure to a scan. Errors in the reader are raised in
+    the consumer.
+
+    :param items: An iterable of hits or bulk actions.
+    :param max_bytes: The maximum size of the buffered items.
+    :type max_bytes: int
+    :param size: A function that returns the size of an item in bytes, a
+        :class:`SizeEstimator` by default.
+    :returns: A generator of the items, in order.
+
+    """
+    size = size or SizeEstimator()
+    budget = ByteBudget(max_bytes)
+    buffered = queue.Queue()
+    stop = threading.Event()
+
+    iterator = iter(items)
+
+    def _run():
+        try:
+            for item in iterator:
+                n = size(item)
+                if not budget.acquire(n, stop):
+                    return
+                buffered.put((item, n))
+            buffered.put((_DONE, 0))
+        except Exception as e:
+            buffered.put((e, 0))
+        finally:
+            # Generators must be closed by the thread that iterates them.
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=_run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, n = buffered.get()
+            if item is _DONE:
+                break
+            elif isinstance(item, Exception):
+                raise item
+            budget.release(n)
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+        logger.debug('Peak buffered {:.1f} MB'.format(budget.peak / 1e6))
+
+
+def _target(action):
+    """The index and routing that a bulk action is sent to."""
+    return action.get('_index'), action.get('_routing')
+
+
+def _group_key(action):
+    # Deletes sort after writes, so a document is never deleted from its
+    # source before the copy is sent within the same buffer.
+    return (action.get('_op_type') == 'delete',
+            action.get('_index') or '',
+            action.get('_routing') or '')
+
+
+class GroupStats:
+    """Statistics of :func:`group_by_target`.
+
+    The fan-out is the average number of distinct index and routing targets
+    per bulk request of chunk_size actions, before and after grouping.
+
+    """
+    # Measure the serialized size of every n-th action to estimate memory use.
+    SAMPLE_RATE = 100
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.actions = 0
+        self.peak_actions = 0
+        self.sampled_actions = 0
+        self.sampled_bytes = 0
+        self.targets_before = 0
+        self.targets_after = 0
+
+    def sample(self, action):
+        if self.actions % self.SAMPLE_RATE == 0:
+            self.sampled_actions += 1
+            self.sampled_bytes += action_size(action)
+
+    @property
+    def avg_action_bytes(self):
+        if not self.sampled_actions:
+            return 0
+        return self.sampled_bytes / self.sampled_actions
+
+    @property
+    def peak_bytes(self):
+        return int(self.peak_actions * self.avg_action_bytes)
+
+    @property
+    def chunks(self):
+        return max(1, -(-self.actions // self.chunk_size))
+
+    @property
+    def fan_out_before(self):
+        return self.targets_before / self.chunks
+
+    @property
+    def fan_out_after(self):
+        return self.targets_after / self.chunks
+
+    def log(self):
+        logger.info('Grouped {} actions by target. Peak buffer {} actions '
+                    '(~{:.1f} MB). Targets per bulk request: {:.1f} before, '
+                    '{:.1f} after'
+                    .format(self.actions, self.peak_actions,
+                            self.peak_bytes / 1e6, self.fan_out_before,
+                            self.fan_out_after))
+
+
+def _count_targets(actions, chunk_size):
+    targets = 0
+    for start in range(0, len(actions), chunk_size):
+        targets += len(set(_target(a)
+                           for a in actions[start:start + chunk_size]))
+    return targets
+
+
+def batched(items, size):
+    """Split an iterable in lists of up to size items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process_map(func, items, processes=None, max_pending=None):
+    """Apply a function to each item in a pool of processes, and yield the
+    results as they complete. The function and the items must be picklable.
+
+    At most max_pending items are in the pool at a time, which bounds memory
+    use and applies backpressure to the items iterator.
+
+    :param func: A module level function, or a functools.partial of one.
+    :param items: An iterable of items, typically batches of hits.
+    :param processes: The number of processes. Default is one per core.
+    :type processes: int
+    :param max_pending: The maximum number of submitted items. Default is
+        twice the number of processes.
+    :type max_pending: int
+    :returns: A generator of results, not necessarily in order.
+
+    """
+    processes = processes or os.cpu_count() or 1
+    max_pending = max_pending or 2 * processes
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield future.result()
+
+
+def _body_actions(body):
+    """Turn a serialized bulk request body back into a list of actions."""
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    lines = iter(line for line in body.splitlines() if line.strip())
+    actions = []
+    for line in lines:
+        (op_type, meta), = json.loads(line).items()
+        action = dict(meta, _op_type=op_type)
+        if op_type == 'update':
+            action.update(json.loads(next(lines)))
+        elif op_type != 'delete':
+            action['_source'] = json.loads(next(lines))
+        actions.append(action)
+    return actions
+
+
+def _check_bulk_response(response, body=None, dead_letters=None):
+    """Count the results of a bulk response the way helpers.bulk does, and
+    raise a BulkIndexError for failed actions, or write them to dead_letters
+    along with the actions from the request body.
+
+    """
+    errors = []
+    failed = []
+    success = 0
+    for position, item in enumerate(response.get('items', [])):
+        op_type, result = item.popitem()
+        if 200 <= result.get('status', 500) < 300:
+            success += 1
+        else:
+            errors.append({op_type: result})
+            failed.append((position, result))
+    if errors and dead_letters is not None:
+        actions = _body_actions(body)
+        dead_letters.write([(actions[position], result.get('status'),
+                             result.get('error'))
+                            for position, result in failed])
+    elif errors:
+        raise helpers.BulkIndexError(
+            '{} document(s) failed to index.'.format(len(errors)), errors)
+    return success
+
+
+def send_bulk(client, bodies, threads=2, max_pending=None,
+              dead_letters=None):
+    """Send serialized bulk request bodies from a pool of threads.
+
+    :param client: An Elasticsearch client.
+    :param bodies: An iterable of bulk request bodies, as newline delimited
+        JSON text. Bytes are decoded, since the client only sends text.
+    :param threads: The number of requests to send in parallel.
+    :type threads: int
+    :param max_pending: The maximum number of bodies waiting to be sent.
+        Default is twice the number of threads.
+    :type max_pending: int
+    :param dead_letters: Write failed actions here instead of raising.
+    :type dead_letters: DeadLetters
+    :returns: The number of successful actions. Failed actions raise a
+        BulkIndexError, like helpers.bulk.
+
+    """
+    max_pending = max_pending or 2 * threads
+    filter_path = 'items.*.status,items.*.error,items.*._index,items.*._id'
+
+    def _send(body):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        return _check_bulk_response(client.bulk(body=body,
+                                                filter_path=filter_path),
+                                    body=body, dead_letters=dead_letters)
+
+    success = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        pending = set()
+        try:
+            for body in bodies:
+                pending.add(executor.submit(_send, body))
+                if len(pending) >= max_pending:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    success += sum(future.result() for future in done)
+            for future in concurrent.futures.as_completed(pending):
+                success += future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+    return success
+
+
+class DeadLetters:
+    """Writes failed bulk actions to a file with one JSON object per line,
+    with the original "action", the "status" and the "error" of the item.
+    Failures are written and flushed as they happen, so the file is complete
+    up to the point where a job stopped.
+
+    :param path: The file to write to. An existing file is replaced.
+    :type path: str
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, failures):
+        """Write a list of (action, status, error) tuples."""
+        lines = []
+        for action, status, error in failures:
+            if isinstance(action, record.Doc):
+                action = action.to_action()
+            lines.append(json.dumps({'action': action, 'status': status,
+                                     'error': error}, default=str) + '\n')
+        with self._lock:
+            self._file.writelines(lines)
+            self._file.flush()
+            self.count += len(lines)
+
+    def close(self):
+        self._file.close()
+        if self.count:
+            logger.warn('Wrote {} failed actions to {}'.format(self.count,
+                                                              self.path))
+
+
+def read_dead_letters(path):
+    """Read the actions of a dead letter file, see :class:`DeadLetters`."""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)['action']
+
+
+def _chunk_actions(actions, chunk_size, max_chunk_bytes, serializer):
+    """Split actions in chunks of (action, lines) tuples by number and
+    size, like helpers.bulk, but keep the original actions.
+
+    """
+    chunk = []
+    size = 0
+    for action in actions:
+        meta, data = record.expand_action(action)
+        lines = [serializer.dumps(meta)]
+        if data is not None:
+            lines.append(serializer.dumps(data))
+        action_bytes = sum(len(line) + 1 for line in lines)
+        if chunk and (len(chunk) >= chunk_size or
+                      size + action_bytes > max_chunk_bytes):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append((action, lines))
+        size += action_bytes
+    if chunk:
+        yield chunk
+
+
+def send_actions(client, actions, dead_letters=None, chunk_size=1000,
+                 max_chunk_bytes=100 * 1024 * 1024, max_retries=3,
+                 initial_backoff=2, sleep=time.sleep):
+    """Send bulk actions and count the successful and failed ones.
+
+    Without dead letters, this is helpers.bulk with stats_only, which raises
+    a BulkIndexError for failed actions. With dead letters, actions that are
+    rejected because the cluster is busy (status 429) are sent again with
+    exponential backoff, and other failures are written to the dead letters.
+
+    :param client: An Elasticsearch client.
+    :param actions: An iterable of bulk actions.
+    :param dead_letters: Write failed actions here instead of raising.
+    :type dead_letters: DeadLetters
+    :param chunk_size: The number of actions per bulk request.
+    :type chunk_size: int
+    :param max_chunk_bytes: The maximum size of a bulk request.
+    :type max_chunk_bytes: int
+    :param max_retries: The number of times to retry rejected actions before
+        they are written to the dead letters.
+    :type max_retries: int
+    :param initial_backoff: Seconds to wait before the first retry. The wait
+        doubles with each retry.
+    :type initial_backoff: float
+    :returns: A tuple of the number of successful and failed actions.
+
+    """
+    if dead_letters is None:
+        return helpers.bulk(client, actions, chunk_size=chunk_size,
+                            max_chunk_bytes=max_chunk_bytes,
+                            expand_action_callback=record.expand_action,
+                            stats_only=True)
+
+    filter_path = 'items.*.status,items.*.error'
+    success = 0
+    failed = 0
+    for chunk in _chunk_actions(actions, chunk_size, max_chunk_bytes,
+                                client.transport.serializer):
+        attempt = 0
+        while chunk:
+            body = '\n'.join(line for _, lines in chunk
+                             for line in lines) + '\n'
+            try:
+                response = client.bulk(body=body, filter_path=filter_path)
+            except TransportError as e:
+                if e.status_code != 429 or attempt >= max_retries:
+                    raise
+                response = {'items': [{'index': {'status': 429}}
+                                      for _ in chunk]}
+            retry = []
+            failures = []
+            for (action, lines), item in zip(chunk, response['items']):
+                _, result = item.popitem()
+                status = result.get('status', 500)
+                if 200 <= status < 300:
+                    success += 1
+                elif status == 429 and attempt < max_retries:
+                    retry.append((action, lines))
+                else:
+                    failures.append((action, status, result.get('error')))
+            if failures:
+                dead_letters.write(failures)
+                failed += len(failures)
+            chunk = retry
+            if retry:
+                logger.warn('{} actions rejected, retrying'.format(len(retry)))
+                sleep(initial_backoff * 2 ** attempt)
+                attempt += 1
+    return success, failed
+
+
+def group_by_target(actions, buffer_size=10000, chunk_size=1000, stats=None,
+                    max_bytes=None):
+    """Reorder bulk actions so that actions for the same index and routing
+    end up in the same bulk requests.
+
+    Up to buffer_size actions, or max_bytes of them, are buffered and emitted
+    sorted by target.
+    Within a buffer, writes are emitted before deletes. Use a buffer_size
+    that is a multiple of chunk_size, so bulk requests line up with buffers.
+
+    :param actions: An iterable of bulk actions.
+    :param buffer_size: The maximum number of actions to buffer.
+    :type buffer_size: int
+    :param chunk_size: The number of actions per bulk request, only used for
+        the statistics.
+    :type chunk_size: int
+    :param stats: A :class:`GroupStats` to update while grouping.
+    :type stats: GroupStats
+    :param max_bytes: The maximum serialized size of the buffered actions.
+    :type max_bytes: int
+    :returns: A generator of bulk actions.
+
+    """
+    if stats is None:
+        stats = GroupStats(chunk_size)
+    buffer = []
+    buffer_bytes = 0
+    size = SizeEstimator()
+
+    def _flush():
+        stats.peak_actions = max(stats.peak_actions, len(buffer))
+        stats.targets_before += _count_targets(buffer, chunk_size)
+        buffer.sort(key=_group_key)
+        stats.targets_after += _count_targets(buffer, chunk_size)
+        for action in buffer:
+            yield action
+        del buffer[:]
+
+    for action in actions:
+        stats.sample(action)
+        stats.actions += 1
+        buffer.append(action)
+        if max_bytes:
+            buffer_bytes += size(action)
+        if len(buffer) >= buffer_size or (max_bytes and
+                                          buffer_bytes >= max_bytes):
+            yield from _flush()
+            buffer_bytes = 0
+    yield from _flush()
@@ -0,0 +1,178 @@
+"""A compact record of a document for the scan to bulk pipeline.
+
+Search hits are dicts with the score, sort values and other keys that a
+re-index or delete does not need, and each bulk action used to be another
+dict. A :class:`Doc` holds only what a bulk action needs in slots, so a
+document costs one small object on its way from the scan to the bulk
+request:
+
+    >>> doc = Doc.from_hit(hit)
+    >>> doc.index = 'event2'
+    >>> meta, source = doc.expand()
+
+The source is either the decoded dict or the raw JSON text of the document,
+which is written to bulk requests as it is.
+
+"""
+import sys
+import json
+
+from elasticsearch import helpers
+
+__all__ = ['Doc', 'expand_action']
+
+# Action keys and the attributes that hold them.
+_KEYS = {
+    '_op_type': 'op_type',
+    '_index': 'index',
+    '_type': 'type',
+    '_id': 'id',
+    '_routing': 'routing',
+    '_parent': 'parent',
+    '_source': 'source'
+}
+
+# Metadata of the bulk action line, in this order.
+_META = (('_index', 'index'), ('_type', 'type'), ('_id', 'id'),
+         ('_routing', 'routing'), ('_parent', 'parent'))
+
+
+class Doc:
+    """A document and the bulk operation for it.
+
+    Code that handles actions can read it like an action dict, with
+    ``doc['_index']`` or ``doc.get('_routing')``.
+
+    :param index: The index name.
+    :type index: str
+    :param doc_type: The document type.
+    :type doc_type: str
+    :param doc_id: The document id, or None to let Elasticsearch create one.
+    :type doc_id: str
+    :param source: The decoded source, or its JSON text as str or bytes.
+    :param routing: The routing value.
+    :type routing: str
+    :param parent: The parent id.
+    :type parent: str
+    :param op_type: The bulk operation, e.g. "index" or "delete".
+    :type op_type: str
+
+    """
+    __slots__ = ('op_type', 'index', 'type', 'id', 'routing', 'parent',
+                 'source')
+
+    def __init__(self, index, doc_type, doc_id=None, source=None,
+                 routing=None, parent=None, op_type='index'):
+        self.op_type = op_type
+        self.index = index
+        self.type = doc_type
+        self.id = doc_id
+        self.source = source
+        self.routing = routing
+        self.parent = parent
+
+    @classmethod
+    def from_hit(cls, hit, op_type='index', source=None):
+        """Create a record from a search hit. Routing and parent are also
+        read from the "fields" of the hit. Deletes do not keep the source.
+
+        :param source: The source to use instead of the _source of the hit,
+            e.g. its raw JSON text.
+
+        """
+        fields = hit.get('fields') or {}
+        if source is None and op_type != 'delete':
+            source = hit.get('_source')
+        # Index and type names repeat for every document, so they are kept
+        # once.
+        index = hit.get('_index')
+        doc_type = hit.get('_type')
+        return cls(index and sys.intern(index),
+                   doc_type and sys.intern(doc_type), hit.get('_id'), source,
+                   routing=hit.get('_routing', fields.get('_routing')),
+                   parent=hit.get('_parent', fields.get('_parent')),
+                   op_type=op_type)
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        attribute = _KEYS.get(key)
+        value = getattr(self, attribute) if attribute else None
+        return default if value is None else value
+
+    def __eq__(self, other):
+        return (isinstance(other, Doc) and
+                all(getattr(self, a) == getattr(other, a)
+                    for a in self.__slots__))
+
+    def __repr__(self):
+        return 'Doc({!r}, {!r}, {!r}, op_type={!r})'.format(
+            self.index, self.type, self.id, self.op_type)
+
+    @property
+    def is_raw(self):
+        return isinstance(self.source, (str, bytes))
+
+    def decoded_source(self):
+        """The source as a dict, decoding raw JSON text."""
+        if isinstance(self.source, bytes):
+            return json.loads(self.source.decode('utf-8'))
+        if isinstance(self.source, str):
+            return json.loads(self.source)
+        return self.source
+
+    def meta(self):
+        """The metadata of the bulk action line."""
+        return {key: getattr(self, attribute) for key, attribute in _META
+                if getattr(self, attribute) is not None}
+
+    def expand(self):
+        """The action line and source of the bulk request, like
+        helpers.expand_action. Raw sources are returned as text, which the
+        serializer of the client writes as it is.
+
+        """
+        action = {self.op_type: self.meta()}
+        if self.op_type == 'delete':
+            return action, None
+        if isinstance(self.source, bytes):
+            return action, self.source.decode('utf-8')
+        return action, self.source if self.source is not None else {}
+
+    def size(self):
+        """The approximate serialized size of the record in bytes."""
+        if self.source is None:
+            source_size = 0
+        elif self.is_raw:
+            source_size = len(self.source)
+        else:
+            source_size = len(json.dumps(self.source, default=str))
+        return 100 + source_size
+
+    def to_hit(self):
+        """The record as a hit dict with the decoded source."""
+        hit = self.meta()
+        if self.op_type != 'delete':
+            hit['_source'] = self.decoded_source()
+        return hit
+
+    def to_action(self):
+        """The record as a bulk action dict for helpers.bulk."""
+        action = self.to_hit()
+        action['_op_type'] = self.op_type
+        return action
+
+
+def expand_action(action):
+    """Expand a :class:`Doc` or an action dict into the action line and
+    source of a bulk request. Use it as the expand_action_callback of the
+    bulk helpers.
+
+    """
+    if isinstance(action, Doc):
+        return action.expand()
+    return helpers.expand_action(action)
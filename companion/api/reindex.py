@@ -1,21 +1,227 @@
 """This module supplies various reindex functions.
 
 """
+import re
+import json
+import math
+import fnmatch
+import time
 import logging
+import datetime
+import functools
+import threading
+import collections
+import concurrent.futures
 
 import dateutil.parser
-from elasticsearch import helpers
 
-from . import util
+from elasticsearch.serializer import JSONSerializer
 
+from . import (util, ingest, pipeline, scan, record,
+               transform as field_transform)
+from .. import error
 
-__all__ = ['date_reindex']
+
+__all__ = ['date_reindex', 'plan_targets', 'create_targets', 'plan_sources',
+           'pattern_reindex']
 logger = logging.getLogger(__name__)
 
+# Date histogram intervals for strftime directives, finest first. Weeks are
+# counted by day, since Elasticsearch weeks do not always match %U or %W.
+INTERVALS = [
+    ('second', 'S'),
+    ('minute', 'M'),
+    ('hour', 'HIp'),
+    ('day', 'dajAwUWV'),
+    ('month', 'mbB'),
+    ('year', 'Yy')
+]
+
+
+def _histogram_interval(target_index_name):
+    """Find the date histogram interval for a target index name template
+    such as "myindex-{:%Y-%m}". Returns None for names without date
+    directives.
+
+    """
+    directives = ''.join(re.findall(r'%-?([a-zA-Z])', target_index_name))
+    for interval, letters in INTERVALS:
+        if any(d in letters for d in directives):
+            return interval
+    return None
+
+
+def plan_targets(url, source_index_name, target_index_name, date_field=None,
+                 query=None):
+    """Find the target indexes of a re-index and their expected number of
+    documents, using a date histogram on the date field.
+
+    The counts are expected rather than exact: the histogram uses UTC, while
+    the re-index formats dates as they are stored in each document.
+
+    :param url: Cluster url
+    :type url: str
+    :param source_index_name: The name of the source index to re-index from.
+    :type source_index_name: str
+    :param target_index_name: The name or name template of the target index.
+    :type target_index_name: str
+    :param date_field: The name of the date field for temporal re-indexing.
+    :type date_field: str
+    :param query: A query to use for the source documents
+    :type query: dict
+    :returns: A list of (target index name, document count) tuples, sorted by
+        index name.
+
+    """
+    client = util.get_client(url)
+    body = dict(query or {}, size=0)
+    interval = _histogram_interval(target_index_name)
+    if not date_field or interval is None:
+        res = client.search(index=source_index_name, body=body)
+        return [(target_index_name, res['hits']['total'])]
+
+    body['aggs'] = {
+        'targets': {
+            'date_histogram': {
+                'field': date_field,
+                'interval': interval,
+                'min_doc_count': 1
+            }
+        }
+    }
+    res = client.search(index=source_index_name, body=body)
+    counts = {}
+    for bucket in res['aggregations']['targets']['buckets']:
+        date_value = datetime.datetime.utcfromtimestamp(bucket['key'] / 1000)
+        name = target_index_name.format(date_value)
+        counts[name] = counts.get(name, 0) + bucket['doc_count']
+    return sorted(counts.items())
+
+
+def shard_count(doc_count, docs_per_shard, max_shards=5):
+    """The number of shards for an index with doc_count documents."""
+    shards = math.ceil(doc_count / docs_per_shard)
+    return max(1, min(max_shards, shards))
+
+
+def create_targets(url, plan, docs_per_shard=None, max_shards=5,
+                   batch_size=20):
+    """Create the target indexes of a plan before re-indexing, so the bulk
+    requests do not trigger index creation. Existing indexes are left as they
+    are. The indexes are created in batches, waiting for each batch to be
+    allocated before starting the next one.
+
+    :param url: Cluster url
+    :type url: str
+    :param plan: A list of (index name, document count), see
+        :func:`plan_targets`.
+    :type plan: list
+    :param docs_per_shard: If given, the number of shards of each index is
+        the expected document count divided by this, between 1 and
+        max_shards. Otherwise index templates or defaults decide.
+    :type docs_per_shard: int
+    :param max_shards: The maximum number of shards per index.
+    :type max_shards: int
+    :param batch_size: The number of indexes per batch.
+    :type batch_size: int
+
+    """
+    client = util.get_client(url)
+    for start in range(0, len(plan), batch_size):
+        batch = plan[start:start + batch_size]
+        for index_name, doc_count in batch:
+            body = {}
+            if docs_per_shard:
+                shards = shard_count(doc_count, docs_per_shard, max_shards)
+                body = {'settings': {'index.number_of_shards': shards}}
+            logger.info('Creating index {}'.format(index_name))
+            client.indices.create(index=index_name, body=body, ignore=400)
+        # Elasticsearch answers a timed out wait with a 408 and the health.
+        res = client.cluster.health(index=','.join(name for name, _ in batch),
+                                    wait_for_status='yellow',
+                                    timeout='60s',
+                                    request_timeout=70,
+                                    ignore=408)
+        if res['timed_out']:
+            logger.warn('Timed out waiting for the new indexes, status is {}'
+                        .format(res['status']))
+
+
+_ActionOptions = collections.namedtuple(
+    '_ActionOptions', ['target_index_name', 'date_field', 'delete_docs',
+                       'use_same_id', 'transform', 'doc_transform'])
+
+
+def _hit_to_actions(hit, options):
+    """Turn a source hit, as a dict or a :class:`companion.api.record.Doc`,
+    into the records of the bulk actions of a re-index.
+
+    """
+    doc = hit if isinstance(hit, record.Doc) else record.Doc.from_hit(hit)
+    if options.date_field and options.date_field not in doc.source:
+        logger.error('Date field not found in {}'.format(doc.id))
+        return []
+
+    delete_op = None
+    if options.delete_docs:
+        delete_op = record.Doc(doc.index, doc.type, doc.id,
+                               routing=doc.routing, parent=doc.parent,
+                               op_type='delete')
+
+    new_index_name = options.target_index_name
+    if options.date_field:
+        date_value = dateutil.parser.parse(doc.source[options.date_field])
+        new_index_name = new_index_name.format(date_value)
+    doc.index = new_index_name
+
+    if not options.use_same_id:
+        doc.id = None
+
+    if options.transform is not None:
+        options.transform(doc.source)
+
+    if options.doc_transform is not None:
+        hit = options.doc_transform(doc.to_hit())
+        if hit is None:
+            return []
+        doc = record.Doc.from_hit(hit)
+
+    if delete_op is not None:
+        return [doc, delete_op]
+    return [doc]
+
+
+def _serialize_batch(hits, options):
+    """Turn a batch of source hits into a bulk request body. Runs in a worker
+    process.
+
+    :returns: A tuple of the body as text and the set of target indexes.
+
+    """
+    serializer = JSONSerializer()
+    lines = []
+    index_names = set()
+    for hit in hits:
+        for action in _hit_to_actions(hit, options):
+            meta, source = action.expand()
+            lines.append(serializer.dumps(meta))
+            if source is not None:
+                lines.append(serializer.dumps(source))
+                index_names.add(action.index)
+    if not lines:
+        return '', index_names
+    return '\n'.join(lines) + '\n', index_names
+
 
 def date_reindex(url, source_index_name, target_index_name, date_field=None,
                  delete_docs=False, query=None, use_same_id=True,
-                 scan_kwargs={}):
+                 scan_kwargs={}, source_include=None, source_exclude=None,
+                 transform=None, optimize_ingest=False, force_merge=None,
+                 wait_for_status='green', precreate=False, plan=None,
+                 docs_per_shard=None, max_shards=5, group_buffer=None,
+                 scan_engine=None, max_memory=None, doc_transform=None,
+                 processes=None, bulk_threads=2, dead_letter_path=None,
+                 ingest_settings=None):
     """Re-index all documents in a source index to the target index.
 
     The re-index takes an optional query to limit the source documents.
@@ -46,6 +252,73 @@ def date_reindex(url, source_index_name, target_index_name, date_field=None,
     :param scan_kwargs: Extra arguments for the index scanner. Similar to
         scan_kwargs in helpers.reindex
     :type scan_kwargs: dict
+    :param source_include: Only fetch these source fields. Wildcards are
+        supported. The date field is always included.
+    :type source_include: list
+    :param source_exclude: Do not fetch these source fields. The date field
+        is never excluded.
+    :type source_exclude: list
+    :param transform: A field transform to apply to each document source,
+        either a :class:`companion.api.transform.FieldTransform` or a dict
+        describing one.
+    :type transform: dict
+    :param optimize_ingest: Create or update the target indexes with
+        refresh_interval -1 and no replicas while writing, and restore the
+        original settings afterwards, also when the re-index fails. Note that
+        with delete_docs, source documents are deleted while the targets have
+        no replicas.
+    :type optimize_ingest: bool
+    :param force_merge: With optimize_ingest, force merge the target indexes
+        to this number of segments after writing.
+    :type force_merge: int
+    :param wait_for_status: With optimize_ingest, the cluster health to wait
+        for after restoring the settings, or None to not wait.
+    :type wait_for_status: str
+    :param precreate: Create all target indexes before re-indexing, see
+        :func:`create_targets`.
+    :type precreate: bool
+    :param plan: With precreate, the target plan from :func:`plan_targets`.
+        Computed if not given.
+    :type plan: list
+    :param docs_per_shard: With precreate, the number of documents per shard
+        to size the target indexes with.
+    :type docs_per_shard: int
+    :param max_shards: With precreate, the maximum number of shards.
+    :type max_shards: int
+    :param group_buffer: Buffer up to this many bulk actions and group them
+        by target index and routing, so each bulk request touches fewer
+        shards. Useful with date templates. Default is no grouping.
+    :type group_buffer: int
+    :param scan_engine: The engine that reads the source documents, see
+        :mod:`companion.api.scan`. Default is a scroll.
+    :param max_memory: Limit the documents buffered between the scan and the
+        bulk requests to a share of this many bytes, see
+        :func:`companion.api.pipeline.memory_limits`. The buffer of a
+        parallel scan engine is limited with its own max_bytes. With
+        processes, the number of batches in flight is limited instead.
+    :type max_memory: int
+    :param doc_transform: A function that takes a hit, with the _index,
+        _type, _id, _routing, _parent and _source of the document, and
+        returns the hit to write, or None to skip the document. Skipped
+        documents are not deleted with delete_docs. Given as a function or
+        as a "module:function" string. It runs after the field transform,
+        with _index already set to the target index.
+    :param processes: Turn the hits into bulk requests in this many
+        processes, for re-indexes that are limited by CPU, e.g. by date
+        parsing or transforms. Use 0 for one process per core. With
+        processes, the transforms must be picklable, so doc_transform must be
+        a module level function. Default is to not use processes.
+    :type processes: int
+    :param bulk_threads: With processes, the number of bulk requests to send
+        in parallel.
+    :type bulk_threads: int
+    :param dead_letter_path: Write failed actions to this file instead of
+        stopping, to replay them later, see
+        :class:`companion.api.pipeline.DeadLetters`.
+    :type dead_letter_path: str
+    :param ingest_settings: A :class:`companion.api.ingest.IngestSettings`
+        shared with other re-indexes, to use instead of optimize_ingest. The
+        caller restores it.
     :returns: The result of an iterating bulk operation.
 
     """
@@ -53,46 +326,312 @@ def date_reindex(url, source_index_name, target_index_name, date_field=None,
     logger.info('Starting reindex from {} to {}'
                 .format(source_index_name, target_index_name))
     client = util.get_client(url)
-    docs = helpers.scan(client,
-                        index=source_index_name,
-                        query=query,
-                        scroll='5m',
-                        **scan_kwargs)
+    scan_kwargs = dict(scan_kwargs)
+    if source_include:
+        source_include = list(source_include)
+        if date_field and date_field not in source_include:
+            source_include.append(date_field)
+        scan_kwargs['_source_include'] = source_include
+    if source_exclude:
+        source_exclude = [f for f in source_exclude if f != date_field]
+        if date_field:
+            for pattern in source_exclude:
+                if (fnmatch.fnmatchcase(date_field, pattern) or
+                        date_field.startswith(pattern + '.')):
+                    raise error.CompanionException(
+                        'The date field {} is excluded by {}'
+                        .format(date_field, pattern))
+        if source_exclude:
+            scan_kwargs['_source_exclude'] = source_exclude
+    if isinstance(transform, dict):
+        transform = field_transform.FieldTransform.from_dict(transform)
+    if isinstance(doc_transform, str):
+        doc_transform = field_transform.load_function(doc_transform)
+    if processes is not None and group_buffer:
+        raise error.CompanionException(
+            'Grouping by target is not supported with processes')
+    if precreate:
+        if plan is None:
+            plan = plan_targets(url, source_index_name, target_index_name,
+                                date_field=date_field, query=query)
+        create_targets(url, plan, docs_per_shard=docs_per_shard,
+                       max_shards=max_shards)
+
+    owns_ingest = optimize_ingest and ingest_settings is None
+    if owns_ingest:
+        ingest_settings = ingest.IngestSettings(
+            client, force_merge=force_merge, wait_for_status=wait_for_status)
+    dead_letters = None
+    if dead_letter_path is not None:
+        dead_letters = pipeline.DeadLetters(dead_letter_path)
+
+    scan_engine = scan_engine or scan.ScrollEngine()
+    docs = scan_engine(client,
+                       index=source_index_name,
+                       query=query,
+                       **scan_kwargs)
+    # Only the fields of the bulk actions are kept from here on.
+    docs = (record.Doc.from_hit(h) for h in docs)
+    limits = pipeline.memory_limits(max_memory)
+    if limits is not None and processes is None:
+        docs = pipeline.bounded(docs, limits.queue_bytes)
+
+    options = _ActionOptions(target_index_name, date_field, delete_docs,
+                             use_same_id, transform, doc_transform)
+
+    if processes is not None:
+        # The pools bound the number of batches in flight, so there is no
+        # need to measure the batches in this process.
+        serialize = functools.partial(_serialize_batch, options=options)
+
+        def _bodies():
+            results = pipeline.process_map(serialize,
+                                           pipeline.batched(docs, 1000),
+                                           processes=processes)
+            for body, index_names in results:
+                if ingest_settings is not None:
+                    for index_name in index_names:
+                        ingest_settings.prepare(index_name)
+                if body:
+                    yield body
+
+        try:
+            success = pipeline.send_bulk(client, _bodies(),
+                                         threads=bulk_threads,
+                                         dead_letters=dead_letters)
+        except BaseException:
+            if owns_ingest:
+                ingest_settings.restore_after_error()
+            raise
+        else:
+            if owns_ingest:
+                ingest_settings.restore()
+        finally:
+            if dead_letters is not None:
+                dead_letters.close()
+        return success, dead_letters.count if dead_letters else 0
 
     def _docs_to_operations(hits):
         for h in hits:
-            if date_field and date_field not in h['_source']:
-                logger.error('Date field not found in {}'.format(h['_id']))
-                continue
-
-            delete_op = None
-            if delete_docs:
-                delete_op = {
-                    '_op_type': 'delete',
-                    '_index': h['_index'],
-                    '_type': h['_type'],
-                    '_id': h['_id']
-                }
-
-            new_index_name = target_index_name
-            if date_field:
-                date_value = dateutil.parser.parse(h['_source'][date_field])
-                new_index_name = new_index_name.format(date_value)
-            h['_index'] = new_index_name
-
-            if not use_same_id:
-                del h['_id']
-
-            if 'fields' in h:
-                h.update(h.pop('fields'))
-
-            yield h
-            if delete_op is not None:
-                yield delete_op
-
-    kwargs = {
-        'stats_only': True,
+            for action in _hit_to_actions(h, options):
+                if (ingest_settings is not None and
+                        action.get('_op_type') != 'delete'):
+                    ingest_settings.prepare(action['_index'])
+                yield action
+
+    kwargs = {}
+    if limits is not None:
+        kwargs['max_chunk_bytes'] = limits.chunk_bytes
+
+    actions = _docs_to_operations(docs)
+    group_stats = None
+    if group_buffer:
+        group_stats = pipeline.GroupStats(chunk_size=1000)
+        actions = pipeline.group_by_target(
+            actions, buffer_size=group_buffer, chunk_size=1000,
+            stats=group_stats,
+            max_bytes=limits.group_bytes if limits is not None else None)
+
+    try:
+        result = pipeline.send_actions(client, actions,
+                                       dead_letters=dead_letters,
+                                       chunk_size=1000, **kwargs)
+    except BaseException:
+        if owns_ingest:
+            ingest_settings.restore_after_error()
+        raise
+    else:
+        if owns_ingest:
+            ingest_settings.restore()
+    finally:
+        if dead_letters is not None:
+            dead_letters.close()
+        if group_stats is not None:
+            group_stats.log()
+    return result
+
+
+def plan_sources(url, source_pattern, query=None):
+    """Expand a source index pattern into the indexes to re-index, largest
+    first. Indexes without matching documents are left out.
+
+    :param url: Cluster url
+    :type url: str
+    :param source_pattern: An index name, pattern or comma separated list,
+        e.g. "event-2015-*".
+    :type source_pattern: str
+    :param query: A query to use for the source documents
+    :type query: dict
+    :returns: A list of (index name, document count, shards) tuples.
+
+    """
+    client = util.get_client(url)
+    settings = client.indices.get_settings(index=source_pattern,
+                                           name='index.number_of_shards')
+    if not settings:
+        raise error.CompanionException(
+            'No indexes match {}'.format(source_pattern))
+
+    body = dict(query or {}, size=0)
+    body['aggs'] = {
+        'sources': {
+            'terms': {'field': '_index', 'size': len(settings)}
+        }
     }
+    res = client.search(index=source_pattern, body=body)
+    plan = []
+    for bucket in res['aggregations']['sources']['buckets']:
+        index_name = bucket['key']
+        index_settings = settings[index_name]['settings']['index']
+        plan.append((index_name, bucket['doc_count'],
+                     int(index_settings['number_of_shards'])))
+    return sorted(plan, key=lambda source: (-source[1], source[0]))
+
+
+def pattern_reindex(url, source_pattern, target_index_name, query=None,
+                    max_parallel=4, max_slices=8, slices_per_index=None,
+                    max_connections=20, engine_factory=None, plan=None,
+                    precreate=False, docs_per_shard=None, max_shards=5,
+                    optimize_ingest=False, force_merge=None,
+                    wait_for_status='green', dead_letter_path=None,
+                    output=None, **kwargs):
+    """Re-index every index that matches a source pattern, e.g. to
+    consolidate daily indexes into monthly ones, with one re-index per source
+    index.
+
+    The source indexes start largest first, up to max_parallel at a time, so
+    the long re-indexes are not left for the end. Each source index is read
+    with one scroll slice per shard, up to slices_per_index, and all
+    re-indexes share a budget of max_slices slices and max_connections
+    connections per node. A source index that fails does not stop the
+    others.
+
+    :param url: Cluster url
+    :type url: str
+    :param source_pattern: The indexes to re-index, see :func:`plan_sources`.
+    :type source_pattern: str
+    :param target_index_name: The name or name template of the target index,
+        as for :func:`date_reindex`.
+    :type target_index_name: str
+    :param query: A query to use for the source documents
+    :type query: dict
+    :param max_parallel: The number of source indexes to re-index at the same
+        time.
+    :type max_parallel: int
+    :param max_slices: The number of scroll slices open at the same time.
+    :type max_slices: int
+    :param slices_per_index: The maximum number of slices of one source
+        index. Default is an even share of max_slices.
+    :type slices_per_index: int
+    :param max_connections: The maximum number of connections per node.
+    :type max_connections: int
+    :param engine_factory: A function that takes a number of slices and
+        returns a scan engine, see :func:`companion.api.scan.get_engine`.
+        Default is a sliced scroll.
+    :param plan: The source plan from :func:`plan_sources`. Computed if not
+        given.
+    :type plan: list
+    :param precreate: Create all target indexes before re-indexing, see
+        :func:`create_targets`.
+    :type precreate: bool
+    :param optimize_ingest: Apply ingest settings to the target indexes while
+        any source index writes to them, and restore them when all are done.
+    :type optimize_ingest: bool
+    :param dead_letter_path: Write failed actions of each source index to
+        this path, followed by a dot and the index name.
+    :type dead_letter_path: str
+    :param output: A file object to write a JSON line to for each finished
+        source index.
+    :param kwargs: Other arguments of :func:`date_reindex`, e.g. date_field,
+        delete_docs or transform.
+    :returns: A dict of the result dicts by source index, largest first, each
+        with a "status" of "succeeded" or "failed", the expected "docs", the
+        "slices" and "seconds" it ran, and the "success" and "failed" action
+        counts or the "error".
+
+    """
+    if plan is None:
+        plan = plan_sources(url, source_pattern, query=query)
+    if engine_factory is None:
+        def engine_factory(slices):
+            return scan.ScrollEngine(slices=slices)
+    slices_per_index = slices_per_index or max(1, max_slices // max_parallel)
+    total_docs = sum(docs for _, docs, _ in plan)
+    logger.info('Re-indexing {} source indexes with {} documents to {}'
+                .format(len(plan), total_docs, target_index_name))
+
+    slots = pipeline.Slots(max_slices)
+    lock = threading.Lock()
+    progress = {'indexes': 0, 'docs': 0}
+
+    def _reindex_source(index_name, docs, shards):
+        slices = min(shards, slices_per_index)
+        slots.acquire(slices)
+        result = {'index': index_name, 'docs': docs, 'slices': slices}
+        start = time.time()
+        try:
+            logger.info('Starting re-index of {} with {} slices'
+                        .format(index_name, slices))
+            letters = None
+            if dead_letter_path is not None:
+                letters = '{}.{}'.format(dead_letter_path, index_name)
+            success, failed = date_reindex(
+                url, index_name, target_index_name, query=query,
+                scan_engine=engine_factory(slices), dead_letter_path=letters,
+                ingest_settings=ingest_settings, **kwargs)
+            result.update(status='succeeded', success=success, failed=failed)
+        except Exception as e:
+            logger.exception('Re-index of {} failed'.format(index_name))
+            result.update(status='failed',
+                          error='{}: {}'.format(type(e).__name__, e))
+        finally:
+            slots.release(slices)
+        result['seconds'] = round(time.time() - start, 3)
+
+        with lock:
+            progress['indexes'] += 1
+            progress['docs'] += docs
+            logger.info('Finished {} of {} source indexes, {} of {} documents'
+                        .format(progress['indexes'], len(plan),
+                                progress['docs'], total_docs))
+            if output is not None:
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+        return result
+
+    util.enable_client_cache(max_connections)
+    ingest_settings = None
+    try:
+        if precreate:
+            targets = plan_targets(url, source_pattern, target_index_name,
+                                   date_field=kwargs.get('date_field'),
+                                   query=query)
+            create_targets(url, targets, docs_per_shard=docs_per_shard,
+                           max_shards=max_shards)
+        if optimize_ingest:
+            ingest_settings = ingest.IngestSettings(
+                util.get_client(url), force_merge=force_merge,
+                wait_for_status=wait_for_status)
+
+        with concurrent.futures.ThreadPoolExecutor(max_parallel) as pool:
+            futures = [pool.submit(_reindex_source, *source)
+                       for source in plan]
+            results = collections.OrderedDict()
+            for future in futures:
+                result = future.result()
+                results[result['index']] = result
+    except BaseException:
+        if ingest_settings is not None:
+            ingest_settings.restore_after_error()
+        raise
+    else:
+        if ingest_settings is not None:
+            ingest_settings.restore()
+    finally:
+        util.disable_client_cache()
 
-    return helpers.bulk(client, _docs_to_operations(docs), chunk_size=1000,
-                        **kwargs)
+    failed = [name for name, r in results.items() if r['status'] == 'failed']
+    if failed:
+        logger.warn('Re-index failed for {} source indexes: {}'
+                    .format(len(failed), ', '.join(failed)))
+    return results
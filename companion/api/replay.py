@@ -0,0 +1,56 @@
+"""Replay the failed actions of a dead letter file.
+
+Re-index, delete and update jobs write the bulk actions that failed to a
+dead letter file when they are given one, see
+:class:`companion.api.pipeline.DeadLetters`. Once the cause is fixed, for
+example a mapping conflict or a full disk, only those actions are sent
+again:
+
+    >>> reindex.date_reindex(url, 'event', 'event2',
+    >>>                      dead_letter_path='event.failed')
+    >>> replay(url, 'event.failed')
+
+"""
+import os
+import logging
+
+from . import util, pipeline
+from .. import error
+
+__all__ = ['replay']
+logger = logging.getLogger(__name__)
+
+
+def replay(url, path, dead_letter_path=None, chunk_size=1000, max_retries=3):
+    """Send the actions of a dead letter file again with bulk requests.
+
+    :param url: Cluster url
+    :type url: str
+    :param path: The dead letter file to replay.
+    :type path: str
+    :param dead_letter_path: Write the actions that fail again to this file.
+        Default is the replayed file name with ".replay" appended.
+    :type dead_letter_path: str
+    :param chunk_size: The number of actions per bulk request.
+    :type chunk_size: int
+    :param max_retries: The number of times to retry actions that the
+        cluster rejects because it is busy.
+    :type max_retries: int
+    :returns: The number of successful and failed actions.
+
+    """
+    dead_letter_path = dead_letter_path or '{}.replay'.format(path)
+    if os.path.abspath(dead_letter_path) == os.path.abspath(path):
+        raise error.CompanionException(
+            'Cannot write failures to the replayed file {}'.format(path))
+
+    logger.info('Replaying failed actions from {}'.format(path))
+    client = util.get_client(url)
+    with pipeline.DeadLetters(dead_letter_path) as dead_letters:
+        stats = pipeline.send_actions(client,
+                                      pipeline.read_dead_letters(path),
+                                      dead_letters=dead_letters,
+                                      chunk_size=chunk_size,
+                                      max_retries=max_retries)
+    logger.info('Finished replay, statistics: {}'.format(stats))
+    return stats
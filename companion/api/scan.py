@@ -0,0 +1,254 @@
+"""Scan engines read all documents matching a query. They are used by backup,
+re-index and delete, and can be swapped to trade off cluster resources:
+
+- :class:`ScrollEngine` uses the scroll API, optionally as a sliced scroll
+  read in parallel. Every slice holds a scroll context on the cluster, which
+  expires if the reader stalls for longer than the keepalive.
+- :class:`SearchAfterEngine` pages with search_after on a sort field. There
+  is no server-side context to expire. With a numeric or date sort field,
+  the key range is split into partitions that are read in parallel.
+
+Both are called like ``helpers.scan`` and return an iterator of hits:
+
+    >>> engine = get_engine('search_after', sort_field='timestamp', workers=4)
+    >>> for hit in engine(client, index='myindex', query={'query': {...}}):
+    >>>     ...
+
+"""
+import queue
+import logging
+import threading
+
+from elasticsearch import helpers
+
+from . import pipeline
+from .. import error
+
+__all__ = ['ScrollEngine', 'SearchAfterEngine', 'get_engine']
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def _merge(readers, max_buffered=10000, max_bytes=None):
+    """Run each reader in a thread and yield the hits of all of them as they
+    arrive. Errors in a reader are raised in the consumer. The readers are
+    told to stop when the consumer stops iterating.
+
+    :param readers: Functions that take a stop event and return an iterator
+        of hits.
+    :type readers: list
+    :param max_buffered: The maximum number of buffered hits.
+    :type max_buffered: int
+    :param max_bytes: The maximum serialized size of the buffered hits.
+    :type max_bytes: int
+
+    """
+    hits = queue.Queue(maxsize=max_buffered)
+    stop = threading.Event()
+    budget = pipeline.ByteBudget(max_bytes) if max_bytes else None
+
+    def _put(item, n=0):
+        if n and not budget.acquire(n, stop):
+            return False
+        while not stop.is_set():
+            try:
+                hits.put((item, n), timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(reader):
+        size = pipeline.SizeEstimator()
+        try:
+            for hit in reader(stop):
+                n = size(hit) if budget is not None else 0
+                if not _put(hit, n):
+                    return
+            _put(_DONE)
+        except Exception as e:
+            _put(e)
+
+    threads = [threading.Thread(target=_run, args=(reader,), daemon=True)
+               for reader in readers]
+    for t in threads:
+        t.start()
+
+    try:
+        running = len(threads)
+        while running:
+            item, n = hits.get()
+            if item is _DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                if n:
+                    budget.release(n)
+                yield item
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+
+
+def _with_filter(query, extra_filter):
+    """Add a filter to a search body, keeping its other keys."""
+    body = dict(query or {})
+    original = body.pop('query', {'match_all': {}})
+    body['query'] = {'bool': {'must': original, 'filter': extra_filter}}
+    return body
+
+
+class ScrollEngine:
+    """Scan with the scroll API.
+
+    :param scroll: The scroll keepalive.
+    :type scroll: str
+    :param size: The number of hits per shard per request.
+    :type size: int
+    :param slices: Read a sliced scroll with this many slices in parallel.
+    :type slices: int
+    :param max_bytes: With slices, the maximum serialized size of the hits
+        buffered between the slices and the consumer.
+    :type max_bytes: int
+
+    """
+    def __init__(self, scroll='5m', size=1000, slices=1, max_bytes=None):
+        self.scroll = scroll
+        self.size = size
+        self.slices = slices
+        self.max_bytes = max_bytes
+
+    def __call__(self, client, index=None, query=None, **kwargs):
+        kwargs.setdefault('scroll', self.scroll)
+        kwargs.setdefault('size', self.size)
+        if self.slices <= 1:
+            return helpers.scan(client, index=index, query=query, **kwargs)
+
+        def _reader(slice_id):
+            def _read(stop):
+                body = dict(query or {})
+                body['slice'] = {'id': slice_id, 'max': self.slices}
+                for hit in helpers.scan(client, index=index, query=body,
+                                        **kwargs):
+                    if stop.is_set():
+                        return
+                    yield hit
+            return _read
+
+        return _merge([_reader(i) for i in range(self.slices)],
+                      max_bytes=self.max_bytes)
+
+
+class SearchAfterEngine:
+    """Scan with search_after, sorted on a field with _uid as tie breaker.
+
+    :param sort_field: The field to sort on. Default is _uid only.
+    :type sort_field: str
+    :param size: The number of hits per request.
+    :type size: int
+    :param workers: Split the range of the sort field into this many
+        partitions and read them in parallel. Requires a numeric or date
+        sort field.
+    :type workers: int
+    :param max_bytes: With workers, the maximum serialized size of the hits
+        buffered between the partitions and the consumer.
+    :type max_bytes: int
+
+    """
+    def __init__(self, sort_field=None, size=1000, workers=1, max_bytes=None):
+        if workers > 1 and sort_field in (None, '_uid'):
+            raise error.CompanionException(
+                'Parallel search_after requires a numeric or date sort field')
+        self.sort_field = sort_field
+        self.size = size
+        self.workers = workers
+        self.max_bytes = max_bytes
+
+    def _sort(self):
+        sort = [{'_uid': 'asc'}]
+        if self.sort_field and self.sort_field != '_uid':
+            sort.insert(0, {self.sort_field: 'asc'})
+        return sort
+
+    def _pages(self, client, index, body, stop, **kwargs):
+        body = dict(body, size=self.size, sort=self._sort())
+        while not stop.is_set():
+            res = client.search(index=index, body=body, **kwargs)
+            hits = res['hits']['hits']
+            for hit in hits:
+                yield hit
+            if len(hits) < self.size:
+                return
+            body['search_after'] = hits[-1]['sort']
+
+    def _partitions(self, client, index, query, **kwargs):
+        """Split the sort field range in equally wide partitions."""
+        body = dict(query or {}, size=0)
+        body['aggs'] = {'range': {'stats': {'field': self.sort_field}}}
+        doc_type = kwargs.get('doc_type')
+        res = client.search(index=index, doc_type=doc_type, body=body)
+        stats = res['aggregations']['range']
+        if not stats['count']:
+            return []
+        low, high = stats['min'], stats['max']
+        step = (high - low) / self.workers
+        bounds = [low + step * i for i in range(self.workers)]
+        if 'min_as_string' in stats:
+            # Dates are compared as epoch milliseconds, which must be whole.
+            bounds = [int(b) for b in bounds]
+        bounds.append(None)
+        partitions = []
+        for i in range(self.workers):
+            range_filter = {'gte': bounds[i]}
+            if bounds[i + 1] is not None:
+                range_filter = {'gte': bounds[i], 'lt': bounds[i + 1]}
+            partitions.append({'range': {self.sort_field: range_filter}})
+        # Documents without the field do not belong to any range.
+        partitions.append({'bool': {'must_not': {
+            'exists': {'field': self.sort_field}}}})
+        return partitions
+
+    def __call__(self, client, index=None, query=None, **kwargs):
+        # Scroll arguments have no meaning here.
+        for key in ('scroll', 'preserve_order', 'raise_on_error'):
+            kwargs.pop(key, None)
+        never = threading.Event()
+        if self.workers <= 1:
+            return self._pages(client, index, query or {}, never, **kwargs)
+
+        def _reader(partition):
+            def _read(stop):
+                body = _with_filter(query, partition)
+                return self._pages(client, index, body, stop, **kwargs)
+            return _read
+
+        partitions = self._partitions(client, index, query, **kwargs)
+        return _merge([_reader(p) for p in partitions],
+                      max_bytes=self.max_bytes)
+
+
+def get_engine(name='scroll', sort_field=None, workers=1, size=1000,
+               scroll='5m', max_bytes=None):
+    """Create a scan engine by name.
+
+    :param name: Either "scroll" or "search_after".
+    :type name: str
+    :param sort_field: For search_after, the field to sort and partition on.
+    :type sort_field: str
+    :param workers: The number of slices or partitions to read in parallel.
+    :type workers: int
+    :param max_bytes: The maximum size of the hits buffered by the workers.
+    :type max_bytes: int
+    :returns: A scan engine.
+
+    """
+    if name == 'scroll':
+        return ScrollEngine(scroll=scroll, size=size, slices=workers,
+                            max_bytes=max_bytes)
+    if name == 'search_after':
+        return SearchAfterEngine(sort_field=sort_field, size=size,
+                                 workers=workers, max_bytes=max_bytes)
+    raise error.CompanionException('Unknown scan engine {}'.format(name))
@@ -0,0 +1,173 @@
+"""A long-running job service with a small HTTP/JSON API.
+
+The service keeps one client with a warm connection pool per cluster, and
+runs the submitted jobs on a shared :class:`companion.api.jobs.Scheduler`,
+so many short operations do not each pay for a new process and new
+connections. Jobs are JSON objects as in a jobs file, see
+:mod:`companion.api.jobs`, and get an id if they have none:
+
+    POST /jobs          Submit a job, or a list of jobs
+    GET /jobs           The states of all jobs
+    GET /jobs/<id>      The state of a job, with its result when it finished
+    DELETE /jobs/<id>   Cancel a job that has not started
+    GET /metrics        Job counts, running jobs and slot usage
+
+For Example:
+
+    >>> serve('http://localhost:9200', port=9250)
+
+    $ curl -XPOST localhost:9250/jobs -d '{"type": "health"}'
+
+"""
+import json
+import uuid
+import logging
+import resource
+import socketserver
+import http.server
+
+from . import util, jobs
+from .. import error
+
+__all__ = ['JobServer', 'serve']
+logger = logging.getLogger(__name__)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    server_version = 'companion'
+
+    def log_message(self, format, *args):
+        logger.debug('{} {}'.format(self.address_string(), format % args))
+
+    def _send(self, status, body):
+        data = json.dumps(body, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _path(self):
+        return self.path.split('?', 1)[0].rstrip('/')
+
+    def _job_id(self):
+        path = self._path()
+        if path.startswith('/jobs/'):
+            return path[len('/jobs/'):]
+        return None
+
+    def do_GET(self):
+        scheduler = self.server.scheduler
+        path = self._path()
+        job_id = self._job_id()
+        if path == '/jobs':
+            self._send(200, scheduler.states())
+        elif path == '/metrics':
+            self._send(200, self.server.metrics())
+        elif job_id is not None:
+            state = scheduler.get(job_id)
+            if state is None:
+                self._send(404, {'error': 'Unknown job {}'.format(job_id)})
+            else:
+                self._send(200, state)
+        else:
+            self._send(404, {'error': 'Unknown path {}'.format(path)})
+
+    def do_POST(self):
+        if self._path() != '/jobs':
+            self._send(404, {'error': 'Unknown path {}'.format(self._path())})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            specs = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(specs, list):
+                specs = [specs]
+            new_jobs = [jobs.Job.from_dict(_with_id(spec)) for spec in specs]
+            states = self.server.scheduler.submit(new_jobs)
+        except (ValueError, TypeError, error.CompanionException) as e:
+            self._send(400, {'error': str(e)})
+            return
+        self._send(201, states)
+
+    def do_DELETE(self):
+        job_id = self._job_id()
+        if job_id is None:
+            self._send(404, {'error': 'Unknown path {}'.format(self._path())})
+            return
+        try:
+            cancelled = self.server.scheduler.cancel(job_id)
+        except error.CompanionException as e:
+            self._send(404, {'error': str(e)})
+            return
+        state = self.server.scheduler.get(job_id)
+        self._send(200 if cancelled else 409, state)
+
+
+def _with_id(spec):
+    if not isinstance(spec, dict):
+        raise error.CompanionException('Jobs must be objects: {}'
+                                       .format(spec))
+    if 'id' not in spec and 'type' in spec:
+        spec = dict(spec, id='{}-{}'.format(spec['type'],
+                                            uuid.uuid4().hex[:12]))
+    return spec
+
+
+class JobServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """An HTTP server for the job API of a scheduler. Each request is handled
+    in its own thread.
+
+    :param address: The (host, port) to listen on.
+    :type address: tuple
+    :param scheduler: The scheduler that runs the jobs.
+    :type scheduler: companion.api.jobs.Scheduler
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address, scheduler):
+        super().__init__(address, _Handler)
+        self.scheduler = scheduler
+
+    def metrics(self):
+        """The scheduler metrics and the peak memory of the process."""
+        metrics = self.scheduler.metrics()
+        # ru_maxrss is in kilobytes on Linux.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        metrics['peak_memory_mb'] = round(peak / 1024, 1)
+        return metrics
+
+
+def serve(url, host='127.0.0.1', port=9250, limits=None, max_finished=1000,
+          output=None):
+    """Run the job service until it is interrupted. Jobs that have not
+    started are then cancelled, and running jobs are waited for.
+
+    :param url: The default cluster url of the jobs.
+    :type url: str
+    :param host: The address to listen on. Default is only local clients.
+    :type host: str
+    :param port: The port to listen on.
+    :type port: int
+    :param limits: The global limits of the jobs, see
+        :class:`companion.api.jobs.Limits`.
+    :param max_finished: The number of finished jobs to keep the results of.
+    :type max_finished: int
+    :param output: A file object to write a JSON line to for each finished
+        job.
+
+    """
+    limits = limits or jobs.Limits()
+    util.enable_client_cache(limits.max_connections)
+    scheduler = jobs.Scheduler(url, limits=limits, output=output,
+                               max_finished=max_finished)
+    server = JobServer((host, port), scheduler)
+    logger.info('Serving jobs on http://{}:{}'.format(
+        *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    finally:
+        logger.info('Stopping, waiting for running jobs')
+        server.server_close()
+        scheduler.shutdown()
+        util.disable_client_cache()
@@ -1,54 +1,107 @@
-"""Setup API."""
+"""Setup API.
+
+The same data directory can be applied to many clusters at once. It is
+parsed once and applied to all clusters in parallel:
+
+    >>> setup_clusters({'eu': 'http://eu:9200', 'us': 'http://us:9200'})
+
+"""
 import os
 import glob
 import json
+import time
 import logging
+import threading
+import functools
+import collections
+import concurrent.futures
 
 from . import util
 from .. import error
 
-__all__ = ['IndexMapper']
+__all__ = ['IndexMapper', 'SetupData', 'load_inventory', 'setup_clusters']
 logger = logging.getLogger(__name__)
 
+SetupData = collections.namedtuple(
+    'SetupData', ['indexes', 'mappings', 'templates', 'scripts'])
+
 
 class IndexMapper:
     """A simple index mapper that reads mapping definitions from JSON files and
     updates the target elasticsearch host with the mapping definitions.
 
+    :param url: The cluster url, or None to only read the data directory.
+    :type url: str
+    :param data: The parsed data directory, see :meth:`read_data`. Read from
+        data_path if not given.
+    :type data: SetupData
+    :param max_requests: The number of requests to send at the same time.
+    :type max_requests: int
+
     """
-    def __init__(self, url, data_path='./data', delete_indexes=False):
-        if not os.path.exists(data_path):
+    def __init__(self, url, data_path='./data', delete_indexes=False,
+                 data=None, max_requests=1):
+        if data is None and not os.path.exists(data_path):
             raise error.CompanionException(
                 'Data directory {} does not exist'.format(data_path))
         self.data_path = data_path
         self.delete_indexes = delete_indexes
+        self.data = data
+        self.max_requests = max_requests
+        self.changes = collections.Counter()
+        self._lock = threading.Lock()
+
+        self.es = None
+        if url is not None:
+            logger.info('Connecting to {}'.format(url))
+            self.es = util.get_client(url)
 
-        logger.info('Connecting to {}'.format(url))
-        self.es = util.get_client(url)
+    def read_data(self):
+        """Parse all definitions in the data directory."""
+        return SetupData(self.get_settings(), self.get_mappings(),
+                         self.get_templates(), self.get_scripts())
 
     def run(self):
-        indexes = self.get_settings()
-        mappings = self.get_mappings()
-        templates = self.get_templates()
-        scripts = self.get_scripts()
+        """Apply the definitions. Indexes are deleted and created before the
+        mappings are updated, and the requests of each step are sent in
+        parallel.
+
+        :returns: A dict of the number of changes by kind.
+
+        """
+        data = self.data or self.read_data()
+
+        with concurrent.futures.ThreadPoolExecutor(self.max_requests) as pool:
+            def _send_all(calls):
+                # Results are read to raise the first error.
+                list(pool.map(lambda call: call(), calls))
 
-        for index_name in indexes:
             if self.delete_indexes:
-                self.delete_index(index_name)
+                _send_all([functools.partial(self.delete_index, index_name)
+                           for index_name in data.indexes])
+
+            _send_all([functools.partial(self.create_index, index_name,
+                                         settings)
+                       for index_name, settings in data.indexes.items()])
 
-            self.create_index(index_name, indexes[index_name])
+            _send_all([functools.partial(self.update_mapping, index_name,
+                                         type_name, mapping)
+                       for index_name, types in data.mappings.items()
+                       for type_name, mapping in types.items()])
 
-        for index_name in mappings:
-            for type_name in mappings[index_name]:
-                self.update_mapping(index_name,
-                                    type_name,
-                                    mappings[index_name][type_name])
+            _send_all(
+                [functools.partial(self.update_template, template_name,
+                                   definition)
+                 for template_name, definition in data.templates.items()] +
+                [functools.partial(self.update_script, script['id'],
+                                   script['lang'], script['body'])
+                 for script in data.scripts])
 
-        for template_name in templates:
-            self.update_template(template_name, templates[template_name])
+        return dict(self.changes)
 
-        for script in scripts:
-            self.update_script(script['id'], script['lang'], script['body'])
+    def _count(self, change):
+        with self._lock:
+            self.changes[change] += 1
 
     def get_settings(self):
         """Builds a settings dict from indexes in the index folder.
@@ -163,11 +216,16 @@ class IndexMapper:
 
     def create_index(self, index_name, settings):
         logger.info('Creating index {}'.format(index_name))
-        self.es.indices.create(index=index_name, body=settings, ignore=400)
+        res = self.es.indices.create(index=index_name, body=settings,
+                                     ignore=400)
+        self._count('indexes_existing' if 'error' in res
+                    else 'indexes_created')
 
     def delete_index(self, index_name):
         logger.info('Deleting index {}'.format(index_name))
-        self.es.indices.delete(index=index_name, ignore=[400, 404])
+        res = self.es.indices.delete(index=index_name, ignore=[400, 404])
+        if 'error' not in res:
+            self._count('indexes_deleted')
 
     def update_mapping(self, index_name, type_name, mapping):
         logger.info('Updating type {} on index {}'
@@ -175,12 +233,85 @@ class IndexMapper:
         self.es.indices.put_mapping(index=index_name,
                                     doc_type=type_name,
                                     body=mapping)
+        self._count('mappings')
 
     def update_template(self, template_name, template_definition):
         logger.info('Updating template definition {}'.format(template_name))
         self.es.indices.put_template(name=template_name,
                                      body=template_definition)
+        self._count('templates')
 
     def update_script(self, id, lang, body):
         logger.info('Updating script {}'.format(id))
         self.es.put_script(id=id, lang=lang, body=body)
+        self._count('scripts')
+
+
+def load_inventory(path):
+    """Read a cluster inventory file with a url, or a name and a url, per
+    line. Empty lines and lines starting with # are skipped.
+
+    :returns: An ordered dict of urls by cluster name. Clusters without a
+        name are named by their url.
+
+    """
+    clusters = collections.OrderedDict()
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) > 2:
+                raise error.CompanionException(
+                    'Invalid inventory line: {}'.format(line.strip()))
+            clusters[fields[0]] = fields[-1]
+    return clusters
+
+
+def setup_clusters(clusters, data_path='./data', delete_indexes=False,
+                   max_clusters=8, max_requests=4):
+    """Apply a data directory to many clusters in parallel. The directory is
+    parsed once. A failure on one cluster does not stop the others.
+
+    :param clusters: A dict of urls by cluster name, or a list of urls.
+    :param data_path: The data directory.
+    :type data_path: str
+    :param delete_indexes: Delete the indexes before creating them.
+    :type delete_indexes: bool
+    :param max_clusters: The number of clusters to set up at the same time.
+    :type max_clusters: int
+    :param max_requests: The number of requests to send to each cluster at
+        the same time.
+    :type max_requests: int
+    :returns: A dict of result dicts by cluster name, each with the "url",
+        a "status" of "succeeded" or "failed", the "seconds" it took, and the
+        "changes" by kind or the "error".
+
+    """
+    if not isinstance(clusters, dict):
+        clusters = collections.OrderedDict((url, url) for url in clusters)
+    data = IndexMapper(None, data_path=data_path).read_data()
+
+    def _setup(name, url):
+        result = {'url': url}
+        start = time.time()
+        try:
+            mapper = IndexMapper(url, data_path=data_path,
+                                 delete_indexes=delete_indexes, data=data,
+                                 max_requests=max_requests)
+            result['changes'] = mapper.run()
+            result['status'] = 'succeeded'
+        except Exception as e:
+            logger.exception('Setup of cluster {} failed'.format(name))
+            result['status'] = 'failed'
+            result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['seconds'] = round(time.time() - start, 3)
+        return result
+
+    workers = max(1, min(max_clusters, len(clusters)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        futures = collections.OrderedDict(
+            (name, pool.submit(_setup, name, url))
+            for name, url in clusters.items())
+        return collections.OrderedDict(
+            (name, future.result()) for name, future in futures.items())
@@ -0,0 +1,249 @@
+"""Backup indexes with Elasticsearch snapshots and restore them again.
+
+Unlike :mod:`companion.api.backup`, the documents do not pass through
+Python. The nodes copy their segment files to a snapshot repository, and
+snapshots are incremental: files that an earlier snapshot in the same
+repository already stored are not copied again.
+
+A repository of type "fs" writes to a shared filesystem path, which must be
+listed in the ``path.repo`` setting of every node:
+
+    >>> ensure_repository(url, 'backups', location='/mnt/backups')
+    >>> name = snapshot(url, 'backups', 'event-*')
+    >>> restore(url, 'backups', name, rename_pattern='event-(.+)',
+    >>>         rename_replacement='restored-event-$1')
+
+"""
+import re
+import time
+import fnmatch
+import logging
+import datetime
+
+from . import util, health
+from .. import error
+
+__all__ = ['ensure_repository', 'snapshot', 'restore']
+logger = logging.getLogger(__name__)
+
+# Snapshot states, see the snapshot status API.
+RUNNING_STATES = ('INIT', 'STARTED', 'WAITING', 'IN_PROGRESS')
+
+
+def ensure_repository(url, repository, location=None, repo_type='fs',
+                      settings=None):
+    """Register a snapshot repository, or reuse it if it exists with the
+    same type and location.
+
+    :param url: Cluster url
+    :type url: str
+    :param repository: The name of the repository.
+    :type repository: str
+    :param location: For "fs" repositories, the path to store the snapshots
+        in. Without a location, the repository must exist already.
+    :type location: str
+    :param repo_type: The repository type, e.g. "fs" or "s3".
+    :type repo_type: str
+    :param settings: Other settings of the repository.
+    :type settings: dict
+    :returns: The settings of the repository.
+
+    """
+    client = util.get_client(url)
+    res = client.snapshot.get_repository(repository=repository,
+                                         ignore=[404])
+    existing = res.get(repository)
+    settings = dict(settings or {})
+    if location is not None:
+        settings['location'] = location
+
+    if existing is not None:
+        if existing['type'] != repo_type or (
+                location is not None and
+                existing['settings'].get('location') != location):
+            raise error.CompanionException(
+                'Repository {} exists with other settings: {}'
+                .format(repository, existing))
+        logger.info('Using snapshot repository {}'.format(repository))
+        return existing['settings']
+
+    if not settings:
+        raise error.CompanionException(
+            'Repository {} does not exist, give a location to create it'
+            .format(repository))
+    logger.info('Creating {} snapshot repository {}'.format(repo_type,
+                                                            repository))
+    client.snapshot.create_repository(
+        repository=repository, body={'type': repo_type, 'settings': settings},
+        params={'verify': 'true'})
+    return settings
+
+
+def _snapshot_progress(client, repository, name):
+    """The state and shard statistics of a snapshot."""
+    res = client.snapshot.status(repository=repository, snapshot=name)
+    status = res['snapshots'][0]
+    return status['state'], status.get('shards_stats', {})
+
+
+def snapshot(url, repository, index_name, name=None,
+             include_global_state=False, poll_interval=5):
+    """Take a snapshot of indexes and wait for it to finish. The snapshot is
+    deleted, which aborts it, when waiting is interrupted.
+
+    :param url: Cluster url
+    :type url: str
+    :param repository: The name of a registered repository, see
+        :func:`ensure_repository`.
+    :type repository: str
+    :param index_name: The name or pattern of the indexes, or a comma
+        separated list of them.
+    :type index_name: str
+    :param name: The snapshot name. Defaults to the index pattern and the
+        current time.
+    :type name: str
+    :param include_global_state: Also store templates and cluster settings.
+    :type include_global_state: bool
+    :param poll_interval: Seconds between progress polls.
+    :type poll_interval: float
+    :returns: The name of the snapshot.
+
+    """
+    if name is None:
+        prefix = re.sub(r'[^a-z0-9_-]+', '_', index_name.lower()).strip('_')
+        name = '{}-{:%Y%m%d%H%M%S}'.format(prefix or 'snapshot',
+                                           datetime.datetime.utcnow())
+    client = util.get_client(url)
+    body = {
+        'indices': index_name,
+        'ignore_unavailable': True,
+        'include_global_state': include_global_state
+    }
+    client.snapshot.create(repository=repository, snapshot=name, body=body,
+                           params={'wait_for_completion': 'false'})
+    logger.info('Started snapshot {} of {}'.format(name, index_name))
+
+    try:
+        while True:
+            state, shards = _snapshot_progress(client, repository, name)
+            logger.info('Snapshot {} is {}, {} of {} shards done'.format(
+                name, state, shards.get('done', 0), shards.get('total', 0)))
+            if state not in RUNNING_STATES:
+                break
+            time.sleep(poll_interval)
+    except BaseException:
+        logger.warn('Aborting snapshot {}'.format(name))
+        client.snapshot.delete(repository=repository, snapshot=name,
+                               ignore=[404])
+        raise
+
+    info = client.snapshot.get(repository=repository,
+                               snapshot=name)['snapshots'][0]
+    if info['state'] != 'SUCCESS':
+        raise error.CompanionException(
+            'Snapshot {} finished as {}: {}'.format(name, info['state'],
+                                                    info.get('failures')))
+    logger.info('Finished snapshot {} of {} indexes'.format(
+        name, len(info['indices'])))
+    return name
+
+
+def _restored_names(indices, index_name, rename_pattern, rename_replacement):
+    """The names that the indexes of a snapshot are restored to."""
+    if index_name:
+        patterns = [p.strip() for p in index_name.split(',')]
+        indices = [i for i in indices
+                   if any(fnmatch.fnmatch(i, p) for p in patterns)]
+    if rename_pattern:
+        # Elasticsearch uses Java regular expressions, with $1 for groups.
+        replacement = re.sub(r'\$(\d+)', r'\\\1', rename_replacement or '')
+        indices = [re.sub(rename_pattern, replacement, i) for i in indices]
+    return sorted(indices)
+
+
+def _failed_primaries(client, index):
+    """The primary shards that could not be allocated, as "index[shard]"."""
+    shards = client.cat.shards(index=index, format='json',
+                               h='index,shard,prirep,state,unassigned.reason')
+    return ['{}[{}]'.format(s['index'], s['shard']) for s in shards
+            if s['prirep'] == 'p' and s['state'] == 'UNASSIGNED' and
+            s.get('unassigned.reason') == 'ALLOCATION_FAILED']
+
+
+def restore(url, repository, name, index_name=None, rename_pattern=None,
+            rename_replacement=None, index_settings=None, poll_interval=5,
+            max_wait=None):
+    """Restore indexes from a snapshot and wait until all their primary
+    shards are recovered. The nodes restore the shards in parallel. Raises a
+    CompanionException when a primary shard fails to restore.
+
+    :param url: Cluster url
+    :type url: str
+    :param repository: The name of the repository.
+    :type repository: str
+    :param name: The name of the snapshot.
+    :type name: str
+    :param index_name: The name or pattern of the indexes to restore.
+        Default is all indexes of the snapshot.
+    :type index_name: str
+    :param rename_pattern: A regular expression for index names to rename.
+    :type rename_pattern: str
+    :param rename_replacement: The new names, with $1 for the groups of the
+        rename pattern, e.g. "restored-$1".
+    :type rename_replacement: str
+    :param index_settings: Settings to override in the restored indexes. For
+        example, {"index.number_of_replicas": 0} restores faster and the
+        replicas can be added afterwards.
+    :type index_settings: dict
+    :param poll_interval: Seconds between progress polls.
+    :type poll_interval: float
+    :param max_wait: Raise a CompanionException if the primary shards are
+        not restored after this many seconds. Default is to wait forever.
+    :type max_wait: float
+    :returns: The names of the restored indexes.
+
+    """
+    client = util.get_client(url)
+    info = client.snapshot.get(repository=repository,
+                               snapshot=name)['snapshots'][0]
+    names = _restored_names(info['indices'], index_name, rename_pattern,
+                            rename_replacement)
+    if not names:
+        raise error.CompanionException(
+            'Snapshot {} has no indexes matching {}'.format(name, index_name))
+
+    body = {'include_global_state': False}
+    if index_name:
+        body['indices'] = index_name
+    if rename_pattern:
+        body['rename_pattern'] = rename_pattern
+        body['rename_replacement'] = rename_replacement
+    if index_settings:
+        body['index_settings'] = index_settings
+    client.snapshot.restore(repository=repository, snapshot=name, body=body,
+                            params={'wait_for_completion': 'false'})
+    logger.info('Restoring {} from snapshot {}'.format(', '.join(names),
+                                                       name))
+
+    index = ','.join(names)
+    start = time.time()
+    while not health.wait_for_status(url, 'yellow', timeout=poll_interval,
+                                     max_wait=poll_interval, index=index):
+        failed = _failed_primaries(client, index)
+        if failed:
+            raise error.CompanionException(
+                'Could not restore shards {}'.format(', '.join(failed)))
+        if max_wait is not None and time.time() - start > max_wait:
+            raise error.CompanionException(
+                'Restore of {} did not finish in {}s'.format(index, max_wait))
+        res = client.indices.recovery(index=index, active_only=True)
+        total = recovered = 0
+        for shards in res.values():
+            for shard in shards['shards']:
+                total += shard['index']['size']['total_in_bytes']
+                recovered += shard['index']['size']['recovered_in_bytes']
+        logger.info('Restored {:.1f} of {:.1f} MB in active recoveries'
+                    .format(recovered / 1024 / 1024, total / 1024 / 1024))
+    logger.info('Restored {} indexes from snapshot {}'.format(len(names),
+                                                              name))
+    return names
@@ -0,0 +1,505 @@
+"""Storage backends for backups. A storage backend is a flat key/value object
+store, either a directory on a local filesystem (which includes NFS and other
+mounted volumes) or an S3 compatible bucket.
+
+Backends are usually created from a target string with :func:`get_storage`:
+
+    >>> get_storage('/mnt/backups')
+    >>> get_storage('s3://mybucket/some/prefix', region='eu-west-1')
+
+"""
+import io
+import os
+import time
+import shutil
+import logging
+import tempfile
+import concurrent.futures
+
+import boto3
+import boto3.exceptions
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
+
+from .. import error
+
+__all__ = ['Storage', 'LocalStorage', 'S3Storage', 'get_storage']
+logger = logging.getLogger(__name__)
+
+# Size of the write buffer for local files and the read size when copying.
+BUFFER_SIZE = 8 * 1024 * 1024
+
+# S3 requires parts of at least 5 MB, except for the last one.
+PART_SIZE = 8 * 1024 * 1024
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+
+def _retry(func, max_retries, description):
+    """Call func, retrying with exponential backoff on connection errors and
+    server side S3 errors. Client errors such as a missing key are raised
+    right away.
+
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func()
+        except (botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError,
+                boto3.exceptions.S3UploadFailedError) as e:
+            # The transfer manager wraps client errors of uploads.
+            cause = e
+            if isinstance(e, boto3.exceptions.S3UploadFailedError):
+                cause = e.__cause__ or e.__context__
+            if isinstance(cause, botocore.exceptions.ClientError):
+                status = cause.response.get('ResponseMetadata', {}) \
+                                       .get('HTTPStatusCode', 500)
+                if status < 500:
+                    raise
+            if attempt == max_retries:
+                raise
+            delay = min(2 ** attempt, 30)
+            logger.warn('{} failed: {}. Retrying in {}s'
+                        .format(description, e, delay))
+            time.sleep(delay)
+
+
+def _copy_file(source_path, target_path):
+    """Copy a file using sendfile when the platform supports it, falling back
+    to large buffered reads and writes.
+
+    """
+    with open(source_path, 'rb') as src, open(target_path, 'wb') as dst:
+        if hasattr(os, 'sendfile'):
+            size = os.fstat(src.fileno()).st_size
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), offset,
+                                       size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                return
+            except OSError:
+                # E.g. file systems that do not support sendfile. Start over.
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        shutil.copyfileobj(src, dst, BUFFER_SIZE)
+
+
+class Storage:
+    """The interface of a storage backend. Keys are strings with forward
+    slashes as separators.
+
+    Subclasses implement put, get, exists, list, delete, open_write and
+    open_read. Copying whole files is built on top of the streaming methods,
+    but subclasses can override upload_file and download_file with something
+    faster.
+
+    """
+    def put(self, key, data):
+        """Store the bytes in data under the given key."""
+        raise NotImplementedError
+
+    def get(self, key):
+        """Return the bytes stored under the given key."""
+        raise NotImplementedError
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def list(self, prefix=''):
+        """Return all keys starting with prefix, in sorted order."""
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def open_write(self, key):
+        """Return a writable binary file object for the given key. The object
+        is stored when the file is closed, and discarded if the file is used
+        as a context manager and an exception occurs.
+
+        """
+        raise NotImplementedError
+
+    def open_read(self, key):
+        """Return a readable binary file object for the given key."""
+        raise NotImplementedError
+
+    def upload_file(self, key, path):
+        """Store the contents of a local file under the given key.
+
+        :returns: The number of bytes stored.
+
+        """
+        with open(path, 'rb') as src, self.open_write(key) as dst:
+            shutil.copyfileobj(src, dst, BUFFER_SIZE)
+        return os.path.getsize(path)
+
+    def download_file(self, key, path):
+        """Write the object stored under the given key to a local file.
+
+        :returns: The number of bytes written.
+
+        """
+        with self.open_read(key) as src, open(path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, BUFFER_SIZE)
+        return os.path.getsize(path)
+
+
+class _LocalWriter(io.BufferedWriter):
+    """A buffered file that is written to a temporary path and moved into
+    place when closed.
+
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        super().__init__(io.FileIO(fd, 'wb'), buffer_size=BUFFER_SIZE)
+        self.path = path
+        self.failed = False
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.failed = exc_type is not None
+        return super().__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if self.failed:
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+
+
+class LocalStorage(Storage):
+    """Stores objects as files below a root directory. Keys map to sub
+    directories.
+
+    """
+    def __init__(self, root_path):
+        self.root_path = os.path.abspath(root_path)
+        if not os.path.exists(self.root_path):
+            os.makedirs(self.root_path)
+
+    def __repr__(self):
+        return 'LocalStorage({!r})'.format(self.root_path)
+
+    def _path(self, key, create_dirs=False):
+        path = os.path.join(self.root_path, *key.split('/'))
+        if create_dirs:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def put(self, key, data):
+        """Store the bytes in data under the given key. The object is written
+        to a temporary file first, so readers never see a partial object.
+
+        """
+        with self.open_write(key) as f:
+            f.write(data)
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def list(self, prefix=''):
+        """Return all keys starting with prefix, in sorted order."""
+        keys = []
+        for dirpath, _, filenames in os.walk(self.root_path):
+            for filename in filenames:
+                if filename.startswith('.tmp-'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.root_path).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def delete(self, key):
+        os.remove(self._path(key))
+
+    def open_write(self, key):
+        return _LocalWriter(self._path(key, create_dirs=True))
+
+    def open_read(self, key):
+        return open(self._path(key), 'rb', buffering=BUFFER_SIZE)
+
+    def upload_file(self, key, path):
+        target_path = self._path(key, create_dirs=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target_path),
+                                        prefix='.tmp-')
+        os.close(fd)
+        try:
+            _copy_file(path, tmp_path)
+            os.replace(tmp_path, target_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return os.path.getsize(target_path)
+
+    def download_file(self, key, path):
+        _copy_file(self._path(key), path)
+        return os.path.getsize(path)
+
+
+class _S3MultipartWriter(io.RawIOBase):
+    """A writable file that uploads to S3 in parts. Parts are uploaded in
+    parallel while the caller keeps writing, with at most max_workers parts
+    in flight. Small objects are stored with a single put.
+
+    """
+    def __init__(self, storage, key, part_size=PART_SIZE, max_workers=10):
+        super().__init__()
+        self.storage = storage
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.futures = []
+        self.executor = None
+        self.failed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def _upload_part(self, data):
+        client = self.storage.client
+        if self.upload_id is None:
+            response = client.create_multipart_upload(
+                Bucket=self.storage.bucket_name, Key=self.key)
+            self.upload_id = response['UploadId']
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers)
+
+        # Limit the number of buffered parts to the number of workers.
+        in_flight = [f for f in self.futures if not f.done()]
+        if len(in_flight) >= self.max_workers:
+            concurrent.futures.wait(in_flight,
+                                    return_when=concurrent.futures.FIRST_COMPLETED)
+
+        part_number = len(self.futures) + 1
+
+        def _upload():
+            return client.upload_part(Bucket=self.storage.bucket_name,
+                                      Key=self.key, UploadId=self.upload_id,
+                                      PartNumber=part_number, Body=data)
+
+        self.futures.append(self.executor.submit(
+            _retry, _upload, self.storage.max_retries,
+            'Upload of part {} of {}'.format(part_number, self.key)))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.failed = exc_type is not None
+        return super().__exit__(exc_type, exc_value, traceback)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.failed:
+                self._abort()
+            elif self.upload_id is None:
+                self.storage.client.put_object(Bucket=self.storage.bucket_name,
+                                               Key=self.key,
+                                               Body=bytes(self.buffer))
+            else:
+                self._complete()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            super().close()
+
+    def _complete(self):
+        if self.buffer:
+            self._upload_part(bytes(self.buffer))
+        try:
+            parts = [{'ETag': f.result()['ETag'], 'PartNumber': i + 1}
+                     for i, f in enumerate(self.futures)]
+        except BaseException:
+            self._abort()
+            raise
+        self.storage.client.complete_multipart_upload(
+            Bucket=self.storage.bucket_name, Key=self.key,
+            UploadId=self.upload_id, MultipartUpload={'Parts': parts})
+
+    def _abort(self):
+        if self.upload_id is None:
+            return
+        for f in self.futures:
+            f.cancel()
+        self.storage.client.abort_multipart_upload(
+            Bucket=self.storage.bucket_name, Key=self.key,
+            UploadId=self.upload_id)
+
+
+class S3Storage(Storage):
+    """Stores objects in an S3 compatible bucket, optionally below a key
+    prefix. Set endpoint_url to use another S3 compatible service.
+
+    Files larger than multipart_threshold bytes are transferred in parts of
+    part_size bytes, with up to max_concurrency parts in flight: uploads go
+    through the boto3 transfer manager and downloads are parallel byte range
+    GETs. Streaming writes are multipart uploads with the same settings.
+    Failed requests are retried up to max_retries times.
+
+    """
+    def __init__(self, bucket_name, prefix='', region=None, user_key=None,
+                 secret_key=None, endpoint_url=None,
+                 multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE,
+                 max_concurrency=10, max_retries=3):
+        self.bucket_name = bucket_name
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=part_size,
+            max_concurrency=max_concurrency)
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client('s3',
+                                   region_name=region,
+                                   aws_access_key_id=user_key,
+                                   aws_secret_access_key=secret_key,
+                                   endpoint_url=endpoint_url)
+
+    def __repr__(self):
+        return 'S3Storage({!r}, {!r})'.format(self.bucket_name, self.prefix)
+
+    def _key(self, key):
+        if self.prefix:
+            return '{}/{}'.format(self.prefix, key)
+        return key
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket_name, Key=self._key(key),
+                               Body=data)
+
+    def get(self, key):
+        response = self.client.get_object(Bucket=self.bucket_name,
+                                          Key=self._key(key))
+        return response['Body'].read()
+
+    def exists(self, key):
+        response = self.client.list_objects_v2(Bucket=self.bucket_name,
+                                               Prefix=self._key(key),
+                                               MaxKeys=1)
+        return any(o['Key'] == self._key(key)
+                   for o in response.get('Contents', []))
+
+    def list(self, prefix=''):
+        """Return all keys starting with prefix, in sorted order."""
+        keys = []
+        strip = len(self._key(''))
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name,
+                                       Prefix=self._key(prefix)):
+            for obj in page.get('Contents', []):
+                keys.append(obj['Key'][strip:])
+        return sorted(keys)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket_name, Key=self._key(key))
+
+    def open_write(self, key):
+        return _S3MultipartWriter(self, self._key(key),
+                                  part_size=self.part_size,
+                                  max_workers=self.max_concurrency)
+
+    def open_read(self, key):
+        response = self.client.get_object(Bucket=self.bucket_name,
+                                          Key=self._key(key))
+        return response['Body']
+
+    def upload_file(self, key, path):
+        _retry(lambda: self.client.upload_file(path, self.bucket_name,
+                                               self._key(key),
+                                               Config=self.transfer_config),
+               self.max_retries, 'Upload of {}'.format(key))
+        return os.path.getsize(path)
+
+    def _download_range(self, key, path, start, end):
+        def _download():
+            response = self.client.get_object(
+                Bucket=self.bucket_name, Key=self._key(key),
+                Range='bytes={}-{}'.format(start, end))
+            with open(path, 'r+b') as f:
+                f.seek(start)
+                shutil.copyfileobj(response['Body'], f, BUFFER_SIZE)
+
+        _retry(_download, self.max_retries,
+               'Download of bytes {}-{} of {}'.format(start, end, key))
+
+    def download_file(self, key, path):
+        """Download an object to a local file. Objects larger than the
+        multipart threshold are downloaded as parallel byte range GETs.
+
+        """
+        head = _retry(lambda: self.client.head_object(Bucket=self.bucket_name,
+                                                      Key=self._key(key)),
+                      self.max_retries, 'Head of {}'.format(key))
+        size = head['ContentLength']
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        if size <= self.multipart_threshold:
+            if size > 0:
+                self._download_range(key, path, 0, size - 1)
+            return size
+
+        ranges = [(start, min(start + self.part_size, size) - 1)
+                  for start in range(0, size, self.part_size)]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_concurrency) as executor:
+            futures = [executor.submit(self._download_range, key, path,
+                                       start, end)
+                       for start, end in ranges]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        return size
+
+
+def get_storage(target, region=None, user_key=None, secret_key=None,
+                endpoint_url=None, **s3_kwargs):
+    """Create a storage target from a target string.
+
+    :param target: Either "s3://bucket/optional/prefix" or a local directory.
+    :type target: str
+    :param region: The S3 region that the bucket is located in.
+    :type region: str
+    :param user_key: S3 username/access key
+    :type user_key: str
+    :param secret_key: S3 password/secret key
+    :type secret_key: str
+    :param endpoint_url: Endpoint for S3 compatible services.
+    :type endpoint_url: str
+    :param s3_kwargs: Transfer settings for S3, see :class:`S3Storage`.
+    :returns: A LocalStorage or S3Storage instance.
+
+    """
+    if target.startswith('s3://'):
+        bucket_name, _, prefix = target[len('s3://'):].partition('/')
+        if not bucket_name:
+            raise error.CompanionException(
+                'No bucket name in target {}'.format(target))
+        return S3Storage(bucket_name, prefix, region=region,
+                         user_key=user_key, secret_key=secret_key,
+                         endpoint_url=endpoint_url, **s3_kwargs)
+    if target.startswith('file://'):
+        target = target[len('file://'):]
+    return LocalStorage(target)
@@ -0,0 +1,220 @@
+"""Export indexes as NDJSON and import them again, to and from files or
+stdout and stdin.
+
+Each line is a JSON hit with the _index, _type, _id, _routing, _parent and
+_source fields, so exports can be filtered with tools like ``jq`` before they
+are imported:
+
+    >>> export(url, 'event', 'event.ndjson.gz')
+    >>> import_files(url, ['event.ndjson.gz'], index_name='event2')
+
+Memory use does not grow with the size of the index. Hits are written in
+pages of large writes, and imports are read line by line into bulk
+requests. Files ending with ".gz" are compressed, and compressed input is
+detected by its content, so it can also be piped into stdin.
+
+"""
+import os
+import sys
+import gzip
+import json
+import logging
+import contextlib
+import concurrent.futures
+
+from elasticsearch import helpers
+
+from . import util, scan, pipeline, record
+from .copy import _bulk_body
+from .. import error
+
+__all__ = ['open_output', 'open_input', 'part_paths', 'export',
+           'import_files']
+logger = logging.getLogger(__name__)
+
+# Read and write buffer size of files.
+BUFFER_SIZE = 1024 * 1024
+
+# Hits per write.
+PAGE_SIZE = 1000
+
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+@contextlib.contextmanager
+def open_output(path, compress=None):
+    """Open a file or "-" for stdout to write NDJSON bytes to.
+
+    :param compress: Compress with gzip. Default is to compress files ending
+        with ".gz".
+    :type compress: bool
+
+    """
+    if compress is None:
+        compress = path.endswith('.gz')
+    if path == '-':
+        f = sys.stdout.buffer
+    else:
+        f = open(path, 'wb', buffering=BUFFER_SIZE)
+    try:
+        if compress:
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as gz:
+                yield gz
+        else:
+            yield f
+    finally:
+        if f is sys.stdout.buffer:
+            f.flush()
+        else:
+            f.close()
+
+
+@contextlib.contextmanager
+def open_input(path):
+    """Open a file or "-" for stdin to read NDJSON lines from, decompressing
+    gzip input.
+
+    """
+    if path == '-':
+        f = sys.stdin.buffer
+    else:
+        f = open(path, 'rb', buffering=BUFFER_SIZE)
+    try:
+        if f.peek(2)[:2] == _GZIP_MAGIC:
+            with gzip.GzipFile(fileobj=f, mode='rb') as gz:
+                yield gz
+        else:
+            yield f
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+def part_paths(path, parts):
+    """The paths of the part files of an export, e.g. "event.part0.ndjson"
+    for "event.ndjson".
+
+    """
+    if parts <= 1:
+        return [path]
+    head, tail = os.path.split(path)
+    name, dot, extension = tail.partition('.')
+    return [os.path.join(head, '{}.part{}{}{}'.format(name, i, dot,
+                                                       extension))
+            for i in range(parts)]
+
+
+def _hit_line(hit):
+    doc = record.Doc.from_hit(hit).to_hit()
+    return json.dumps(doc).encode('utf-8') + b'\n'
+
+
+def _write_hits(hits, f):
+    count = 0
+    for page in pipeline.batched(hits, PAGE_SIZE):
+        f.write(b''.join(_hit_line(hit) for hit in page))
+        count += len(page)
+    return count
+
+
+def export(url, index_name, output='-', query=None, doc_type=None, parts=1,
+           compress=None, scan_engine=None, size=1000, scroll='5m'):
+    """Export the documents of an index as NDJSON.
+
+    :param url: Cluster url
+    :type url: str
+    :param index_name: The name or pattern of the indexes to export.
+    :type index_name: str
+    :param output: The file to write to, or "-" for stdout.
+    :type output: str
+    :param query: A query for the documents to export.
+    :type query: dict
+    :param doc_type: The document type to export.
+    :type doc_type: str
+    :param parts: Read a sliced scroll with this many slices in parallel,
+        each written to its own part file, see :func:`part_paths`.
+    :type parts: int
+    :param compress: Compress with gzip. Default is to compress files ending
+        with ".gz".
+    :type compress: bool
+    :param scan_engine: The engine that reads the documents of a single
+        output, see :mod:`companion.api.scan`. Default is a scroll.
+    :param size: For part files, the number of hits per shard per scroll
+        page.
+    :type size: int
+    :param scroll: For part files, the scroll keepalive.
+    :type scroll: str
+    :returns: The number of exported documents.
+
+    """
+    if parts > 1 and output == '-':
+        raise error.CompanionException(
+            'Part files need an output file name, not stdout')
+    client = util.get_client(url)
+    logger.info('Exporting {} to {}'.format(index_name, output))
+
+    if parts <= 1:
+        scan_engine = scan_engine or scan.ScrollEngine()
+        hits = scan_engine(client, index=index_name, doc_type=doc_type,
+                           query=query)
+        with open_output(output, compress) as f:
+            count = _write_hits(hits, f)
+        logger.info('Exported {} documents'.format(count))
+        return count
+
+    def _export_part(slice_id, path):
+        body = dict(query or {})
+        body['slice'] = {'id': slice_id, 'max': parts}
+        hits = helpers.scan(client, index=index_name, doc_type=doc_type,
+                            query=body, size=size, scroll=scroll)
+        with open_output(path, compress) as f:
+            return _write_hits(hits, f)
+
+    paths = part_paths(output, parts)
+    with concurrent.futures.ThreadPoolExecutor(parts) as pool:
+        counts = list(pool.map(_export_part, range(parts), paths))
+    logger.info('Exported {} documents to {} part files'.format(sum(counts),
+                                                                parts))
+    return sum(counts)
+
+
+def import_files(url, paths, index_name=None, chunk_size=1000,
+                 bulk_threads=2):
+    """Import NDJSON files, read in parallel, with bulk requests.
+
+    :param url: Cluster url
+    :type url: str
+    :param paths: The files to read, or "-" for stdin.
+    :type paths: list
+    :param index_name: The index to import to. Defaults to the index that
+        each document was exported from.
+    :type index_name: str
+    :param chunk_size: The number of documents per bulk request.
+    :type chunk_size: int
+    :param bulk_threads: The number of bulk requests to send in parallel.
+    :type bulk_threads: int
+    :returns: The number of imported documents.
+
+    """
+    client = util.get_client(url)
+    logger.info('Importing {} files'.format(len(paths)))
+
+    def _reader(path):
+        def _read(stop):
+            with open_input(path) as f:
+                lines = (line for line in f if line.strip())
+                for page in pipeline.batched(lines, chunk_size):
+                    if stop.is_set():
+                        return
+                    hits = []
+                    for line in page:
+                        hit = json.loads(line.decode('utf-8'))
+                        hits.append((hit, json.dumps(hit['_source'])))
+                    yield _bulk_body(hits, index_name)
+        return _read
+
+    bodies = scan._merge([_reader(path) for path in paths],
+                         max_buffered=2 * max(len(paths), bulk_threads))
+    imported = pipeline.send_bulk(client, bodies, threads=bulk_threads)
+    logger.info('Imported {} documents'.format(imported))
+    return imported
@@ -0,0 +1,301 @@
+"""Throttle jobs that run against a live cluster.
+
+A :class:`Throttle` limits the documents and bytes per second that are read
+with token buckets. Since the re-index, delete and backup pipelines pull
+their documents from the scan, throttling the scan also throttles the bulk
+requests. Wrap a scan engine to throttle a job:
+
+    >>> throttle = Throttle(docs_per_sec=1000, client=client, adaptive=True)
+    >>> engine = ThrottledEngine(scan.ScrollEngine(), throttle)
+    >>> reindex.date_reindex(url, 'event', 'event2', scan_engine=engine)
+
+The limits can be changed while a job runs with a control file, a JSON
+object such as ``{"docs_per_sec": 500, "bytes_per_sec": null}`` that is
+read again when it changes. With adaptive throttling, the thread pools of
+the cluster are polled and the rate is halved while there are rejections or
+long queues, and slowly increased again when the cluster has recovered.
+
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+from . import pipeline
+from .. import error
+
+__all__ = ['TokenBucket', 'Throttle', 'ThrottledEngine']
+logger = logging.getLogger(__name__)
+
+# Thread pools that show pressure from companion jobs or hurt users.
+THREAD_POOLS = ['search', 'bulk', 'index']
+
+
+class TokenBucket:
+    """Allows up to rate tokens per second, with bursts of up to burst
+    tokens. A rate of None is unlimited.
+
+    :param rate: Tokens per second.
+    :type rate: float
+    :param burst: The bucket size. Default is one second of tokens.
+    :type burst: float
+
+    """
+    def __init__(self, rate=None, burst=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self.burst = burst
+        self.rate = None
+        self.tokens = 0
+        self.last = clock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            was_unlimited = self.rate is None
+            self.rate = rate or None
+            if was_unlimited:
+                self.tokens = self._capacity()
+            self.tokens = min(self.tokens, self._capacity())
+
+    def _capacity(self):
+        if self.rate is None:
+            return 0
+        return self.burst or self.rate
+
+    def take(self, n=1):
+        """Take n tokens, and block until they are available. A request for
+        more tokens than the bucket holds waits until the bucket is full and
+        leaves it in debt.
+
+        """
+        while True:
+            with self._lock:
+                if self.rate is None:
+                    return
+                now = self.clock()
+                self.tokens = min(self._capacity(),
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                wanted = min(n, self._capacity())
+                # Allow for rounding errors in the refill.
+                if self.tokens >= wanted - 1e-9:
+                    self.tokens -= n
+                    return
+                wait = (wanted - self.tokens) / self.rate
+            self.sleep(min(wait, 1))
+
+
+class Throttle:
+    """Limits documents and bytes per second, optionally adapting to the
+    thread pool pressure of the cluster.
+
+    :param docs_per_sec: The maximum documents per second.
+    :type docs_per_sec: float
+    :param bytes_per_sec: The maximum serialized bytes per second.
+    :type bytes_per_sec: float
+    :param client: An Elasticsearch client, required with adaptive.
+    :param adaptive: Back off when the cluster has thread pool rejections or
+        queues longer than max_queue.
+    :type adaptive: bool
+    :param control_file: A JSON file with docs_per_sec and bytes_per_sec to
+        read again when it changes.
+    :type control_file: str
+    :param poll_interval: Seconds between cluster polls and control file
+        checks.
+    :type poll_interval: float
+    :param max_queue: The thread pool queue length that counts as pressure.
+    :type max_queue: int
+
+    """
+    # The lowest rate to back off to.
+    MIN_DOCS_PER_SEC = 1
+
+    def __init__(self, docs_per_sec=None, bytes_per_sec=None, client=None,
+                 adaptive=False, control_file=None, poll_interval=10,
+                 max_queue=100):
+        if adaptive and client is None:
+            raise error.CompanionException(
+                'Adaptive throttling requires a client')
+        self.docs_per_sec = docs_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.client = client
+        self.adaptive = adaptive
+        self.control_file = control_file
+        self.poll_interval = poll_interval
+        self.max_queue = max_queue
+        self.docs = TokenBucket(docs_per_sec)
+        self.bytes = TokenBucket(bytes_per_sec)
+        self.count = 0
+        self._control_mtime = None
+        self._rejected = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.load_control_file()
+
+    @property
+    def active(self):
+        return bool(self.docs_per_sec or self.bytes_per_sec or
+                    self.adaptive or self.control_file)
+
+    def take(self, docs=1, nbytes=0):
+        """Block until docs documents and nbytes bytes may pass."""
+        self.docs.take(docs)
+        if nbytes:
+            self.bytes.take(nbytes)
+        self.count += docs
+
+    def wrap(self, items, size=None):
+        """Throttle an iterable of hits or actions.
+
+        :param size: A function that returns the size of an item in bytes,
+            only called with a byte limit. A
+            :class:`companion.api.pipeline.SizeEstimator` by default.
+        :returns: A generator of the items.
+
+        """
+        size = size or pipeline.SizeEstimator()
+        self.start()
+        try:
+            for item in items:
+                nbytes = size(item) if self.bytes.rate is not None else 0
+                self.take(1, nbytes)
+                yield item
+        finally:
+            self.stop()
+
+    def reload(self):
+        """Read the control file and poll the cluster without waiting for
+        the next poll, e.g. from a signal handler.
+
+        """
+        self._control_mtime = None
+        self._wake.set()
+
+    def load_control_file(self):
+        """Apply the limits from the control file if it changed."""
+        if not self.control_file:
+            return
+        try:
+            mtime = os.path.getmtime(self.control_file)
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        try:
+            with open(self.control_file) as f:
+                limits = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warn('Could not read control file {}: {}'
+                        .format(self.control_file, e))
+            return
+        self.docs_per_sec = limits.get('docs_per_sec', self.docs_per_sec)
+        self.bytes_per_sec = limits.get('bytes_per_sec', self.bytes_per_sec)
+        logger.info('Throttling to {} docs/s and {} bytes/s'
+                    .format(self.docs_per_sec, self.bytes_per_sec))
+        self.docs.set_rate(self.docs_per_sec)
+        self.bytes.set_rate(self.bytes_per_sec)
+
+    def _pressure(self):
+        """Poll the thread pools and return True if the cluster is under
+        pressure since the last poll.
+
+        """
+        res = self.client.nodes.stats(
+            metric='thread_pool',
+            filter_path='nodes.*.thread_pool.*.queue,'
+                        'nodes.*.thread_pool.*.rejected')
+        queue = 0
+        rejected = 0
+        for node in res.get('nodes', {}).values():
+            for name, pool in node.get('thread_pool', {}).items():
+                if name in THREAD_POOLS:
+                    queue = max(queue, pool.get('queue', 0))
+                    rejected += pool.get('rejected', 0)
+        new_rejections = (self._rejected is not None and
+                          rejected > self._rejected)
+        self._rejected = rejected
+        return new_rejections or queue > self.max_queue
+
+    def adapt(self, observed):
+        """Poll the cluster and adjust the document rate.
+
+        :param observed: The documents per second since the last poll.
+        :type observed: float
+
+        """
+        pressure = self._pressure()
+        current = self.docs.rate or observed
+        if pressure and current:
+            rate = max(self.MIN_DOCS_PER_SEC, current / 2)
+            logger.warn('Cluster under pressure, throttling to {:.0f} docs/s'
+                        .format(rate))
+            self.docs.set_rate(rate)
+        elif not pressure and self.docs.rate is not None:
+            rate = self.docs.rate * 1.25
+            if self.docs_per_sec and rate >= self.docs_per_sec:
+                rate = self.docs_per_sec
+            elif not self.docs_per_sec and rate > 2 * observed:
+                # The job is slower than the limit by itself, so lift it.
+                rate = None
+            if rate != self.docs.rate:
+                logger.info('Cluster recovered, throttling to {} docs/s'
+                            .format(rate and round(rate)))
+                self.docs.set_rate(rate)
+
+    def _poll(self):
+        last_count = self.count
+        last_time = time.monotonic()
+        while not self._stop.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                self.load_control_file()
+                if self.adaptive:
+                    now = time.monotonic()
+                    observed = ((self.count - last_count) /
+                                max(now - last_time, 1e-6))
+                    last_count, last_time = self.count, now
+                    self.adapt(observed)
+            except Exception:
+                logger.exception('Could not update the throttle')
+
+    def start(self):
+        if self._thread is not None or not (self.adaptive or
+                                            self.control_file):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+
+class ThrottledEngine:
+    """A scan engine that throttles the hits of another engine.
+
+    :param engine: A scan engine, see :mod:`companion.api.scan`.
+    :param throttle: The throttle to apply.
+    :type throttle: Throttle
+
+    """
+    def __init__(self, engine, throttle):
+        self.engine = engine
+        self.throttle = throttle
+
+    def __call__(self, client, index=None, query=None, **kwargs):
+        return self.throttle.wrap(self.engine(client, index=index,
+                                              query=query, **kwargs))
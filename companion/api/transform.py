@@ -0,0 +1,130 @@
+"""Declarative field transforms for documents, used by the re-index pipeline.
+
+A transform is described with a dict, typically loaded from JSON:
+
+    {
+        "drop": ["debug", "raw.payload"],
+        "rename": {"ts": "timestamp", "user.name": "username"},
+        "cast": {"price": "float", "count": "int"}
+    }
+
+Fields are addressed with dot notation for nested objects. The steps run in
+the order drop, rename, cast, so casts refer to the renamed fields.
+
+Anything else can be done with a Python function that takes a hit and
+returns it, see :func:`load_function`.
+
+"""
+import importlib
+
+from .. import error
+
+__all__ = ['FieldTransform', 'load_function']
+
+
+def _to_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ('true', 'yes', '1')
+    return bool(value)
+
+
+CASTS = {
+    'int': int,
+    'float': float,
+    'str': str,
+    'bool': _to_bool
+}
+
+
+def _parent(source, path, create=False):
+    """Find the dict containing the last part of a dotted path."""
+    parts = path.split('.')
+    current = source
+    for part in parts[:-1]:
+        if part not in current:
+            if not create:
+                return None, parts[-1]
+            current[part] = {}
+        current = current[part]
+        if not isinstance(current, dict):
+            return None, parts[-1]
+    return current, parts[-1]
+
+
+class FieldTransform:
+    """Drops, renames and casts fields of a document source in place.
+
+    :param drop: Fields to remove.
+    :type drop: list
+    :param rename: Mapping of old to new field names.
+    :type rename: dict
+    :param cast: Mapping of field names to one of "int", "float", "str" or
+        "bool".
+    :type cast: dict
+
+    """
+    def __init__(self, drop=None, rename=None, cast=None):
+        self.drop = list(drop or [])
+        self.rename = dict(rename or {})
+        self.cast = {}
+        for field, type_name in (cast or {}).items():
+            if type_name not in CASTS:
+                raise error.CompanionException(
+                    'Unknown cast type {} for field {}'.format(type_name,
+                                                               field))
+            self.cast[field] = CASTS[type_name]
+
+    @classmethod
+    def from_dict(cls, spec):
+        unknown = set(spec) - {'drop', 'rename', 'cast'}
+        if unknown:
+            raise error.CompanionException(
+                'Unknown transform steps: {}'.format(', '.join(sorted(unknown))))
+        return cls(drop=spec.get('drop'), rename=spec.get('rename'),
+                   cast=spec.get('cast'))
+
+    def __call__(self, source):
+        for path in self.drop:
+            parent, name = _parent(source, path)
+            if parent is not None:
+                parent.pop(name, None)
+
+        for old_path, new_path in self.rename.items():
+            parent, name = _parent(source, old_path)
+            if parent is None or name not in parent:
+                continue
+            value = parent.pop(name)
+            new_parent, new_name = _parent(source, new_path, create=True)
+            if new_parent is not None:
+                new_parent[new_name] = value
+
+        for path, cast in self.cast.items():
+            parent, name = _parent(source, path)
+            if parent is None or parent.get(name) is None:
+                continue
+            try:
+                parent[name] = cast(parent[name])
+            except (TypeError, ValueError):
+                raise error.CompanionException(
+                    'Cannot cast field {} with value {!r}'.format(path,
+                                                                  parent[name]))
+        return source
+
+
+def load_function(path):
+    """Import a document transform function given as "module:function", for
+    example "mytransforms:anonymize". The module must be importable, e.g.
+    from the PYTHONPATH.
+
+    """
+    module_name, _, func_name = path.partition(':')
+    if not module_name or not func_name:
+        raise error.CompanionException(
+            'Expected a transform function as module:function, got {}'
+            .format(path))
+    module = importlib.import_module(module_name)
+    try:
+        return getattr(module, func_name)
+    except AttributeError:
+        raise error.CompanionException(
+            'Module {} has no function {}'.format(module_name, func_name))
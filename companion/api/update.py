@@ -0,0 +1,195 @@
+"""Update fields of many documents in place.
+
+There are two ways to update:
+
+- :func:`update_by_query` runs _update_by_query on the cluster, optionally
+  sliced and throttled, as a background task. The progress is followed with
+  the tasks API.
+- :func:`bulk_update` scans the documents with a scan engine and sends
+  partial update actions with a script or a partial document, like a
+  re-index. This also works for updates that need client-side logic, with
+  an update function.
+
+For Example:
+
+    >>> script = {'inline': 'ctx._source.views += params.n',
+    >>>           'lang': 'painless', 'params': {'n': 1}}
+    >>> update_by_query(url, 'event', script, slices=5,
+    >>>                 requests_per_second=1000)
+
+"""
+import time
+import logging
+
+from . import util, scan, pipeline, transform as field_transform
+from .. import error
+
+__all__ = ['update_by_query', 'bulk_update']
+logger = logging.getLogger(__name__)
+
+
+def _log_progress(status):
+    logger.info('Updated {} of {} documents, {} version conflicts, {} batches'
+                .format(status.get('updated', 0), status.get('total', 0),
+                        status.get('version_conflicts', 0),
+                        status.get('batches', 0)))
+
+
+def update_by_query(url, index_name, script, query=None, doc_type=None,
+                    slices=1, requests_per_second=None, conflicts='proceed',
+                    poll_interval=5):
+    """Update documents with _update_by_query and wait for the task to
+    finish. The task is cancelled when waiting is interrupted.
+
+    :param url: Cluster url
+    :type url: str
+    :param index_name: The name or pattern of the indexes to update.
+    :type index_name: str
+    :param script: The update script, e.g.
+        {"inline": "ctx._source.n = params.n", "params": {"n": 1}}.
+    :type script: dict
+    :param query: A query for the documents to update.
+    :type query: dict
+    :param doc_type: The document type to update.
+    :type doc_type: str
+    :param slices: The number of slices to run in parallel on the cluster.
+    :type slices: int
+    :param requests_per_second: Throttle the update to this many documents
+        per second. Default is no throttling.
+    :type requests_per_second: float
+    :param conflicts: "proceed" to count version conflicts, or "abort" to
+        stop on the first one.
+    :type conflicts: str
+    :param poll_interval: Seconds between task progress polls.
+    :type poll_interval: float
+    :returns: The response of the finished task.
+
+    """
+    client = util.get_client(url)
+    body = dict(query or {})
+    if script is not None:
+        body['script'] = script
+    params = {'slices': slices, 'conflicts': conflicts,
+              'wait_for_completion': 'false'}
+    if requests_per_second:
+        params['requests_per_second'] = requests_per_second
+    res = client.update_by_query(index=index_name, doc_type=doc_type,
+                                 body=body, params=params)
+    task_id = res['task']
+    logger.info('Started update by query task {}'.format(task_id))
+
+    try:
+        while True:
+            task = client.tasks.get(task_id=task_id)
+            _log_progress(task['task'].get('status', {}))
+            if task.get('completed'):
+                break
+            time.sleep(poll_interval)
+    except BaseException:
+        logger.warn('Cancelling task {}'.format(task_id))
+        client.tasks.cancel(task_id=task_id, ignore=404)
+        raise
+
+    response = task.get('response', {})
+    if task.get('error') or response.get('failures'):
+        raise error.CompanionException(
+            'Update by query failed: {}'.format(
+                task.get('error') or response['failures'][:10]))
+    _log_progress(response)
+    return response
+
+
+def bulk_update(url, index_name, script=None, doc=None, update_func=None,
+                query=None, doc_type=None, retry_on_conflict=3,
+                scan_engine=None, max_memory=None, dead_letter_path=None):
+    """Update documents with partial update actions in bulk requests.
+
+    Exactly one of script, doc and update_func describes the update.
+
+    :param url: Cluster url
+    :type url: str
+    :param index_name: The name or pattern of the indexes to update.
+    :type index_name: str
+    :param script: An update script for every document.
+    :type script: dict
+    :param doc: A partial document to merge into every document.
+    :type doc: dict
+    :param update_func: A function that takes a hit, including its source,
+        and returns the update action body, e.g. {"doc": {...}} or
+        {"script": {...}}, or None to leave the document as it is. Given as a
+        function or a "module:function" string.
+    :param query: A query for the documents to update.
+    :type query: dict
+    :param doc_type: The document type to update.
+    :type doc_type: str
+    :param retry_on_conflict: Retries of an update that hits a concurrent
+        change of the document.
+    :type retry_on_conflict: int
+    :param scan_engine: The engine that reads the documents, see
+        :mod:`companion.api.scan`. Default is a scroll.
+    :param max_memory: Limit the hits buffered between the scan and the bulk
+        requests to a share of this many bytes, see
+        :func:`companion.api.pipeline.memory_limits`.
+    :type max_memory: int
+    :param dead_letter_path: Write failed updates to this file instead of
+        stopping, see :class:`companion.api.pipeline.DeadLetters`.
+    :type dead_letter_path: str
+    :returns: The number of updated and failed documents.
+
+    """
+    if sum(x is not None for x in (script, doc, update_func)) != 1:
+        raise error.CompanionException(
+            'Give exactly one of a script, a partial doc or an update function')
+    if isinstance(update_func, str):
+        update_func = field_transform.load_function(update_func)
+
+    logger.info('Starting bulk update of {}'.format(index_name))
+    client = util.get_client(url)
+    scan_engine = scan_engine or scan.ScrollEngine()
+    scan_kwargs = {}
+    if update_func is None:
+        # Only the metadata is needed for the same update of every document.
+        scan_kwargs['_source'] = False
+    hits = scan_engine(client, index=index_name, doc_type=doc_type,
+                       query=query, **scan_kwargs)
+
+    kwargs = {}
+    limits = pipeline.memory_limits(max_memory)
+    if limits is not None:
+        hits = pipeline.bounded(hits, limits.queue_bytes)
+        kwargs['max_chunk_bytes'] = limits.chunk_bytes
+
+    def _updates(hits):
+        for h in hits:
+            if update_func is not None:
+                body = update_func(h)
+                if body is None:
+                    continue
+            elif script is not None:
+                body = {'script': script}
+            else:
+                body = {'doc': doc}
+            action = {
+                '_op_type': 'update',
+                '_index': h['_index'],
+                '_type': h['_type'],
+                '_id': h['_id'],
+                '_retry_on_conflict': retry_on_conflict
+            }
+            if '_routing' in h:
+                action['_routing'] = h['_routing']
+            action.update(body)
+            yield action
+
+    dead_letters = None
+    if dead_letter_path is not None:
+        dead_letters = pipeline.DeadLetters(dead_letter_path)
+    try:
+        stats = pipeline.send_actions(client, _updates(hits),
+                                      dead_letters=dead_letters,
+                                      chunk_size=1000, **kwargs)
+    finally:
+        if dead_letters is not None:
+            dead_letters.close()
+    logger.info('Finished bulk update, statistics: {}'.format(stats))
+    return stats
@@ -4,22 +4,69 @@ import json
 import shutil
 import tarfile
 import zipfile
+import threading
 
 import certifi
 import elasticsearch
 
+# Clients by url when the client cache is enabled, see enable_client_cache.
+_clients = None
+_clients_maxsize = None
+_clients_users = 0
+_clients_lock = threading.Lock()
+
 
 def pretty(output):
     return json.dumps(output, indent=2)
 
 
-def get_client(url):
+def _create_client(url, **kwargs):
     is_ssl = url.startswith('https')
     return elasticsearch.Elasticsearch(url,
                                        use_ssl=is_ssl,
                                        verify_certs=is_ssl,
                                        ca_certs=certifi.where(),
-                                       retry_on_timeout=True)
+                                       retry_on_timeout=True,
+                                       **kwargs)
+
+
+def get_client(url):
+    with _clients_lock:
+        if _clients is None:
+            return _create_client(url)
+        if url not in _clients:
+            _clients[url] = _create_client(url, maxsize=_clients_maxsize)
+        return _clients[url]
+
+
+def enable_client_cache(maxsize=10):
+    """Share one client per url between all callers of :func:`get_client`,
+    for example between jobs that run in the same process. The clients are
+    thread safe.
+
+    Calls nest, so that e.g. a re-index can enable the cache while it runs
+    as a job: an enabled cache and its clients are kept, and the cache is
+    only disabled by the matching last call of :func:`disable_client_cache`.
+
+    :param maxsize: The maximum number of connections per node of a client,
+        if the cache is not enabled yet.
+    :type maxsize: int
+
+    """
+    global _clients, _clients_maxsize, _clients_users
+    with _clients_lock:
+        if not _clients_users:
+            _clients = {}
+            _clients_maxsize = maxsize
+        _clients_users += 1
+
+
+def disable_client_cache():
+    global _clients, _clients_users
+    with _clients_lock:
+        _clients_users = max(0, _clients_users - 1)
+        if not _clients_users:
+            _clients = None
 
 
 def tar_gz_directory(directory, target_path):
@@ -0,0 +1,292 @@
+"""Verify that a re-index copied all documents from the source to the target
+indexes.
+
+The verification compares buckets, where a bucket is a target index. It
+runs in two steps, and the second one only runs if the first one is not
+conclusive:
+
+1. Document counts and order independent content hashes of _type, _id and
+   _source per target index, computed with parallel sliced scans of both
+   sides. Source documents are put in buckets the way the re-index names
+   their targets, so the counts are exact. Each bucket is further split in
+   sub-buckets by a hash of the document uid.
+2. For the sub-buckets that differ, the documents are compared one by one
+   to find the missing, extra and changed documents. Only the differing
+   target indexes, and the source documents within the date range of the
+   differing buckets, are scanned again.
+
+"""
+import re
+import json
+import math
+import string
+import hashlib
+import logging
+import datetime
+
+import dateutil.parser
+import dateutil.tz
+
+from . import util, scan
+
+__all__ = ['verify']
+logger = logging.getLogger(__name__)
+
+SUB_BUCKETS = 256
+HASH_MODULUS = 2 ** 64
+
+# Longer index lists do not fit in the request line.
+MAX_INDEX_LIST = 3000
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Regular expressions for the numeric date directives of name templates.
+_DIRECTIVES = {'Y': r'\d{4}', 'G': r'\d{4}', 'j': r'\d{3}', 'y': r'\d{2}',
+               'm': r'\d{2}', 'd': r'\d{2}', 'H': r'\d{2}', 'M': r'\d{2}',
+               'S': r'\d{2}', 'U': r'\d{2}', 'W': r'\d{2}', 'V': r'\d{2}',
+               'u': r'\d', 'w': r'\d', '%': '%'}
+
+
+def _target_pattern(target_index_name):
+    """Turn a target name template into an index pattern."""
+    return re.sub(r'\{[^}]*\}', '*', target_index_name)
+
+
+def _target_regex(target_index_name):
+    """Turn a target name template into a regular expression for the names
+    of its targets. Unlike the index pattern, the regular expression of
+    "event-{:%Y.%m}" does not match daily indexes such as "event-2015.01.01".
+
+    """
+    parts = []
+    for literal, field, spec, _ in string.Formatter().parse(
+            target_index_name):
+        parts.append(re.escape(literal))
+        if field is None:
+            continue
+        if not spec:
+            parts.append('.+')
+        for token in re.split(r'(%.)', spec or ''):
+            if token.startswith('%') and len(token) == 2:
+                parts.append(_DIRECTIVES.get(token[1], '.+'))
+            else:
+                parts.append(re.escape(token))
+    return re.compile(''.join(parts) + '$')
+
+
+def _target_index(source_index_name, target_index_name, target_regex):
+    """The indexes to scan for targets, leaving out the source indexes that
+    the index pattern of the targets also matches.
+
+    """
+    index = _target_pattern(target_index_name)
+    for name in source_index_name.split(','):
+        if '*' not in name and not target_regex.match(name):
+            index += ',-' + name
+    return index
+
+
+def _doc_hashes(hit, ids_only=False):
+    """Return the sub-bucket and the content hash of a document."""
+    uid = '{}\x00{}'.format(hit['_type'], hit['_id'])
+    sub_bucket = hashlib.sha1(uid.encode('utf-8')).digest()[0] % SUB_BUCKETS
+    content = uid
+    if not ids_only:
+        content += '\x00' + json.dumps(hit.get('_source'), sort_keys=True,
+                                       separators=(',', ':'))
+    digest = hashlib.sha256(content.encode('utf-8')).digest()
+    return sub_bucket, int.from_bytes(digest[:8], 'big')
+
+
+def _epoch_millis(date_value):
+    """Milliseconds since the epoch of a date, taking dates without a time
+    zone as UTC like Elasticsearch does.
+
+    """
+    if date_value.tzinfo is not None:
+        date_value = date_value.astimezone(dateutil.tz.tzutc()).replace(
+            tzinfo=None)
+    return (date_value - _EPOCH).total_seconds() * 1000
+
+
+class _Side:
+    """Reads one side of the comparison and maps documents to buckets."""
+    def __init__(self, client, index, query, bucket_func, scan_engine,
+                 ids_only):
+        self.client = client
+        self.index = index
+        self.query = query
+        self.bucket_func = bucket_func
+        self.scan_engine = scan_engine
+        self.ids_only = ids_only
+
+    def hits(self, index=None, query=None):
+        for hit in self.scan_engine(self.client, index=index or self.index,
+                                    query=query or self.query,
+                                    ignore_unavailable=True):
+            bucket = self.bucket_func(hit)
+            if bucket is not None:
+                yield bucket, hit
+
+    def sub_bucket_hashes(self):
+        """The content hashes by (bucket, sub-bucket) and the document
+        counts by bucket.
+
+        """
+        hashes = {}
+        counts = {}
+        for bucket, hit in self.hits():
+            sub_bucket, doc_hash = _doc_hashes(hit, self.ids_only)
+            key = (bucket, sub_bucket)
+            hashes[key] = (hashes.get(key, 0) + doc_hash) % HASH_MODULUS
+            counts[bucket] = counts.get(bucket, 0) + 1
+        return hashes, counts
+
+    def doc_hashes(self, sub_buckets, index=None, query=None):
+        """The document hashes in the sub-buckets, reading only the given
+        index and query if they are given.
+
+        """
+        docs = {}
+        for bucket, hit in self.hits(index, query):
+            sub_bucket, doc_hash = _doc_hashes(hit, self.ids_only)
+            if (bucket, sub_bucket) in sub_buckets:
+                docs[(bucket, hit['_type'], hit['_id'])] = doc_hash
+        return docs
+
+
+def verify(url, source_index_name, target_index_name, date_field=None,
+           query=None, slices=4, ids_only=False, max_listed=1000):
+    """Verify a re-index made with
+    :func:`companion.api.reindex.date_reindex`.
+
+    Re-indexes with a transform, source filtering or new IDs change the
+    documents and will not verify, except for the counts. Use ids_only to
+    only compare which documents exist.
+
+    :param url: Cluster url
+    :type url: str
+    :param source_index_name: The name of the source index.
+    :type source_index_name: str
+    :param target_index_name: The target index name or name template.
+    :type target_index_name: str
+    :param date_field: The date field used for temporal re-indexing.
+    :type date_field: str
+    :param query: The query used for the source documents.
+    :type query: dict
+    :param slices: The number of scroll slices per side to read in parallel.
+    :type slices: int
+    :param ids_only: Only compare document IDs, not their contents.
+    :type ids_only: bool
+    :param max_listed: The maximum number of differing documents to list.
+    :type max_listed: int
+    :returns: A dict with the per-bucket results under "buckets", a "match"
+        flag, lists of "missing", "extra" and "changed" documents as
+        (index, type, id) tuples and their total numbers under "counts".
+
+    """
+    client = util.get_client(url)
+    # The range of the dates in each bucket, in epoch milliseconds.
+    date_ranges = {}
+
+    def _source_bucket(hit):
+        if not date_field:
+            return target_index_name
+        if date_field not in hit['_source']:
+            return None
+        date_value = dateutil.parser.parse(hit['_source'][date_field])
+        name = target_index_name.format(date_value)
+        millis = _epoch_millis(date_value)
+        low, high = date_ranges.get(name, (millis, millis))
+        date_ranges[name] = (min(low, millis), max(high, millis))
+        return name
+
+    def _target_bucket(hit):
+        # Source indexes can match the index pattern of the targets, e.g.
+        # the daily indexes of monthly targets.
+        if not target_regex.match(hit['_index']):
+            return None
+        return hit['_index']
+
+    target_regex = _target_regex(target_index_name)
+    engine = scan.ScrollEngine(slices=slices)
+    source = _Side(client, source_index_name, query, _source_bucket, engine,
+                   ids_only)
+    target = _Side(client,
+                   _target_index(source_index_name, target_index_name,
+                                 target_regex),
+                   None, _target_bucket, engine, ids_only)
+
+    logger.info('Comparing document counts and content hashes')
+    source_hashes, source_counts = source.sub_bucket_hashes()
+    target_hashes, target_counts = target.sub_bucket_hashes()
+    if not source_counts:
+        logger.warn('The source has no documents. Were they deleted by the '
+                    're-index?')
+
+    buckets = {}
+    for name in sorted(set(source_counts) | set(target_counts)):
+        buckets[name] = {
+            'source_count': source_counts.get(name, 0),
+            'target_count': target_counts.get(name, 0)
+        }
+    count_mismatches = [n for n, b in buckets.items()
+                        if b['source_count'] != b['target_count']]
+    logger.info('{} of {} buckets have different counts'
+                .format(len(count_mismatches), len(buckets)))
+
+    differing = set(k for k in set(source_hashes) | set(target_hashes)
+                    if source_hashes.get(k) != target_hashes.get(k))
+    for name, bucket in buckets.items():
+        bucket['match'] = (name not in count_mismatches and
+                           not any(k[0] == name for k in differing))
+
+    result = {
+        'buckets': buckets,
+        'match': not differing and not count_mismatches,
+        'missing': [],
+        'extra': [],
+        'changed': [],
+        'counts': {'missing': 0, 'extra': 0, 'changed': 0}
+    }
+    if result['match']:
+        logger.info('All {} buckets match'.format(len(buckets)))
+        return result
+
+    logger.info('Comparing documents in {} differing sub-buckets'
+                .format(len(differing)))
+    differing_buckets = sorted(set(bucket for bucket, _ in differing))
+
+    source_docs = {}
+    source_query = query
+    ranges = [date_ranges[b] for b in differing_buckets if b in date_ranges]
+    if date_field and ranges:
+        source_query = scan._with_filter(query, {'range': {date_field: {
+            'gte': math.floor(min(low for low, _ in ranges)),
+            'lte': math.ceil(max(high for _, high in ranges)),
+            'format': 'epoch_millis'}}})
+    if ranges or not date_field:
+        source_docs = source.doc_hashes(differing, query=source_query)
+
+    target_docs = {}
+    target_names = [b for b in differing_buckets if b in target_counts]
+    if target_names:
+        index = ','.join(target_names)
+        if len(index) > MAX_INDEX_LIST:
+            index = None
+        target_docs = target.doc_hashes(differing, index=index)
+    for key in sorted(set(source_docs) | set(target_docs)):
+        if key not in target_docs:
+            kind = 'missing'
+        elif key not in source_docs:
+            kind = 'extra'
+        elif source_docs[key] != target_docs[key]:
+            kind = 'changed'
+        else:
+            continue
+        result['counts'][kind] += 1
+        if len(result[kind]) < max_listed:
+            result[kind].append(key)
+    logger.info('{missing} missing, {extra} extra and {changed} changed '
+                'documents'.format(**result['counts']))
+    return result
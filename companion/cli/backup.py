@@ -1,14 +1,98 @@
-"""Backup Elasticsearch documents to a datastore. Currently, only S3 is
-supported.
+"""Backup Elasticsearch documents to a datastore, either AWS S3 or a local
+directory, or with an Elasticsearch snapshot, and restore them again.
 
 For Example:
 
     >>> $ ./cli.py backup s3 myindex mybucket -u myuser -s mysecret
+    >>> $ ./cli.py backup local myindex /mnt/backups
+    >>> $ ./cli.py restore local /mnt/backups clibackup/2017/01/02_120000
+    >>> $ ./cli.py backup snapshot 'event-*' backups -l /mnt/snapshots
+    >>> $ ./cli.py restore snapshot backups event-20170102120000 \
+    >>>   --rename-pattern '(.+)' --rename-replacement 'restored-$1'
 
 """
-from ..api import backup
+import time
+
+from ..api import backup, storage, estimate, util, snapshot
+from .util import MB, parse_list, get_scan_engine, print_estimate
+
+
+def transfer_settings(args):
+    """Build S3 transfer settings from the transfer arguments."""
+    return {
+        'multipart_threshold': args.multipart_threshold * MB,
+        'part_size': args.part_size * MB,
+        'max_concurrency': args.max_concurrency,
+        'max_retries': args.max_retries
+    }
+
+
+def timed_backup(args, func, *func_args, **kwargs):
+    """Run a backup, or only print its estimate, and record the
+    throughput.
+
+    """
+    if args.estimate:
+        print_estimate(estimate.estimate(args.url, 'backup',
+                                         args.index_name))
+        return
+    client = util.get_client(args.url)
+    docs = client.count(index=args.index_name,
+                        ignore_unavailable=True)['count']
+    start = time.time()
+    func(*func_args, **kwargs)
+    estimate.record_throughput('backup', docs, time.time() - start)
 
 
 def s3_run(args):
-    backup.s3(args.url, args.index_name, args.region, args.bucket_name,
-              args.user, args.secret)
+    timed_backup(args, backup.s3, args.url, args.index_name, args.region,
+                 args.bucket_name, args.user, args.secret,
+                 filetype=args.filetype,
+                 parallel_files=args.parallel_files,
+                 transfer_settings=transfer_settings(args),
+                 source_include=parse_list(args.include),
+                 source_exclude=parse_list(args.exclude),
+                 scan_engine=get_scan_engine(args))
+
+
+def local_run(args):
+    timed_backup(args, backup.local, args.url, args.index_name, args.path,
+                 filetype=args.filetype,
+                 source_include=parse_list(args.include),
+                 source_exclude=parse_list(args.exclude),
+                 scan_engine=get_scan_engine(args))
+
+
+def restore_s3_run(args):
+    target = storage.S3Storage(args.bucket_name, region=args.region,
+                               user_key=args.user, secret_key=args.secret,
+                               **transfer_settings(args))
+    backup.restore(args.url, target, args.backup_name,
+                   index_name=args.index_name)
+
+
+def restore_local_run(args):
+    target = storage.LocalStorage(args.path)
+    backup.restore(args.url, target, args.backup_name,
+                   index_name=args.index_name)
+
+
+def snapshot_run(args):
+    snapshot.ensure_repository(args.url, args.repository,
+                               location=args.location)
+    name = snapshot.snapshot(args.url, args.repository, args.index_name,
+                             name=args.name)
+    print('Created snapshot {}'.format(name))
+
+
+def restore_snapshot_run(args):
+    index_settings = None
+    if args.replicas is not None:
+        index_settings = {'index.number_of_replicas': args.replicas}
+    names = snapshot.restore(args.url, args.repository, args.snapshot_name,
+                             index_name=args.index_name,
+                             rename_pattern=args.rename_pattern,
+                             rename_replacement=args.rename_replacement,
+                             index_settings=index_settings,
+                             max_wait=args.max_wait)
+    print('Restored {}'.format(', '.join(names)))
@@ -5,8 +5,20 @@
 """
 import logging
 import argparse
+import resource
+import importlib
 
-from . import setup, health, reindex, backup, deletebulk
+
+def lazy(module_name, func_name='run'):
+    """Refer to a command function without importing its module. The module
+    is imported when the command runs, so each command only loads its own
+    dependencies and the help is shown without loading any of them.
+
+    """
+    def _run(args):
+        module = importlib.import_module('.' + module_name, __package__)
+        return getattr(module, func_name)(args)
+    return _run
 
 
 # Create main parser
@@ -25,7 +37,19 @@ health_parser = command_parser.add_parser('health',
 health_parser.add_argument('-l', '--level', help='The status level',
                            choices=['cluster', 'indices', 'shards'],
                            default='cluster')
-health_parser.set_defaults(func=health.run)
+health_parser.add_argument('-w', '--watch', action='store_true',
+                           help='Keep polling and only show changes')
+health_parser.add_argument('-i', '--interval', type=float, default=5,
+                           help='Seconds between polls when watching')
+health_parser.add_argument('--wait-for-status',
+                           choices=['green', 'yellow', 'red'],
+                           help='Block until the cluster has this status')
+health_parser.add_argument('--timeout', type=int, default=30,
+                           help='Seconds for each wait-for-status poll')
+health_parser.add_argument('--max-wait', type=int,
+                           help='''Seconds to wait for the status before
+                           exiting with an error''')
+health_parser.set_defaults(func=lazy('health'))
 
 # Create parser for setup command
 setup_parser = command_parser.add_parser('setup', help='Perform index setup')
@@ -35,12 +59,60 @@ setup_parser.add_argument('-r', '--reset', action='store_true',
 setup_parser.add_argument('-p', '--data-path',
                           help='Directory containing the setup data files',
                           default='./data')
-setup_parser.set_defaults(func=setup.run)
+setup_parser.add_argument('-c', '--cluster', action='append',
+                          help='''A cluster url to set up instead of --url,
+                          can be given several times''')
+setup_parser.add_argument('--inventory',
+                          help='''A file with a cluster url, or a name and a
+                          url, per line''')
+setup_parser.add_argument('--max-clusters', type=int, default=8,
+                          help='The number of clusters to set up in parallel')
+setup_parser.add_argument('--max-requests', type=int, default=4,
+                          help='The number of parallel requests per cluster')
+setup_parser.set_defaults(func=lazy('setup'))
+
+
+def add_scan_arguments(scan_parser):
+    scan_parser.add_argument('--scan-engine', default='scroll',
+                             choices=['scroll', 'search_after'],
+                             help='How to read the documents')
+    scan_parser.add_argument('--sort-field',
+                             help='''The field to sort search_after on, and
+                             to partition on with several workers''')
+    scan_parser.add_argument('--scan-workers', type=int, default=1,
+                             help='''The number of scroll slices or
+                             search_after partitions to read in parallel''')
+    scan_parser.add_argument('--max-memory', type=int,
+                             help='''Memory budget in MB for the documents
+                             buffered between reading and writing''')
+    scan_parser.add_argument('--max-docs-per-sec', type=float,
+                             help='Limit the documents read per second')
+    scan_parser.add_argument('--max-mb-per-sec', type=float,
+                             help='Limit the MB of documents read per second')
+    scan_parser.add_argument('--adaptive-throttle', action='store_true',
+                             help='''Slow down while the cluster has thread
+                             pool rejections or long queues''')
+    scan_parser.add_argument('--estimate', action='store_true',
+                             help='''Only print the expected documents, sizes
+                             and duration''')
+    scan_parser.add_argument('--throttle-file',
+                             help='''A JSON file with docs_per_sec and
+                             bytes_per_sec limits, read again when it changes
+                             or on SIGHUP''')
+
+
+def add_dead_letter_arguments(bulk_parser):
+    bulk_parser.add_argument('--dead-letter-file',
+                             help='''Write failed bulk actions to this file
+                             instead of stopping, to send them again with the
+                             replay command''')
+
 
 # Create parser for reindex command
 reindex_parser = command_parser.add_parser('reindex', help='Re-index an index')
 reindex_parser.add_argument('source_index_name',
-                            help='The name of the index to re-index')
+                            help='''The name or pattern of the indexes to
+                            re-index''')
 reindex_parser.add_argument('target_index_name',
                             help='''The target index name. The name can be
                             specific such as "myindex" or use a date pattern
@@ -51,7 +123,73 @@ reindex_parser.add_argument('-d', '--datefield',
                             help='The field to base the date on')
 reindex_parser.add_argument('--deletedoc', help='Delete the source document',
                             action='store_true')
-reindex_parser.set_defaults(func=reindex.run)
+reindex_parser.add_argument('--include',
+                            help='Comma separated source fields to copy')
+reindex_parser.add_argument('--exclude',
+                            help='Comma separated source fields to skip')
+reindex_parser.add_argument('--transform',
+                            help='''Field transform with drop, rename and
+                            cast steps, as JSON or a JSON file''')
+reindex_parser.add_argument('--optimize-ingest', action='store_true',
+                            help='''Disable refreshes and replicas on the
+                            target indexes while writing''')
+reindex_parser.add_argument('--force-merge', type=int,
+                            help='''With --optimize-ingest, force merge the
+                            targets to this number of segments''')
+reindex_parser.add_argument('--plan', action='store_true',
+                            help='''Only print the target indexes and their
+                            expected number of documents''')
+reindex_parser.add_argument('--precreate', action='store_true',
+                            help='Create the target indexes up front')
+reindex_parser.add_argument('--docs-per-shard', type=int,
+                            help='''With --precreate, size the number of
+                            shards of the targets by this many documents per
+                            shard''')
+reindex_parser.add_argument('--max-shards', type=int, default=5,
+                            help='''With --precreate, the maximum number of
+                            shards per target''')
+reindex_parser.add_argument('--group-buffer', type=int,
+                            help='''Buffer this many actions and group them
+                            by target index, e.g. 10000''')
+reindex_parser.add_argument('--doc-transform',
+                            help='''A Python function that transforms each
+                            document, as module:function''')
+reindex_parser.add_argument('--processes', type=int,
+                            help='''Prepare bulk requests in this many
+                            processes, 0 for one per CPU core''')
+reindex_parser.add_argument('--bulk-threads', type=int, default=2,
+                            help='''With --processes, the number of bulk
+                            requests to send in parallel''')
+reindex_parser.add_argument('--per-index', action='store_true',
+                            help='''Re-index each index that matches the
+                            source pattern on its own, largest first''')
+reindex_parser.add_argument('--max-parallel', type=int, default=4,
+                            help='''With --per-index, the number of source
+                            indexes to re-index at the same time''')
+reindex_parser.add_argument('--max-slices', type=int, default=8,
+                            help='''With --per-index, the number of scan
+                            slices of all source indexes together. Each index
+                            gets one slice per shard, up to --scan-workers
+                            or an even share of this''')
+reindex_parser.add_argument('--max-connections', type=int, default=20,
+                            help='''With --per-index, the maximum number of
+                            connections per node''')
+add_scan_arguments(reindex_parser)
+add_dead_letter_arguments(reindex_parser)
+reindex_parser.set_defaults(func=lazy('reindex'))
+
+
+def add_transfer_arguments(transfer_parser):
+    transfer_parser.add_argument('--multipart-threshold', type=int, default=8,
+                                 help='''Size in MB from which S3 transfers
+                                 are split into parts''')
+    transfer_parser.add_argument('--part-size', type=int, default=8,
+                                 help='Size in MB of S3 transfer parts')
+    transfer_parser.add_argument('--max-concurrency', type=int, default=10,
+                                 help='Parallel S3 requests per file')
+    transfer_parser.add_argument('--max-retries', type=int, default=3,
+                                 help='Retries for failed S3 requests')
+
 
 # Create parser for backup command
 backup_parser = command_parser.add_parser('backup',
@@ -65,7 +203,99 @@ s3_parser.add_argument('-r', '--region', help='The name of aws region',
                        default='eu-west-1')
 s3_parser.add_argument('-u', '--user', help='User key for s3')
 s3_parser.add_argument('-s', '--secret', help='Secret key for s3')
-s3_parser.set_defaults(func=backup.s3_run)
+s3_parser.add_argument('-t', '--filetype', help='The archive file type',
+                       choices=['zip', 'tar'], default='zip')
+s3_parser.add_argument('--parallel-files', type=int, default=4,
+                       help='The number of files to upload concurrently')
+s3_parser.add_argument('--include',
+                       help='Comma separated source fields to backup')
+s3_parser.add_argument('--exclude',
+                       help='Comma separated source fields to skip')
+add_transfer_arguments(s3_parser)
+add_scan_arguments(s3_parser)
+s3_parser.set_defaults(func=lazy('backup', 's3_run'))
+local_parser = backup_type_parser.add_parser('local',
+                                             help='Backup to a local directory')
+local_parser.add_argument('index_name', help='The name of index to backup')
+local_parser.add_argument('path', help='The directory to backup to')
+local_parser.add_argument('-t', '--filetype', help='The archive file type',
+                          choices=['zip', 'tar'], default='zip')
+local_parser.add_argument('--include',
+                          help='Comma separated source fields to backup')
+local_parser.add_argument('--exclude',
+                          help='Comma separated source fields to skip')
+add_scan_arguments(local_parser)
+local_parser.set_defaults(func=lazy('backup', 'local_run'))
+snapshot_parser = backup_type_parser.add_parser(
+    'snapshot', help='Backup with an Elasticsearch snapshot')
+snapshot_parser.add_argument('index_name',
+                             help='The name or pattern of indexes to backup')
+snapshot_parser.add_argument('repository',
+                             help='The name of the snapshot repository')
+snapshot_parser.add_argument('-l', '--location',
+                             help='''Create an "fs" repository in this
+                             directory, which must be in path.repo of the
+                             nodes, if it does not exist''')
+snapshot_parser.add_argument('-n', '--name',
+                             help='Snapshot name, defaults to current time')
+snapshot_parser.set_defaults(func=lazy('backup', 'snapshot_run'))
+
+# Create parser for restore command
+restore_parser = command_parser.add_parser('restore',
+                                           help='Restore an index backup')
+restore_type_parser = restore_parser.add_subparsers(help='Storage type',
+                                                    dest='storagetype')
+restore_s3_parser = restore_type_parser.add_parser('s3',
+                                                   help='Restore from AWS S3')
+restore_s3_parser.add_argument('bucket_name',
+                               help='The name of bucket to restore from')
+restore_s3_parser.add_argument('backup_name',
+                               help='''The backup name, such as
+                               "clibackup/2017/01/02_120000"''')
+restore_s3_parser.add_argument('-i', '--index-name',
+                               help='''Index to restore to, defaults to the
+                               index of the backup''')
+restore_s3_parser.add_argument('-r', '--region',
+                               help='The name of aws region',
+                               default='eu-west-1')
+restore_s3_parser.add_argument('-u', '--user', help='User key for s3')
+restore_s3_parser.add_argument('-s', '--secret', help='Secret key for s3')
+add_transfer_arguments(restore_s3_parser)
+restore_s3_parser.set_defaults(func=lazy('backup', 'restore_s3_run'))
+restore_local_parser = restore_type_parser.add_parser(
+    'local', help='Restore from a local directory')
+restore_local_parser.add_argument('path',
+                                  help='The directory to restore from')
+restore_local_parser.add_argument('backup_name',
+                                  help='''The backup name, such as
+                                  "clibackup/2017/01/02_120000"''')
+restore_local_parser.add_argument('-i', '--index-name',
+                                  help='''Index to restore to, defaults to the
+                                  index of the backup''')
+restore_local_parser.set_defaults(func=lazy('backup', 'restore_local_run'))
+restore_snapshot_parser = restore_type_parser.add_parser(
+    'snapshot', help='Restore from an Elasticsearch snapshot')
+restore_snapshot_parser.add_argument('repository',
+                                     help='The name of the snapshot repository')
+restore_snapshot_parser.add_argument('snapshot_name',
+                                     help='The name of the snapshot')
+restore_snapshot_parser.add_argument('-i', '--index-name',
+                                     help='''The name or pattern of indexes to
+                                     restore, defaults to all''')
+restore_snapshot_parser.add_argument('--rename-pattern',
+                                     help='''A regular expression for index
+                                     names to rename, such as "(.+)"''')
+restore_snapshot_parser.add_argument('--rename-replacement',
+                                     help='''The new index names, such as
+                                     "restored-$1"''')
+restore_snapshot_parser.add_argument('--replicas', type=int,
+                                     help='''The number of replicas of the
+                                     restored indexes, 0 restores fastest''')
+restore_snapshot_parser.add_argument('--max-wait', type=float,
+                                     help='''Fail if the restore takes more
+                                     than this many seconds''')
+restore_snapshot_parser.set_defaults(func=lazy('backup',
+                                               'restore_snapshot_run'))
 
 # Create parser for delete command
 delete_parser = command_parser.add_parser('delete', help='Delete documents')
@@ -75,13 +305,233 @@ delete_parser.add_argument('doc_type',
                            help='The name of the document type to delete from')
 delete_parser.add_argument('-q', '--query',
                            help='Optional query object')
-delete_parser.set_defaults(func=deletebulk.run)
+add_scan_arguments(delete_parser)
+add_dead_letter_arguments(delete_parser)
+delete_parser.set_defaults(func=lazy('deletebulk'))
+
+# Create parser for update command
+update_parser = command_parser.add_parser('update',
+                                          help='Update documents in place')
+update_parser.add_argument('index_name',
+                           help='The name of the index to update in')
+update_parser.add_argument('-t', '--doc-type',
+                           help='The document type to update')
+update_parser.add_argument('-q', '--query',
+                           help='Optional query object')
+update_parser.add_argument('--script',
+                           help='The source of the update script')
+update_parser.add_argument('--lang', default='painless',
+                           help='The language of the update script')
+update_parser.add_argument('--params',
+                           help='JSON params of the update script')
+update_parser.add_argument('--client-side', action='store_true',
+                           help='''Scan the documents and send partial updates
+                           in bulk requests, instead of running
+                           _update_by_query on the cluster''')
+update_parser.add_argument('--doc',
+                           help='''With --client-side, a JSON partial document
+                           to merge into the documents''')
+update_parser.add_argument('--update-func',
+                           help='''With --client-side, a "module:function" that
+                           returns the update for a hit''')
+add_scan_arguments(update_parser)
+add_dead_letter_arguments(update_parser)
+update_parser.set_defaults(func=lazy('update'))
+
+# Create parser for copy command
+copy_parser = command_parser.add_parser('copy',
+                                        help='Copy an index to another cluster')
+copy_parser.add_argument('target_url', help='The url of the target cluster')
+copy_parser.add_argument('source_index_name',
+                         help='The name or pattern of the indexes to copy')
+copy_parser.add_argument('target_index_name', nargs='?',
+                         help='The target index, default is the same name')
+copy_parser.add_argument('-q', '--query',
+                         help='A query for the documents to copy')
+copy_parser.add_argument('--slices', type=int, default=4,
+                         help='''Scroll slices to read in parallel, use 1 for
+                         sources older than Elasticsearch 5''')
+copy_parser.add_argument('--size', type=int, default=1000,
+                         help='Documents per shard per scroll page')
+copy_parser.add_argument('--bulk-threads', type=int, default=4,
+                         help='Bulk requests to send in parallel')
+copy_parser.add_argument('--raw', action='store_true',
+                         help='''Copy the sources as JSON text without decoding
+                         them''')
+copy_parser.set_defaults(func=lazy('copy'))
+
+# Create parser for replay command
+replay_parser = command_parser.add_parser(
+    'replay', help='Send the failed actions of a dead letter file again')
+replay_parser.add_argument('dead_letter_file',
+                           help='The dead letter file of an earlier job')
+replay_parser.add_argument('-o', '--output',
+                           help='''The dead letter file for actions that fail
+                           again, default is the replayed file name with
+                           ".replay" appended''')
+replay_parser.add_argument('--max-retries', type=int, default=3,
+                           help='Retries of actions rejected by a busy cluster')
+replay_parser.set_defaults(func=lazy('replay'))
+
+# Create parser for export command
+export_parser = command_parser.add_parser('export',
+                                          help='Export an index as NDJSON')
+export_parser.add_argument('index_name',
+                           help='The name or pattern of indexes to export')
+export_parser.add_argument('-o', '--output', default='-',
+                           help='''The file to write to, default is stdout.
+                           Files ending with ".gz" are compressed''')
+export_parser.add_argument('-q', '--query',
+                           help='A query for the documents to export')
+export_parser.add_argument('-t', '--doc-type',
+                           help='The document type to export')
+export_parser.add_argument('--parts', type=int, default=1,
+                           help='''Export this many scroll slices in parallel,
+                           each to its own part file''')
+export_parser.add_argument('-z', '--compress', action='store_true',
+                           help='Compress with gzip')
+add_scan_arguments(export_parser)
+export_parser.set_defaults(func=lazy('stream', 'export_run'))
+
+# Create parser for import command
+import_parser = command_parser.add_parser('import',
+                                          help='Import NDJSON files')
+import_parser.add_argument('files', nargs='+',
+                           help='''The files to import in parallel, or "-" for
+                           stdin. Compressed files are detected''')
+import_parser.add_argument('-i', '--index-name',
+                           help='''Index to import to, defaults to the index of
+                           each document''')
+import_parser.add_argument('--bulk-threads', type=int, default=2,
+                           help='Bulk requests to send in parallel')
+import_parser.set_defaults(func=lazy('stream', 'import_run'))
+
+# Create parser for verify command
+verify_parser = command_parser.add_parser('verify',
+                                          help='Verify a re-index')
+verify_parser.add_argument('source_index_name',
+                           help='The name of the re-indexed index')
+verify_parser.add_argument('target_index_name',
+                           help='The target index name or date pattern')
+verify_parser.add_argument('-d', '--datefield',
+                           help='The field the date pattern was based on')
+verify_parser.add_argument('-q', '--query',
+                           help='The query used for the re-index')
+verify_parser.add_argument('--slices', type=int, default=4,
+                           help='Scroll slices to read in parallel per side')
+verify_parser.add_argument('--ids-only', action='store_true',
+                           help='Only compare IDs, not document contents')
+verify_parser.add_argument('-a', '--all', action='store_true',
+                           help='Also print the matching target indexes')
+verify_parser.set_defaults(func=lazy('verify'))
+
+
+def add_limit_arguments(jobs_parser):
+    jobs_parser.add_argument('--max-jobs', type=int, default=4,
+                             help='The number of jobs to run at the same time')
+    jobs_parser.add_argument('--max-scrolls', type=int, default=16,
+                             help='The number of scroll contexts for all jobs')
+    jobs_parser.add_argument('--max-bulk-threads', type=int, default=8,
+                             help='''The number of parallel bulk requests for
+                             all jobs''')
+    jobs_parser.add_argument('--max-connections', type=int, default=20,
+                             help='''The number of connections per node for
+                             all jobs''')
+
+
+# Create parser for the job runner command
+run_parser = command_parser.add_parser('run', help='Run a file of jobs')
+run_parser.add_argument('jobs_file',
+                        help='A file with one JSON job per line')
+run_parser.add_argument('-o', '--output',
+                        help='Append a JSON line per job result to this file')
+add_limit_arguments(run_parser)
+run_parser.set_defaults(func=lazy('jobs'))
+
+# Create parser for job service command
+serve_parser = command_parser.add_parser(
+    'serve', help='Run jobs submitted over an HTTP API')
+serve_parser.add_argument('--host', default='127.0.0.1',
+                          help='The address to listen on')
+serve_parser.add_argument('-p', '--port', type=int, default=9250,
+                          help='The port to listen on')
+serve_parser.add_argument('-o', '--output',
+                          help='Append a JSON line per job result to this file')
+serve_parser.add_argument('--max-finished', type=int, default=1000,
+                          help='The number of finished jobs to keep results of')
+add_limit_arguments(serve_parser)
+serve_parser.set_defaults(func=lazy('serve'))
+
+# Create parser for deduplicated backup command
+dedup_parser = command_parser.add_parser('dedup',
+                                         help='Deduplicated backups')
+dedup_command_parser = dedup_parser.add_subparsers(help='Dedup options',
+                                                   dest='dedupcommand')
+dedup_command_parser.required = True
+
+
+def add_storage_arguments(storage_parser):
+    storage_parser.add_argument('target',
+                                help='''A local directory or an S3 url such as
+                                "s3://mybucket/prefix"''')
+    storage_parser.add_argument('-r', '--region',
+                                help='The name of aws region',
+                                default='eu-west-1')
+    storage_parser.add_argument('-u', '--user', help='User key for s3')
+    storage_parser.add_argument('-s', '--secret', help='Secret key for s3')
+    storage_parser.add_argument('--endpoint-url',
+                                help='Endpoint of an S3 compatible service')
+    add_transfer_arguments(storage_parser)
+
+
+dedup_backup_parser = dedup_command_parser.add_parser(
+    'backup', help='Backup an index')
+dedup_backup_parser.add_argument('index_name',
+                                 help='The name of the index to backup')
+add_storage_arguments(dedup_backup_parser)
+dedup_backup_parser.add_argument('-n', '--name',
+                                 help='Backup name, defaults to current time')
+dedup_backup_parser.set_defaults(func=lazy('dedup', 'backup_run'))
+
+dedup_restore_parser = dedup_command_parser.add_parser(
+    'restore', help='Restore a backup')
+add_storage_arguments(dedup_restore_parser)
+dedup_restore_parser.add_argument('manifest',
+                                  help='The manifest key of the backup')
+dedup_restore_parser.add_argument('-i', '--index-name',
+                                  help='''Index to restore to, defaults to
+                                  the index of the backup''')
+dedup_restore_parser.set_defaults(func=lazy('dedup', 'restore_run'))
+
+dedup_list_parser = dedup_command_parser.add_parser(
+    'list', help='List backup manifests')
+add_storage_arguments(dedup_list_parser)
+dedup_list_parser.add_argument('-i', '--index-name',
+                               help='Only list backups of this index')
+dedup_list_parser.set_defaults(func=lazy('dedup', 'list_run'))
+
+dedup_gc_parser = dedup_command_parser.add_parser(
+    'gc', help='Delete chunks that no backup refers to')
+add_storage_arguments(dedup_gc_parser)
+dedup_gc_parser.add_argument('--dry-run', action='store_true',
+                             help='Only count the unreferenced chunks')
+dedup_gc_parser.set_defaults(func=lazy('dedup', 'gc_run'))
+
+
+def log_peak_memory():
+    # ru_maxrss is in kilobytes on Linux.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    logging.getLogger(__name__).info('Peak memory usage {:.1f} MB'
+                                     .format(peak / 1024))
 
 
 def main():
     args = parser.parse_args()
     logging.basicConfig(level=args.log_level)
-    args.func(args)
+    try:
+        args.func(args)
+    finally:
+        log_peak_memory()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,17 @@
+"""This command copies an index from the cluster given with --url to another
+cluster.
+
+For Example:
+
+    >>> companion -u http://old:9200 copy http://new:9200 event --raw
+
+"""
+from ..api import copy
+from .util import parse_json
+
+
+def run(args):
+    copy.copy(args.url, args.target_url, args.source_index_name,
+              target_index_name=args.target_index_name,
+              query=parse_json(args.query), slices=args.slices,
+              size=args.size, bulk_threads=args.bulk_threads, raw=args.raw)
@@ -0,0 +1,41 @@
+"""Deduplicated backups. Unchanged documents are only stored once across all
+backups in the same target. The target is a local directory or an S3 url.
+
+For Example:
+
+    >>> companion dedup backup myindex s3://mybucket/backups -u myuser -s secret
+    >>> companion dedup list /mnt/backups
+    >>> companion dedup restore /mnt/backups manifests/myindex/20170101T000000.json
+    >>> companion dedup gc /mnt/backups
+
+"""
+from ..api import dedup, storage
+from .backup import transfer_settings
+
+
+def _get_storage(args):
+    return storage.get_storage(args.target, region=args.region,
+                               user_key=args.user, secret_key=args.secret,
+                               endpoint_url=args.endpoint_url,
+                               **transfer_settings(args))
+
+
+def backup_run(args):
+    dedup.backup(args.url, args.index_name, _get_storage(args),
+                 name=args.name)
+
+
+def restore_run(args):
+    dedup.restore(args.url, _get_storage(args), args.manifest,
+                  index_name=args.index_name)
+
+
+def list_run(args):
+    for key in dedup.list_manifests(_get_storage(args), args.index_name):
+        print(key)
+
+
+def gc_run(args):
+    unreferenced = dedup.gc(_get_storage(args), dry_run=args.dry_run)
+    action = 'Would delete' if args.dry_run else 'Deleted'
+    print('{} {} unreferenced chunks'.format(action, len(unreferenced)))
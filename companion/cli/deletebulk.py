@@ -12,9 +12,10 @@ For more complicated queries, you can store the query in a JSON file:
 The command will automatically detect when a file is used.
 
 """
-import os
-import json
-from ..api import deletebulk, util
+import time
+
+from ..api import deletebulk, util, estimate
+from .util import parse_json, get_scan_engine, get_max_memory, print_estimate
 
 
 def parse_query(query):
@@ -25,32 +26,28 @@ def parse_query(query):
     :returns: A Python dict corresponding to the query.
 
     """
-    if query is None:
-        return query
-
-    # If the query is actually a file, load it.
-    # Otherwise assume it is a JSON string.
-    if os.path.isfile(query):
-        with open(query) as f:
-            query = json.loads(f.read())
-    else:
-        query = json.loads(query)
-
-    return query
+    return parse_json(query)
 
 
 def run(args):
     query = parse_query(args.query)
+    if args.estimate:
+        print_estimate(estimate.estimate(args.url, 'delete', args.index_name,
+                                         query=query, doc_type=args.doc_type))
+        return
 
     client = util.get_client(args.url)
-    cnt = client.count(index=args.index_name, doc_type=args.doc_type,
-                       body=query)
+    counts = estimate.parallel({
+        'query': lambda: client.count(index=args.index_name,
+                                      doc_type=args.doc_type, body=query),
+        'all': lambda: client.count(index=args.index_name,
+                                    doc_type=args.doc_type)
+    })
+    cnt = counts['query']
     if query:
-        cnt_without = client.count(index=args.index_name,
-                                   doc_type=args.doc_type)
         print('You specified a query. Please double check the data...')
         print('Number of documents if query was empty: {}'
-              .format(cnt_without['count']))
+              .format(counts['all']['count']))
         print('Number of documents with your query: {}'.format(cnt['count']))
 
     print('Will delete {} documents'.format(cnt['count']))
@@ -58,4 +55,9 @@ def run(args):
     if res != 'yes':
         return
 
-    deletebulk.delete_by_query(args.url, args.index_name, args.doc_type, query)
+    start = time.time()
+    deleted, _ = deletebulk.delete_by_query(
+        args.url, args.index_name, args.doc_type, query,
+        scan_engine=get_scan_engine(args), max_memory=get_max_memory(args),
+        dead_letter_path=args.dead_letter_file)
+    estimate.record_throughput('delete', deleted, time.time() - start)
@@ -1,6 +1,24 @@
-"""Health command."""
+"""Health command.
+
+For Example:
+
+    >>> companion health -l shards --watch -i 10
+    >>> companion health --wait-for-status green --max-wait 600
+
+"""
+import sys
+
 from ..api import health
 
 
 def run(args):
-    health.health(args.url, args.level)
+    if args.wait_for_status:
+        reached = health.wait_for_status(args.url, args.wait_for_status,
+                                         timeout=args.timeout,
+                                         max_wait=args.max_wait)
+        if not reached:
+            sys.exit(1)
+    elif args.watch:
+        health.watch(args.url, args.level, interval=args.interval)
+    else:
+        health.health(args.url, args.level)
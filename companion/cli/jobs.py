@@ -0,0 +1,37 @@
+"""This command runs a file of jobs, one JSON object per line, concurrently
+and in dependency order. See :mod:`companion.api.jobs` for the format.
+
+For Example:
+
+    >>> companion run jobs.jsonl -o results.jsonl --max-jobs 8
+
+"""
+import sys
+
+from ..api import jobs
+
+
+def get_limits(args):
+    """The global job limits of the arguments."""
+    return jobs.Limits(max_jobs=args.max_jobs,
+                       max_scrolls=args.max_scrolls,
+                       max_bulk_threads=args.max_bulk_threads,
+                       max_connections=args.max_connections)
+
+
+def run(args):
+    job_list = jobs.load_jobs(args.jobs_file)
+    limits = get_limits(args)
+    if args.output:
+        with open(args.output, 'a') as output:
+            results = jobs.run_jobs(args.url, job_list, limits=limits,
+                                    output=output)
+    else:
+        results = jobs.run_jobs(args.url, job_list, limits=limits)
+
+    for job in job_list:
+        result = results[job.id]
+        print('{:<40} {:<10} {:>10}'.format(job.id, result['status'],
+                                            result.get('seconds', '-')))
+    if any(r['status'] != 'succeeded' for r in results.values()):
+        sys.exit(1)
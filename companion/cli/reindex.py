@@ -5,20 +5,167 @@ For Example:
 
     >>> companion reindex event event-{:%Y} -d timestamp --deletedoc
 
+Only some fields can be copied, and fields can be dropped, renamed or cast on
+the way with a transform given as JSON or a JSON file:
+
+    >>> companion reindex event event2 --exclude raw --transform \
+    >>> '{"rename":{"ts":"timestamp"},"cast":{"price":"float"}}'
+
+Date parsing and transforms are limited to one CPU core, unless the bulk
+requests are prepared in several processes. A Python function can transform
+the documents too:
+
+    >>> companion reindex event event-{:%Y-%m-%d} -d timestamp --processes 0 \
+    >>> --doc-transform mytransforms:anonymize
+
+To review the target indexes and create them before re-indexing:
+
+    >>> companion reindex event event-{:%Y-%m-%d} -d timestamp --precreate \
+    >>> --docs-per-shard 10000000
+
+Many source indexes can be re-indexed one by one in parallel, largest first,
+with a shared budget of scan slices:
+
+    >>> companion reindex 'event-2015-*' event-{:%Y-%m} -d timestamp \
+    >>> --per-index --max-parallel 4 --max-slices 16
+
 """
+import sys
+import time
 import datetime
 
-from ..api import reindex
+from ..api import reindex, estimate
+from .util import (parse_json, parse_list, get_scan_engine, get_max_memory,
+                   get_engine_factory, print_estimate)
+
+
+def print_plan(plan, docs_per_shard=None, max_shards=5):
+    print('{:<50} {:>12} {:>6}'.format('Target index', 'Documents', 'Shards'))
+    for index_name, doc_count in plan:
+        shards = '-'
+        if docs_per_shard:
+            shards = reindex.shard_count(doc_count, docs_per_shard,
+                                         max_shards)
+        print('{:<50} {:>12} {:>6}'.format(index_name, doc_count, shards))
+    print('{} target indexes, {} documents'
+          .format(len(plan), sum(count for _, count in plan)))
+
+
+def print_sources(plan):
+    print('{:<50} {:>12} {:>6}'.format('Source index', 'Documents', 'Shards'))
+    for index_name, doc_count, shards in plan:
+        print('{:<50} {:>12} {:>6}'.format(index_name, doc_count, shards))
+    print('{} source indexes, {} documents'
+          .format(len(plan), sum(count for _, count, _ in plan)))
+
+
+def print_results(results):
+    print('{:<50} {:>10} {:>12} {:>10}'.format('Source index', 'Status',
+                                               'Documents', 'Seconds'))
+    for index_name, result in results.items():
+        print('{:<50} {:>10} {:>12} {:>10}'.format(
+            index_name, result['status'], result.get('success', '-'),
+            result['seconds']))
+        if result['status'] == 'failed':
+            print('    {}'.format(result['error']))
+
+
+def run_per_index(args):
+    plan = reindex.plan_sources(args.url, args.source_index_name)
+    print_sources(plan)
+    if args.plan:
+        return
+    res = input('Is this what you want? Type "yes" if you are sure: ')
+    if res != 'yes':
+        return
+
+    # The memory budget is shared by the source indexes that run together.
+    max_memory = get_max_memory(args)
+    if max_memory:
+        max_memory //= args.max_parallel
+    slices_per_index = args.scan_workers if args.scan_workers > 1 else None
+
+    start = time.time()
+    results = reindex.pattern_reindex(
+        args.url, args.source_index_name, args.target_index_name,
+        max_parallel=args.max_parallel,
+        max_slices=args.max_slices,
+        slices_per_index=slices_per_index,
+        max_connections=args.max_connections,
+        engine_factory=get_engine_factory(args, max_memory),
+        plan=plan,
+        precreate=args.precreate,
+        docs_per_shard=args.docs_per_shard,
+        max_shards=args.max_shards,
+        optimize_ingest=args.optimize_ingest,
+        force_merge=args.force_merge,
+        dead_letter_path=args.dead_letter_file,
+        date_field=args.datefield,
+        delete_docs=args.deletedoc,
+        source_include=parse_list(args.include),
+        source_exclude=parse_list(args.exclude),
+        transform=parse_json(args.transform),
+        group_buffer=args.group_buffer,
+        max_memory=max_memory,
+        doc_transform=args.doc_transform,
+        processes=args.processes,
+        bulk_threads=args.bulk_threads)
+    print_results(results)
+    success = sum(r.get('success', 0) for r in results.values())
+    estimate.record_throughput('reindex', success, time.time() - start)
+    if any(r['status'] == 'failed' for r in results.values()):
+        sys.exit(1)
 
 
 def run(args):
-    if args.datefield:
+    if args.estimate:
+        print_estimate(estimate.estimate(
+            args.url, 'reindex', args.source_index_name,
+            target_index_name=args.target_index_name,
+            date_field=args.datefield, delete_docs=args.deletedoc))
+        return
+
+    if args.per_index:
+        run_per_index(args)
+        return
+
+    plan = None
+    if args.plan or args.precreate:
+        plan = reindex.plan_targets(args.url, args.source_index_name,
+                                    args.target_index_name,
+                                    date_field=args.datefield)
+        print_plan(plan, args.docs_per_shard, args.max_shards)
+        if args.plan:
+            return
+        res = input('Is this what you want? Type "yes" if you are sure: ')
+        if res != 'yes':
+            return
+    elif args.datefield:
         example = args.target_index_name.format(datetime.datetime.now())
         print('Target index name would be for example: {}'.format(example))
         res = input('Is this what you want? Type "yes" if you are sure: ')
         if res != 'yes':
             return
 
-    reindex.date_reindex(args.url, args.source_index_name,
-                         args.target_index_name, date_field=args.datefield,
-                         delete_docs=args.deletedoc)
+    start = time.time()
+    success, _ = reindex.date_reindex(
+        args.url, args.source_index_name,
+        args.target_index_name, date_field=args.datefield,
+        delete_docs=args.deletedoc,
+        source_include=parse_list(args.include),
+        source_exclude=parse_list(args.exclude),
+        transform=parse_json(args.transform),
+        optimize_ingest=args.optimize_ingest,
+        force_merge=args.force_merge,
+        precreate=args.precreate,
+        plan=plan,
+        docs_per_shard=args.docs_per_shard,
+        max_shards=args.max_shards,
+        group_buffer=args.group_buffer,
+        scan_engine=get_scan_engine(args),
+        max_memory=get_max_memory(args),
+        doc_transform=args.doc_transform,
+        processes=args.processes,
+        bulk_threads=args.bulk_threads,
+        dead_letter_path=args.dead_letter_file)
+    estimate.record_throughput('reindex', success, time.time() - start)
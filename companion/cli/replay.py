@@ -0,0 +1,17 @@
+"""This command sends the failed actions of a dead letter file again.
+
+For Example:
+
+    >>> companion reindex event event2 --dead-letter-file event.failed
+    >>> companion replay event.failed
+
+"""
+from ..api import replay
+
+
+def run(args):
+    success, failed = replay.replay(args.url, args.dead_letter_file,
+                                    dead_letter_path=args.output,
+                                    max_retries=args.max_retries)
+    print('Replayed {} actions, {} failed again'.format(success + failed,
+                                                        failed))
@@ -0,0 +1,25 @@
+"""This command runs a job service, which runs jobs that are submitted over
+an HTTP/JSON API with warm connections. See :mod:`companion.api.server` for
+the API.
+
+For Example:
+
+    >>> companion serve --port 9250 --max-jobs 8
+    >>> curl -XPOST localhost:9250/jobs -d '{"type": "health"}'
+
+"""
+from ..api import server
+from .jobs import get_limits
+
+
+def run(args):
+    kwargs = {'host': args.host, 'port': args.port,
+              'limits': get_limits(args), 'max_finished': args.max_finished}
+    try:
+        if args.output:
+            with open(args.output, 'a') as output:
+                server.serve(args.url, output=output, **kwargs)
+        else:
+            server.serve(args.url, **kwargs)
+    except KeyboardInterrupt:
+        pass
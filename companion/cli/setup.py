@@ -1,14 +1,56 @@
-"""Setup command."""
+"""Setup command.
+
+For Example:
+
+    >>> companion setup -p ./data
+    >>> companion setup -c http://eu:9200 -c http://us:9200
+    >>> companion setup --inventory clusters.txt --max-clusters 12
+
+"""
+import sys
+import collections
+
 from ..api import setup
 
 
+def get_clusters(args):
+    """The clusters of the arguments, by name."""
+    clusters = collections.OrderedDict()
+    if args.inventory:
+        clusters.update(setup.load_inventory(args.inventory))
+    for url in args.cluster or []:
+        clusters[url] = url
+    return clusters or {args.url: args.url}
+
+
+def print_summary(results):
+    kinds = ['indexes_deleted', 'indexes_created', 'indexes_existing',
+             'mappings', 'templates', 'scripts']
+    print('{:<30} {:<10} {:>7} {:>8} {:>8} {:>8} {:>9} {:>7} {:>8}'.format(
+        'Cluster', 'Status', 'Deleted', 'Created', 'Existing', 'Mappings',
+        'Templates', 'Scripts', 'Seconds'))
+    for name, result in results.items():
+        changes = result.get('changes', {})
+        print('{:<30} {:<10} {:>7} {:>8} {:>8} {:>8} {:>9} {:>7} {:>8.1f}'
+              .format(name, result['status'],
+                      *[changes.get(kind, 0) for kind in kinds],
+                      result['seconds']))
+        if 'error' in result:
+            print('  {}'.format(result['error']))
+
+
 def run(args):
+    clusters = get_clusters(args)
     if args.reset:
         # Prompt the user to be extra sure.
-        res = input('THIS WILL DELETE ALL DATA! Type "yes" if you are sure: ')
+        res = input('THIS WILL DELETE ALL DATA ON {} CLUSTER(S)! Type "yes" '
+                    'if you are sure: '.format(len(clusters)))
         if res != 'yes':
             return
-    im = setup.IndexMapper(args.url,
-                           data_path=args.data_path,
-                           delete_indexes=args.reset)
-    im.run()
+    results = setup.setup_clusters(clusters, data_path=args.data_path,
+                                   delete_indexes=args.reset,
+                                   max_clusters=args.max_clusters,
+                                   max_requests=args.max_requests)
+    print_summary(results)
+    if any(result['status'] == 'failed' for result in results.values()):
+        sys.exit(1)
@@ -0,0 +1,29 @@
+"""These commands export indexes as NDJSON and import them again.
+
+For Example:
+
+    >>> companion export event | jq -c 'select(._source.n > 1)' > event.ndjson
+    >>> companion export event -o event.ndjson.gz --parts 4
+    >>> companion import event.part*.ndjson.gz -i event2
+    >>> gunzip -c event.ndjson.gz | companion import -
+
+"""
+from ..api import stream, estimate
+from .util import parse_json, get_scan_engine, print_estimate
+
+
+def export_run(args):
+    query = parse_json(args.query)
+    if args.estimate:
+        print_estimate(estimate.estimate(args.url, 'backup', args.index_name,
+                                         query=query, doc_type=args.doc_type))
+        return
+    stream.export(args.url, args.index_name, output=args.output,
+                  query=query, doc_type=args.doc_type,
+                  parts=args.parts, compress=args.compress or None,
+                  scan_engine=get_scan_engine(args))
+
+
+def import_run(args):
+    stream.import_files(args.url, args.files, index_name=args.index_name,
+                        bulk_threads=args.bulk_threads)
@@ -0,0 +1,88 @@
+"""This command updates fields of documents in place.
+
+By default, the update runs on the cluster with _update_by_query, in as many
+slices as --scan-workers and throttled to --max-docs-per-sec. The other
+scan, memory and throttle options are rejected in this mode:
+
+    >>> companion update myindex --script \
+    >>> 'ctx._source.views = params.views' --params '{"views": 0}' \
+    >>> -q '{"query":{"term":{"type":"click"}}}' --scan-workers 5
+
+With --client-side, the documents are scanned and updated with partial
+update actions in bulk requests, with a script, a partial document or an
+update function:
+
+    >>> companion update myindex --client-side --doc '{"archived": true}'
+    >>> companion update myindex --client-side --update-func mymodule:update
+
+"""
+import time
+
+from ..api import update, util, estimate
+from .util import parse_json, get_scan_engine, get_max_memory, print_estimate
+
+
+def get_script(args):
+    """The update script of the arguments, or None."""
+    if args.script is None:
+        return None
+    script = {'inline': args.script, 'lang': args.lang}
+    params = parse_json(args.params)
+    if params:
+        script['params'] = params
+    return script
+
+
+def get_client_side_options(args):
+    """The given options that only apply to updates with --client-side."""
+    options = []
+    if args.scan_engine != 'scroll':
+        options.append('--scan-engine')
+    for name in ('sort_field', 'max_memory', 'max_mb_per_sec',
+                 'adaptive_throttle', 'throttle_file', 'doc', 'update_func',
+                 'dead_letter_file'):
+        if getattr(args, name):
+            options.append('--' + name.replace('_', '-'))
+    return options
+
+
+def run(args):
+    query = parse_json(args.query)
+    if args.estimate:
+        print_estimate(estimate.estimate(args.url, 'update', args.index_name,
+                                         query=query, doc_type=args.doc_type))
+        return
+
+    script = get_script(args)
+    doc = parse_json(args.doc)
+    if not args.client_side and script is None:
+        print('Updates on the cluster need a --script')
+        return
+    options = [] if args.client_side else get_client_side_options(args)
+    if options:
+        print('{} only apply with --client-side'.format(', '.join(options)))
+        return
+
+    client = util.get_client(args.url)
+    cnt = client.count(index=args.index_name, doc_type=args.doc_type,
+                       body=query)
+    print('Will update {} documents'.format(cnt['count']))
+    res = input('Does this look correct? Type "yes" if you are sure: ')
+    if res != 'yes':
+        return
+
+    start = time.time()
+    if args.client_side:
+        updated, _ = update.bulk_update(
+            args.url, args.index_name, script=script, doc=doc,
+            update_func=args.update_func, query=query,
+            doc_type=args.doc_type, scan_engine=get_scan_engine(args),
+            max_memory=get_max_memory(args),
+            dead_letter_path=args.dead_letter_file)
+    else:
+        response = update.update_by_query(
+            args.url, args.index_name, script, query=query,
+            doc_type=args.doc_type, slices=args.scan_workers,
+            requests_per_second=args.max_docs_per_sec)
+        updated = response.get('updated', 0)
+    estimate.record_throughput('update', updated, time.time() - start)
@@ -0,0 +1,112 @@
+"""Helpers for parsing command-line arguments."""
+import os
+import json
+import signal
+import datetime
+
+from ..api import scan, pipeline, throttle, util
+
+MB = 1024 * 1024
+
+
+def parse_json(value):
+    """Parse a JSON argument.
+
+    :param value: A JSON compatible string or a filename.
+    :type value: str
+    :returns: The parsed value, or None if value is None.
+
+    """
+    if value is None:
+        return value
+
+    # If the value is actually a file, load it.
+    # Otherwise assume it is a JSON string.
+    if os.path.isfile(value):
+        with open(value) as f:
+            return json.loads(f.read())
+    return json.loads(value)
+
+
+def parse_list(value):
+    """Parse a comma separated argument such as "field1,field2.*".
+
+    :returns: A list of the non-empty items, or None if value is None.
+
+    """
+    if value is None:
+        return value
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def get_max_memory(args):
+    """The memory budget of the scan arguments in bytes, or None."""
+    if not args.max_memory:
+        return None
+    return args.max_memory * MB
+
+
+def print_estimate(result):
+    """Print the result of :func:`companion.api.estimate.estimate`."""
+    if result['targets']:
+        print('{:<50} {:>12} {:>10}'.format('Target', 'Documents', 'MB'))
+        for name, docs, size in result['targets']:
+            print('{:<50} {:>12} {:>10.1f}'.format(name, docs, size / MB))
+    print('{} documents of ~{:.0f} bytes, {:.1f} MB to transfer in {} bulk '
+          'requests'.format(result['docs'], result['avg_doc_bytes'],
+                            result['bytes'] / MB, result['bulk_requests']))
+    if result['seconds'] is None:
+        print('No earlier runs to estimate the duration from')
+    else:
+        print('Estimated duration: {}'.format(
+            datetime.timedelta(seconds=round(result['seconds']))))
+
+
+def get_throttle(args):
+    """Create the throttle of the scan arguments, or None. A SIGHUP makes
+    the throttle read its control file again.
+
+    """
+    bytes_per_sec = None
+    if args.max_mb_per_sec:
+        bytes_per_sec = args.max_mb_per_sec * MB
+    job_throttle = throttle.Throttle(
+        docs_per_sec=args.max_docs_per_sec,
+        bytes_per_sec=bytes_per_sec,
+        client=util.get_client(args.url) if args.adaptive_throttle else None,
+        adaptive=args.adaptive_throttle,
+        control_file=args.throttle_file)
+    if not job_throttle.active:
+        return None
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda *_: job_throttle.reload())
+    return job_throttle
+
+
+def get_engine_factory(args, max_memory=None):
+    """A function that takes a number of workers and creates the scan engine
+    selected with the scan arguments. All engines share one throttle.
+
+    :param max_memory: The memory budget of each engine in bytes. Default is
+        the --max-memory argument.
+    :type max_memory: int
+
+    """
+    max_bytes = None
+    limits = pipeline.memory_limits(max_memory or get_max_memory(args))
+    if limits is not None:
+        max_bytes = limits.scan_bytes
+    job_throttle = get_throttle(args)
+
+    def _create(workers):
+        engine = scan.get_engine(args.scan_engine, sort_field=args.sort_field,
+                                 workers=workers, max_bytes=max_bytes)
+        if job_throttle is not None:
+            engine = throttle.ThrottledEngine(engine, job_throttle)
+        return engine
+    return _create
+
+
+def get_scan_engine(args):
+    """Create the scan engine selected with the scan arguments."""
+    return get_engine_factory(args)(args.scan_workers)
@@ -0,0 +1,40 @@
+"""This command verifies that a re-index copied all documents. It compares
+document counts and content hashes per target index, and lists the
+documents that differ.
+
+For Example:
+
+    >>> companion verify event event-{:%Y-%m-%d} -d timestamp
+
+"""
+import sys
+
+from ..api import verify
+from .util import parse_json
+
+
+def run(args):
+    result = verify.verify(args.url, args.source_index_name,
+                           args.target_index_name, date_field=args.datefield,
+                           query=parse_json(args.query), slices=args.slices,
+                           ids_only=args.ids_only)
+
+    print('{:<50} {:>12} {:>12} {:>6}'.format('Target index', 'Source',
+                                              'Target', 'Match'))
+    for name, bucket in sorted(result['buckets'].items()):
+        if bucket['match'] and not args.all:
+            continue
+        print('{:<50} {:>12} {:>12} {:>6}'.format(
+            name, bucket['source_count'], bucket['target_count'],
+            'yes' if bucket['match'] else 'NO'))
+
+    for kind in ('missing', 'extra', 'changed'):
+        for index_name, doc_type, doc_id in result[kind]:
+            print('{} {}/{}/{}'.format(kind, index_name, doc_type, doc_id))
+
+    if result['match']:
+        print('All {} target indexes match'.format(len(result['buckets'])))
+    else:
+        print('Differences found: {missing} missing, {extra} extra and '
+              '{changed} changed documents'.format(**result['counts']))
+        sys.exit(1)
@@ -1,8 +1,10 @@
 """Testing."""
 import os
+import json
 import datetime
 
 from elasticsearch import Elasticsearch
+from elasticsearch.connection import Connection
 
 
 es_url = os.environ.get('ELASTICSEARCH_URL', 'http://localhost:9200')
@@ -52,3 +54,57 @@ def create_test_data():
               })
 
     es.indices.refresh(index='companiontest')
+
+
+class BulkConnection(Connection):
+    """Answers bulk requests without a cluster, so that the bodies go through
+    the body handling of the real client.
+
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.bodies = []
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        from companion.api import pipeline
+        self.bodies.append(body)
+        actions = pipeline._body_actions(body)
+        items = [{action['_op_type']: {'status': 201}} for action in actions]
+        return 200, {}, json.dumps({'items': items})
+
+
+def bulk_client():
+    """A client that sends bulk requests to a :class:`BulkConnection`."""
+    return Elasticsearch('http://localhost:1', connection_class=BulkConnection)
+
+
+class HealthConnection(Connection):
+    """Answers cluster health requests like Elasticsearch does while a
+    wait_for_status times out, with a 408 and timed_out in the body. The
+    status is reached after timeouts requests, or never if it is None.
+
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.timeouts = None
+        self.requests = 0
+
+    def perform_request(self, method, url, params=None, body=None,
+                        timeout=None, ignore=()):
+        self.requests += 1
+        timed_out = self.timeouts is None or self.requests <= self.timeouts
+        status = 408 if timed_out else 200
+        data = json.dumps({'status': 'red' if timed_out else 'green',
+                           'timed_out': timed_out})
+        if status != 200 and status not in ignore:
+            self._raise_error(status, data)
+        return status, {}, data
+
+
+def health_client(timeouts=None):
+    """A client that sends health requests to a :class:`HealthConnection`."""
+    client = Elasticsearch('http://localhost:1',
+                           connection_class=HealthConnection)
+    client.transport.get_connection().timeouts = timeouts
+    return client
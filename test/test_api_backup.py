@@ -2,11 +2,12 @@
 import os
 import json
 import shutil
+import datetime
 import tempfile
-from unittest import TestCase
+from unittest import TestCase, mock
 
 from companion import error
-from companion.api import backup, util
+from companion.api import backup, storage, util
 
 from . import create_test_data, es_url
 
@@ -105,3 +106,78 @@ class TestFetchAndTar(TempfileTestCase):
         tar2 = os.path.join(tmpdir, 'companiontest_advanced.tar.gz')
         self.assertIn(tar1, tarfiles)
         self.assertIn(tar2, tarfiles)
+
+
+class TestReadArchive(TempfileTestCase):
+
+    def test_zip_and_tar(self):
+        """It should read the hits from zip and tar.gz archives."""
+        hit = {
+            '_id': 'abcd',
+            '_index': 'myindex',
+            '_type': 'mytype',
+            '_source': {
+                'myfield': 'myvalue'
+            }
+        }
+        doc_path = backup._save_hit(self.tmpdir, hit)
+        index_dir = os.path.dirname(doc_path)
+        tar_path = util.tar_gz_directory(index_dir, self.tmpdir)
+        zip_path = util.zip_directory(index_dir, self.tmpdir)
+        self.assertEqual(list(backup._read_archive(tar_path)), [hit])
+        self.assertEqual(list(backup._read_archive(zip_path)), [hit])
+
+
+class TestBackupNames(TempfileTestCase):
+    def _fetch(self, url, index_name, **kwargs):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, '{}_0.zip'.format(index_name))
+        with open(path, 'wb') as f:
+            f.write(b'data')
+        return tmpdir, [path]
+
+    def test_successive_backups(self):
+        """It should name each backup after the time it was made."""
+        times = [datetime.datetime(2017, 1, 2, 12, 0, 0),
+                 datetime.datetime(2017, 1, 2, 13, 0, 0)]
+        target = storage.LocalStorage(self.tmpdir)
+        with mock.patch.object(backup, '_fetch_and_zip', self._fetch), \
+                mock.patch('datetime.datetime', mock.Mock(
+                    utcnow=mock.Mock(side_effect=times))):
+            names = [backup.backup(es_url, 'event', target)
+                     for _ in times]
+        self.assertEqual(names, ['clibackup/2017/01/02_120000',
+                                 'clibackup/2017/01/02_130000'])
+        self.assertEqual(sorted(target.list('clibackup')),
+                         ['clibackup/2017/01/02_120000_event_0.zip',
+                          'clibackup/2017/01/02_130000_event_0.zip'])
+
+
+class TestLocalBackupRestore(TempfileTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontesttarget', ignore=[404])
+
+    def test_backup_restore(self):
+        """It should restore a local backup to another index."""
+        create_test_data()
+        backup_name = backup.local(es_url, 'companiontest', self.tmpdir)
+        backup.restore(es_url, storage.LocalStorage(self.tmpdir), backup_name,
+                       index_name='companiontesttarget')
+        self.client.indices.refresh(index='companiontesttarget')
+        cnt = self.client.count(index='companiontesttarget')
+        self.assertEqual(cnt['count'], 4)
+
+    def test_source_exclude(self):
+        """It should not backup excluded fields."""
+        create_test_data()
+        backup_name = backup.local(es_url, 'companiontest', self.tmpdir,
+                                   source_exclude=['timestamp'])
+        backup.restore(es_url, storage.LocalStorage(self.tmpdir), backup_name,
+                       index_name='companiontesttarget')
+        doc = self.client.get(index='companiontesttarget',
+                              doc_type='simple',
+                              id='foo')
+        self.assertEqual(doc['_source'], {'id': 'foo'})
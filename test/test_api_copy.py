@@ -0,0 +1,130 @@
+"""Cross-cluster copy test functions."""
+import json
+from unittest import TestCase, mock
+
+from companion.api import copy, util
+
+from . import create_test_data, es_url, bulk_client
+
+RESPONSE = r'''{"_scroll_id":"abc","took":1,"hits":{"total":2,"max_score":null,
+"hits": [ {"_index":"i","_type":"t","_id":"1","_score":null,
+"_source":{"text":"a \"quoted\" }] brace","n":[1, 2.50]},"sort":[0]},
+{"_index":"i","_type":"t","_id":"2","_routing":"r","_source" : {}} ]}}'''
+
+
+class TestRawHits(TestCase):
+    def test_raw_hits(self):
+        """It should split the hits without decoding the sources."""
+        hits = copy._raw_hits(RESPONSE)
+        self.assertEqual(len(hits), 2)
+        meta, source = hits[0]
+        self.assertEqual(meta['_id'], '1')
+        self.assertEqual(meta['sort'], [0])
+        self.assertEqual(source, r'{"text":"a \"quoted\" }] brace",'
+                                 r'"n":[1, 2.50]}')
+        self.assertEqual(hits[1], ({'_index': 'i', '_type': 't', '_id': '2',
+                                    '_routing': 'r'}, '{}'))
+
+    def test_no_hits(self):
+        """It should return no hits for empty pages."""
+        self.assertEqual(copy._raw_hits('{"hits":{"hits":[]}}'), [])
+
+    def test_bulk_body(self):
+        """It should build index actions with the original sources."""
+        body = copy._bulk_body(copy._raw_hits(RESPONSE), 'target')
+        lines = body.splitlines()
+        self.assertEqual(json.loads(lines[0]),
+                         {'index': {'_index': 'target', '_type': 't',
+                                    '_id': '1'}})
+        self.assertIn('2.50', lines[1])
+        self.assertEqual(json.loads(lines[2]),
+                         {'index': {'_index': 'target', '_type': 't',
+                                    '_id': '2', '_routing': 'r'}})
+
+
+class TestCopy(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontesttarget*', ignore=[404])
+        create_test_data()
+
+    def check_copy(self, raw):
+        copied = copy.copy(es_url, es_url, 'companiontest',
+                           'companiontesttarget', slices=2, raw=raw)
+        self.assertEqual(copied, 4)
+        self.client.indices.refresh(index='companiontesttarget')
+        doc = self.client.get(index='companiontesttarget', doc_type='simple',
+                              id='foo')
+        self.assertEqual(doc['_source']['id'], 'foo')
+
+    def test_copy(self):
+        """It should copy all documents"""
+        self.check_copy(raw=False)
+
+    def test_copy_raw(self):
+        """It should copy all documents without decoding them"""
+        self.check_copy(raw=True)
+
+
+class FakeConnection:
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.requests = []
+
+    def perform_request(self, method, url, params=None, body=None):
+        self.requests.append((method, url, params, json.loads(body)))
+        hits = self.pages.pop(0) if self.pages else []
+        text = json.dumps({'_scroll_id': 'scroll{}'.format(len(self.pages)),
+                           'hits': {'hits': hits}})
+        return 200, {}, text
+
+
+class FakeClient:
+    def __init__(self, pages=()):
+        self.connection = FakeConnection(pages)
+        self.transport = self
+        self.cleared = []
+        self.bodies = []
+
+    def get_connection(self):
+        return self.connection
+
+    def clear_scroll(self, body, ignore=()):
+        self.cleared.extend(body['scroll_id'])
+
+    def bulk(self, body, filter_path=None):
+        self.bodies.append(body)
+        items = body.splitlines()[::2]
+        return {'items': [{'index': {'status': 201}} for _ in items]}
+
+
+class TestRawCopy(TestCase):
+    def test_raw_copy(self):
+        """It should scroll the source and write the pages to the target."""
+        pages = [[{'_index': 'i', '_type': 't', '_id': str(n),
+                   '_source': {'n': n}} for n in range(p * 3, p * 3 + 3)]
+                 for p in range(2)]
+        source, target = FakeClient(pages), FakeClient()
+        clients = {'http://source': source, 'http://target': target}
+        with mock.patch('companion.api.util.get_client', clients.get):
+            copied = copy.copy('http://source', 'http://target', 'i',
+                               slices=1, raw=True)
+        self.assertEqual(copied, 6)
+        self.assertEqual(len(target.bodies), 2)
+        self.assertEqual(source.connection.requests[1][3]['scroll_id'],
+                         'scroll1')
+        self.assertEqual(source.cleared, ['scroll0'])
+
+    def test_client_bulk(self):
+        """It should send the bodies through the bulk API of the client."""
+        pages = [[{'_index': 'i', '_type': 't', '_id': str(n),
+                   '_source': {'n': n}} for n in range(3)]]
+        source, target = FakeClient(pages), bulk_client()
+        clients = {'http://source': source, 'http://target': target}
+        with mock.patch('companion.api.util.get_client', clients.get):
+            copied = copy.copy('http://source', 'http://target', 'i',
+                               slices=1, raw=True)
+        self.assertEqual(copied, 3)
+        body, = target.transport.get_connection().bodies
+        self.assertEqual(body.decode('utf-8').count('\n'), 6)
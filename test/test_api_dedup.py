@@ -0,0 +1,98 @@
+"""Deduplicated backup test functions."""
+import shutil
+import tempfile
+from unittest import TestCase
+
+from companion.api import dedup, storage, util
+
+from . import create_test_data, es_url
+
+
+def make_hits(count):
+    return [{'_index': 'myindex', '_type': 'mytype', '_id': str(i),
+             '_source': {'value': i}} for i in range(count)]
+
+
+class TestChunkHits(TestCase):
+    def test_all_hits(self):
+        """It should return all hits in order."""
+        hits = make_hits(500)
+        chunks = list(dedup._chunk_hits(hits, avg_chunk_docs=10))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual([h for c in chunks for h in c], hits)
+
+    def test_max_chunk_docs(self):
+        """It should not create chunks larger than the maximum."""
+        chunks = dedup._chunk_hits(make_hits(500), avg_chunk_docs=1000,
+                                   max_chunk_docs=7)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 7)
+
+    def test_stable_boundaries(self):
+        """It should only change the chunk of an inserted document."""
+        hits = make_hits(500)
+        before = [dedup._serialize_chunk(c)
+                  for c in dedup._chunk_hits(hits, avg_chunk_docs=10)]
+        hits.insert(250, {'_index': 'myindex', '_type': 'mytype',
+                          '_id': 'new', '_source': {}})
+        after = [dedup._serialize_chunk(c)
+                 for c in dedup._chunk_hits(hits, avg_chunk_docs=10)]
+        self.assertLessEqual(len(set(after) - set(before)), 2)
+
+
+class TestGc(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storage = storage.LocalStorage(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_gc(self):
+        """It should only delete chunks without a manifest."""
+        self.storage.put(dedup._chunk_key('aaaa'), b'')
+        self.storage.put(dedup._chunk_key('bbbb'), b'')
+        self.storage.put('manifests/myindex/1.json',
+                         b'{"chunks": [{"id": "aaaa"}]}')
+
+        unreferenced = dedup.gc(self.storage, dry_run=True)
+        self.assertEqual(unreferenced, [dedup._chunk_key('bbbb')])
+        self.assertTrue(self.storage.exists(dedup._chunk_key('bbbb')))
+
+        dedup.gc(self.storage)
+        self.assertFalse(self.storage.exists(dedup._chunk_key('bbbb')))
+        self.assertTrue(self.storage.exists(dedup._chunk_key('aaaa')))
+
+
+class TestBackupRestore(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storage = storage.LocalStorage(self.tmpdir)
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontesttarget', ignore=[404])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_not_exists(self):
+        """It should not crash on indexes that do not exist."""
+        self.assertIsNone(dedup.backup(es_url, 'fooindexname', self.storage))
+
+    def test_backup_twice(self):
+        """It should not store unchanged chunks again."""
+        create_test_data()
+        dedup.backup(es_url, 'companiontest', self.storage, name='1')
+        chunks = self.storage.list(dedup.CHUNK_PREFIX)
+        dedup.backup(es_url, 'companiontest', self.storage, name='2')
+        self.assertEqual(self.storage.list(dedup.CHUNK_PREFIX), chunks)
+        self.assertEqual(len(dedup.list_manifests(self.storage)), 2)
+
+    def test_restore(self):
+        """It should restore all documents."""
+        create_test_data()
+        manifest_key = dedup.backup(es_url, 'companiontest', self.storage)
+        dedup.restore(es_url, self.storage, manifest_key,
+                      index_name='companiontesttarget')
+        self.client.indices.refresh(index='companiontesttarget')
+        cnt = self.client.count(index='companiontesttarget')
+        self.assertEqual(cnt['count'], 4)
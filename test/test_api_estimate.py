@@ -0,0 +1,64 @@
+"""Estimate test functions."""
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from companion.api import estimate, util
+
+from . import create_test_data, es_url
+
+
+class TestParallel(TestCase):
+    def test_parallel(self):
+        """It should return the results by name."""
+        self.assertEqual(estimate.parallel({'a': lambda: 1, 'b': lambda: 2}),
+                         {'a': 1, 'b': 2})
+
+
+class TestThroughput(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sub', 'throughput.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_record(self):
+        """It should average the throughput of the runs."""
+        self.assertEqual(estimate.load_throughput(self.path), {})
+        estimate.record_throughput('reindex', 1000, 10, path=self.path)
+        estimate.record_throughput('reindex', 3000, 10, path=self.path)
+        estimate.record_throughput('delete', 0, 10, path=self.path)
+        self.assertEqual(estimate.load_throughput(self.path),
+                         {'reindex': {'docs_per_sec': 200, 'runs': 2}})
+
+
+class TestEstimate(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'throughput.json')
+        create_test_data()
+        util.get_client(es_url).indices.refresh(index='companiontest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reindex(self):
+        """It should estimate the targets of a re-index"""
+        estimate.record_throughput('reindex', 100, 1, path=self.path)
+        result = estimate.estimate(es_url, 'reindex', 'companiontest',
+                                   target_index_name='target-{:%Y-%m-%d}',
+                                   date_field='timestamp', delete_docs=True,
+                                   history_path=self.path)
+        self.assertEqual(result['docs'], 4)
+        self.assertEqual(result['bulk_requests'], 1)
+        self.assertEqual(len(result['targets']), 3)
+        self.assertAlmostEqual(result['seconds'], 0.04)
+
+    def test_delete(self):
+        """It should estimate a delete without earlier runs"""
+        result = estimate.estimate(es_url, 'delete', 'companiontest',
+                                   history_path=self.path)
+        self.assertEqual(result['docs'], 4)
+        self.assertIsNone(result['seconds'])
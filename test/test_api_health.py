@@ -0,0 +1,59 @@
+"""Health test functions."""
+from unittest import TestCase, mock
+
+from companion.api import health
+
+from . import es_url, health_client
+
+
+class TestDiff(TestCase):
+    def test_no_changes(self):
+        """It should return no changes for equal snapshots."""
+        snapshot = {'status': 'green', 'indices': {'a': {'status': 'green'}}}
+        self.assertEqual(health.diff(snapshot, snapshot), [])
+
+    def test_nested_changes(self):
+        """It should return changed nested values with dotted keys."""
+        old = {'status': 'green',
+               'indices': {'a': {'shards': {'0': {'status': 'green'}}}}}
+        new = {'status': 'yellow',
+               'indices': {'a': {'shards': {'0': {'status': 'yellow'}}}}}
+        self.assertEqual(health.diff(old, new), [
+            ('indices.a.shards.0.status', 'green', 'yellow'),
+            ('status', 'green', 'yellow')
+        ])
+
+    def test_added_removed(self):
+        """It should include added and removed indices."""
+        old = {'indices': {'a': {'status': 'green'}}}
+        new = {'indices': {'b': {'status': 'red'}}}
+        self.assertEqual(health.diff(old, new), [
+            ('indices.a.status', 'green', None),
+            ('indices.b.status', None, 'red')
+        ])
+
+
+class TestWaitForStatus(TestCase):
+    def test_wait_for_red(self):
+        """It should return right away when the status is reached."""
+        self.assertTrue(health.wait_for_status(es_url, 'red', timeout=1))
+
+    def test_watch(self):
+        """It should poll the given number of times."""
+        health.watch(es_url, level='shards', interval=0, iterations=2)
+
+
+class TestWaitForStatusTimeout(TestCase):
+    def _wait(self, client, **kwargs):
+        with mock.patch('companion.api.util.get_client', return_value=client):
+            return health.wait_for_status('url', 'green', timeout=1, **kwargs)
+
+    def test_retry(self):
+        """It should poll again when a wait times out."""
+        client = health_client(timeouts=2)
+        self.assertTrue(self._wait(client))
+        self.assertEqual(client.transport.get_connection().requests, 3)
+
+    def test_max_wait(self):
+        """It should return False when max_wait passes."""
+        self.assertFalse(self._wait(health_client(), max_wait=0.01))
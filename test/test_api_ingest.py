@@ -0,0 +1,121 @@
+"""Ingest settings test functions."""
+from unittest import TestCase
+
+from elasticsearch import TransportError
+
+from companion.api import ingest, util
+
+from . import es_url, health_client
+
+
+class TestIngestSettings(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontesttarget*', ignore=[404])
+        self.client.indices.create(index='companiontesttarget',
+                                   body={
+                                       'index': {
+                                           'number_of_replicas': 0,
+                                           'refresh_interval': '5s'
+                                       }
+                                   })
+
+    def get_settings(self, index_name):
+        res = self.client.indices.get_settings(index=index_name)
+        return res[index_name]['settings']['index']
+
+    def test_prepare_restore(self):
+        """It should apply ingest settings and restore the originals."""
+        with ingest.IngestSettings(self.client,
+                                   wait_for_status='yellow') as settings:
+            settings.prepare('companiontesttarget')
+            self.assertEqual(
+                self.get_settings('companiontesttarget')['refresh_interval'],
+                '-1')
+
+        index_settings = self.get_settings('companiontesttarget')
+        self.assertEqual(index_settings['refresh_interval'], '5s')
+        self.assertEqual(index_settings['number_of_replicas'], '0')
+
+    def test_create_missing(self):
+        """It should create missing indexes and restore default settings."""
+        with ingest.IngestSettings(self.client,
+                                   wait_for_status=None) as settings:
+            settings.prepare('companiontesttarget-new')
+            self.assertTrue(
+                self.client.indices.exists(index='companiontesttarget-new'))
+
+        index_settings = self.get_settings('companiontesttarget-new')
+        self.assertNotIn('refresh_interval', index_settings)
+
+    def test_restore_on_error(self):
+        """It should restore settings when an error occurs."""
+        with self.assertRaises(ValueError):
+            with ingest.IngestSettings(self.client,
+                                       wait_for_status=None) as settings:
+                settings.prepare('companiontesttarget')
+                raise ValueError()
+
+        index_settings = self.get_settings('companiontesttarget')
+        self.assertEqual(index_settings['refresh_interval'], '5s')
+
+
+class FakeIndices:
+    def __init__(self, create_error):
+        self.create_error = create_error
+
+    def create(self, index):
+        raise TransportError(400, self.create_error)
+
+    def get_settings(self, index, name):
+        return {index: {'settings': {'index': {'refresh_interval': '5s'}}}}
+
+    def put_settings(self, index, body):
+        pass
+
+    def forcemerge(self, **kwargs):
+        raise TransportError('N/A', 'timed out')
+
+
+class FakeClient:
+    def __init__(self, create_error='resource_already_exists_exception'):
+        self.indices = FakeIndices(create_error)
+        # Health waits always time out with a 408.
+        self.cluster = health_client().cluster
+
+
+class TestIngestSettingsErrors(TestCase):
+    def test_invalid_create(self):
+        """It should only ignore errors for indexes that already exist."""
+        settings = ingest.IngestSettings(
+            FakeClient('illegal_argument_exception'), wait_for_status=None)
+        with self.assertRaises(TransportError):
+            settings.prepare('target')
+
+        settings = ingest.IngestSettings(FakeClient(), wait_for_status=None)
+        settings.prepare('target')
+        self.assertIn('target', settings.original)
+
+    def test_failed_restore_on_error(self):
+        """It should raise the original error when the restore fails."""
+        with self.assertRaises(ValueError):
+            with ingest.IngestSettings(FakeClient(),
+                                       force_merge=1) as settings:
+                settings.prepare('target')
+                raise ValueError()
+
+    def test_failed_restore(self):
+        """It should raise errors of the restore without another error."""
+        with self.assertRaises(TransportError):
+            with ingest.IngestSettings(FakeClient(),
+                                       force_merge=1) as settings:
+                settings.prepare('target')
+
+    def test_health_timeout(self):
+        """It should warn when the health wait times out."""
+        with self.assertLogs('companion.api.ingest', 'WARNING') as logs:
+            with ingest.IngestSettings(FakeClient()) as settings:
+                settings.prepare('target')
+        self.assertIn('Timed out waiting for status green, status is red',
+                      logs.output[-1])
@@ -0,0 +1,195 @@
+"""Job runner test functions."""
+import io
+import os
+import json
+import shutil
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from companion import error
+from companion.api import jobs
+
+
+class FakeJobs:
+    """Fake job types that record their calls."""
+    def __init__(self):
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, url, args, scan_engine):
+        with self.lock:
+            self.calls.append(args['name'])
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            if args.get('fail'):
+                raise ValueError('failed on purpose')
+            threading.Event().wait(0.05)
+            return args['name']
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def job(job_id, depends_on=None, **args):
+    args['name'] = job_id
+    return jobs.Job(job_id, 'reindex', args=args, depends_on=depends_on)
+
+
+class TestLoadJobs(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'jobs.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, *specs):
+        with open(self.path, 'w') as f:
+            for spec in specs:
+                f.write(json.dumps(spec) + '\n')
+
+    def test_load(self):
+        """It should read jobs in file order."""
+        self.write({'id': 'a', 'type': 'backup'},
+                   {'id': 'b', 'type': 'delete', 'depends_on': ['a'],
+                    'args': {'index_name': 'i'}})
+        loaded = jobs.load_jobs(self.path)
+        self.assertEqual([j.id for j in loaded], ['a', 'b'])
+        self.assertEqual(loaded[1].depends_on, ['a'])
+        self.assertEqual(loaded[1].args, {'index_name': 'i'})
+
+    def test_invalid(self):
+        """It should reject invalid job files."""
+        invalid = [
+            [{'id': 'a', 'type': 'nothing'}],
+            [{'type': 'delete'}],
+            [{'id': 'a', 'type': 'delete'}, {'id': 'a', 'type': 'delete'}],
+            [{'id': 'a', 'type': 'delete', 'depends_on': ['b']}],
+            [{'id': 'a', 'type': 'delete', 'depends_on': ['b']},
+             {'id': 'b', 'type': 'delete', 'depends_on': ['a']}],
+            [{'id': 'a', 'type': 'delete', 'args': {'scan_workers': 'x'}}],
+            [{'id': 'a', 'type': 'verify', 'args': {'slices': 0}}]
+        ]
+        for specs in invalid:
+            self.write(*specs)
+            with self.assertRaises(error.CompanionException):
+                jobs.load_jobs(self.path)
+
+
+class TestRunJobs(TestCase):
+    def setUp(self):
+        self.fake = FakeJobs()
+        patcher = mock.patch.dict(jobs.JOB_TYPES, {'reindex': self.fake})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_dependencies(self):
+        """It should run jobs after their dependencies."""
+        job_list = [job('c', depends_on=['b']), job('b', depends_on=['a']),
+                    job('a')]
+        results = jobs.run_jobs('http://localhost:9200', job_list)
+        self.assertEqual(self.fake.calls, ['a', 'b', 'c'])
+        self.assertEqual(results['c']['status'], 'succeeded')
+        self.assertEqual(results['c']['result'], 'c')
+
+    def test_failures(self):
+        """It should skip the jobs that depend on a failed job."""
+        job_list = [job('a', fail=True), job('b', depends_on=['a']),
+                    job('c', depends_on=['b']), job('d')]
+        output = io.StringIO()
+        results = jobs.run_jobs('http://localhost:9200', job_list,
+                                output=output)
+        self.assertEqual(sorted(self.fake.calls), ['a', 'd'])
+        self.assertEqual({k: r['status'] for k, r in results.items()},
+                         {'a': 'failed', 'b': 'skipped', 'c': 'skipped',
+                          'd': 'succeeded'})
+        self.assertIn('failed on purpose', results['a']['error'])
+        lines = [json.loads(l) for l in output.getvalue().splitlines()]
+        self.assertEqual(sorted(l['id'] for l in lines), ['a', 'b', 'c', 'd'])
+
+    def test_limits(self):
+        """It should not run more jobs than the limits allow."""
+        job_list = [job(str(i), scan_workers=2) for i in range(8)]
+        limits = jobs.Limits(max_jobs=8, max_scrolls=4)
+        jobs.run_jobs('http://localhost:9200', job_list, limits=limits)
+        self.assertEqual(self.fake.max_running, 2)
+
+
+class TestSchedulerFailures(TestCase):
+    def test_fail_before_start(self):
+        """It should schedule the other jobs when a job fails right away."""
+        scheduler = jobs.Scheduler('http://localhost:9200')
+        self.addCleanup(scheduler.shutdown)
+        bad = job('a')
+        # Fails in the slot accounting, before the job starts.
+        bad.args['scan_workers'] = 'x'
+        with mock.patch.dict(jobs.JOB_TYPES, {'reindex': FakeJobs()}):
+            scheduler.submit([bad, job('b'), job('c', depends_on=['a'])])
+            results = scheduler.wait(timeout=5)
+        self.assertEqual({k: r['status'] for k, r in results.items()},
+                         {'a': 'failed', 'b': 'succeeded', 'c': 'skipped'})
+
+
+class TestScheduler(TestCase):
+    def setUp(self):
+        self.fake = FakeJobs()
+        patcher = mock.patch.dict(jobs.JOB_TYPES, {'reindex': self.fake})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = jobs.Scheduler('http://localhost:9200',
+                                        max_finished=2)
+        self.addCleanup(self.scheduler.shutdown)
+
+    def test_submit_over_time(self):
+        """It should run jobs that depend on earlier submissions."""
+        self.scheduler.submit([job('a')])
+        states = self.scheduler.submit([job('b', depends_on=['a'])])
+        self.assertEqual(states[0]['status'], 'pending')
+        results = self.scheduler.wait(timeout=5)
+        self.assertEqual(results['b']['status'], 'succeeded')
+        self.assertEqual(self.fake.calls, ['a', 'b'])
+
+        with self.assertRaises(error.CompanionException):
+            self.scheduler.submit([job('a')])
+        with self.assertRaises(error.CompanionException):
+            self.scheduler.submit([job('c', depends_on=['x'])])
+
+    def test_cancel(self):
+        """It should cancel pending jobs and skip their dependents."""
+        self.scheduler.submit([job('a'), job('b', depends_on=['a']),
+                               job('c', depends_on=['b'])])
+        self.assertTrue(self.scheduler.cancel('b'))
+        self.scheduler.wait(timeout=5)
+        self.assertEqual(self.scheduler.get('b')['status'], 'cancelled')
+        self.assertEqual(self.scheduler.get('c')['status'], 'skipped')
+        self.assertFalse(self.scheduler.cancel('c'))
+        self.assertEqual(self.fake.calls, ['a'])
+
+    def test_forget_finished(self):
+        """It should keep the results of the last finished jobs only, and
+        still run jobs that depend on forgotten ones.
+
+        """
+        for name in 'abc':
+            self.scheduler.submit([job(name)])
+            self.scheduler.wait(timeout=5)
+        self.assertIsNone(self.scheduler.get('a'))
+        self.scheduler.submit([job('d', depends_on=['a'])])
+        self.scheduler.wait(timeout=5)
+        self.assertEqual(self.scheduler.get('d')['status'], 'succeeded')
+        metrics = self.scheduler.metrics()
+        self.assertEqual(metrics['finished'], {'succeeded': 4})
+        self.assertEqual(metrics['active']['running'], 0)
+
+    def test_health(self):
+        """It should fail health jobs that do not reach the status."""
+        with mock.patch('companion.api.health.wait_for_status',
+                        return_value=False):
+            self.scheduler.submit([jobs.Job('h', 'health', args={
+                'wait_for_status': 'green', 'max_wait': 1})])
+            self.scheduler.wait(timeout=5)
+        self.assertEqual(self.scheduler.get('h')['status'], 'failed')
@@ -0,0 +1,248 @@
+"""Pipeline test functions."""
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+from elasticsearch import Elasticsearch, helpers
+
+from companion.api import pipeline, record
+
+from . import bulk_client
+
+
+def make_actions(count, targets):
+    return [{'_index': 'index-{}'.format(i % targets), '_type': 'doc',
+             '_id': str(i), '_source': {'value': i}} for i in range(count)]
+
+
+class TestGroupByTarget(TestCase):
+    def test_all_actions(self):
+        """It should emit every action exactly once."""
+        actions = make_actions(250, 7)
+        grouped = list(pipeline.group_by_target(actions, buffer_size=100))
+        self.assertEqual(len(grouped), 250)
+        self.assertEqual(sorted(a['_id'] for a in grouped),
+                         sorted(a['_id'] for a in actions))
+
+    def test_grouped_within_buffer(self):
+        """It should group actions by index within each buffer."""
+        grouped = list(pipeline.group_by_target(make_actions(100, 4),
+                                                buffer_size=100))
+        indexes = [a['_index'] for a in grouped]
+        self.assertEqual(indexes, sorted(indexes))
+
+    def test_deletes_after_writes(self):
+        """It should emit deletes after the writes of a buffer."""
+        actions = []
+        for i in range(10):
+            actions.append({'_index': 'target', '_id': str(i)})
+            actions.append({'_op_type': 'delete', '_index': 'source',
+                            '_id': str(i)})
+        grouped = list(pipeline.group_by_target(actions, buffer_size=20))
+        self.assertEqual([a.get('_op_type') for a in grouped],
+                         [None] * 10 + ['delete'] * 10)
+
+    def test_stats(self):
+        """It should report the buffer size and fan-out reduction."""
+        stats = pipeline.GroupStats(chunk_size=10)
+        list(pipeline.group_by_target(make_actions(100, 10), buffer_size=100,
+                                      chunk_size=10, stats=stats))
+        self.assertEqual(stats.actions, 100)
+        self.assertEqual(stats.peak_actions, 100)
+        self.assertGreater(stats.peak_bytes, 0)
+        self.assertEqual(stats.fan_out_before, 10)
+        self.assertEqual(stats.fan_out_after, 1)
+
+    def test_stats_docs(self):
+        """It should measure the size of records."""
+        stats = pipeline.GroupStats(chunk_size=10)
+        docs = [record.Doc('index', 'doc', str(i), source={'value': 'x' * 500})
+                for i in range(10)]
+        list(pipeline.group_by_target(docs, stats=stats))
+        self.assertEqual(stats.avg_action_bytes, docs[0].size())
+
+    def test_max_bytes(self):
+        """It should flush the buffer when it reaches max_bytes."""
+        stats = pipeline.GroupStats(chunk_size=10)
+        size = pipeline.action_size(make_actions(1, 1)[0])
+        list(pipeline.group_by_target(make_actions(100, 10), buffer_size=100,
+                                      chunk_size=10, stats=stats,
+                                      max_bytes=size * 20))
+        self.assertLessEqual(stats.peak_actions, 20)
+
+
+class TestMemoryLimits(TestCase):
+    def test_memory_limits(self):
+        """It should split the budget and keep half of it in reserve."""
+        self.assertIsNone(pipeline.memory_limits(None))
+        limits = pipeline.memory_limits(800)
+        self.assertEqual(limits, (100, 100, 100, 100))
+
+
+class TestSizeEstimator(TestCase):
+    def test_sampled(self):
+        """It should only serialize a sample of the items."""
+        size = pipeline.SizeEstimator(sample_rate=10)
+        actions = make_actions(100, 1)
+        sizes = [size(a) for a in actions]
+        self.assertEqual(size.sampled_items, 19)
+        self.assertEqual(sizes[:10],
+                         [pipeline.action_size(a) for a in actions[:10]])
+        self.assertAlmostEqual(sum(sizes) / 100,
+                               pipeline.action_size(actions[50]), delta=2)
+
+    def test_raw_source(self):
+        """It should measure raw sources without sampling."""
+        size = pipeline.SizeEstimator()
+        doc = record.Doc('event', 'click', '1', source=b'{"n": 1}')
+        self.assertEqual(size(doc), doc.size())
+        self.assertEqual(size.sampled_items, 0)
+
+
+class TestBounded(TestCase):
+    def test_order(self):
+        """It should yield all items in order."""
+        actions = make_actions(100, 3)
+        self.assertEqual(list(pipeline.bounded(actions, 1000)), actions)
+
+    def test_backpressure(self):
+        """It should not read ahead more than max_bytes."""
+        read = []
+
+        def _items():
+            for action in make_actions(100, 1):
+                read.append(action)
+                yield action
+
+        size = pipeline.action_size(make_actions(1, 1)[0])
+        items = pipeline.bounded(_items(), size * 5)
+        next(items)
+        time.sleep(0.3)
+        # The consumed item, five buffered ones and one waiting for budget.
+        self.assertLessEqual(len(read), 7)
+        items.close()
+
+    def test_large_item(self):
+        """It should let items through that are larger than the budget."""
+        self.assertEqual(list(pipeline.bounded(['x' * 100] * 3, 10)),
+                         ['x' * 100] * 3)
+
+    def test_error(self):
+        """It should raise errors from the reader."""
+        def _failing():
+            yield {}
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            list(pipeline.bounded(_failing(), 1000))
+
+
+class FakeClient:
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.bodies = []
+
+    def bulk(self, body, filter_path=None):
+        self.bodies.append(body)
+        return {'items': [{'index': {'status': s}} for s in self.statuses]}
+
+
+class TestProcessStages(TestCase):
+    def test_batched(self):
+        """It should split items in batches."""
+        self.assertEqual(list(pipeline.batched(range(5), 2)),
+                         [[0, 1], [2, 3], [4]])
+
+    def test_process_map(self):
+        """It should apply the function to every item in processes."""
+        batches = pipeline.batched(range(100), 10)
+        results = pipeline.process_map(sum, batches, processes=2)
+        self.assertEqual(sorted(results),
+                         [sum(range(i, i + 10)) for i in range(0, 100, 10)])
+
+    def test_send_bulk(self):
+        """It should send every body and count the successful actions."""
+        client = FakeClient([200, 201])
+        self.assertEqual(pipeline.send_bulk(client, ['a', 'b', b'c']), 6)
+        self.assertEqual(sorted(client.bodies), ['a', 'b', 'c'])
+
+    def test_send_bulk_client(self):
+        """It should send text and bytes bodies with the real client."""
+        client = bulk_client()
+        body = '{"index":{"_index":"i","_type":"t"}}\n{"n":1}\n'
+        sent = pipeline.send_bulk(client, [body, body.encode('utf-8')])
+        self.assertEqual(sent, 2)
+        self.assertEqual(client.transport.get_connection().bodies,
+                         [body.encode('utf-8')] * 2)
+
+    def test_send_bulk_errors(self):
+        """It should raise an error for failed actions."""
+        with self.assertRaises(helpers.BulkIndexError):
+            pipeline.send_bulk(FakeClient([200, 400]), ['a'])
+
+
+class SequenceClient:
+    """Answers each bulk request with the next list of statuses."""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.bodies = []
+        self.transport = Elasticsearch().transport
+
+    def bulk(self, body, filter_path=None):
+        self.bodies.append(body)
+        return {'items': [{'index': {'status': s, 'error': 'e{}'.format(s)}}
+                          for s in self.responses.pop(0)]}
+
+
+class TestDeadLetters(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'failed.ndjson')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_send_actions(self):
+        """It should retry rejected actions and write other failures."""
+        client = SequenceClient([[200, 429, 400], [429], [200]])
+        sleeps = []
+        with pipeline.DeadLetters(self.path) as dead_letters:
+            stats = pipeline.send_actions(client, make_actions(3, 1),
+                                          dead_letters=dead_letters,
+                                          sleep=sleeps.append)
+        self.assertEqual(stats, (2, 1))
+        self.assertEqual(sleeps, [2, 4])
+        self.assertEqual(client.bodies[2].count('\n'), 2)
+
+        failed = list(pipeline.read_dead_letters(self.path))
+        self.assertEqual(failed, [make_actions(3, 1)[2]])
+
+    def test_max_retries(self):
+        """It should write actions that are still rejected after retries."""
+        client = SequenceClient([[429], [429]])
+        with pipeline.DeadLetters(self.path) as dead_letters:
+            stats = pipeline.send_actions(client, make_actions(1, 1),
+                                          dead_letters=dead_letters,
+                                          max_retries=1, sleep=lambda s: None)
+        self.assertEqual(stats, (0, 1))
+        self.assertEqual(dead_letters.count, 1)
+
+    def test_send_bulk(self):
+        """It should write the actions of failed items of bodies."""
+        body = (b'{"index":{"_index":"i","_id":"1"}}\n{"n":1}\n'
+                b'{"delete":{"_index":"i","_id":"2"}}\n'
+                b'{"update":{"_index":"i","_id":"3"}}\n{"doc":{"n":3}}\n')
+        client = FakeClient([400, 404, 409])
+        with pipeline.DeadLetters(self.path) as dead_letters:
+            self.assertEqual(pipeline.send_bulk(client, [body],
+                                                dead_letters=dead_letters),
+                             0)
+        failed = list(pipeline.read_dead_letters(self.path))
+        self.assertEqual(failed, [
+            {'_op_type': 'index', '_index': 'i', '_id': '1',
+             '_source': {'n': 1}},
+            {'_op_type': 'delete', '_index': 'i', '_id': '2'},
+            {'_op_type': 'update', '_index': 'i', '_id': '3',
+             'doc': {'n': 3}}])
@@ -0,0 +1,96 @@
+"""Document record test functions."""
+import json
+import pickle
+import tracemalloc
+from unittest import TestCase
+
+from elasticsearch import helpers
+
+from companion.api import record
+
+HIT = ('{{"_index": "event", "_type": "click", "_id": "{0}", "_score": null, '
+       '"_routing": "r{0}", "sort": [{0}], '
+       '"_source": {{"timestamp": "2015-01-01", "user": "u{0}"}}}}')
+
+
+def _memory(make, count=5000):
+    """The memory held by the records that make creates from hits."""
+    tracemalloc.start()
+    try:
+        records = [make(json.loads(HIT.format(i))) for i in range(count)]
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(records) == count
+    return current
+
+
+class TestDoc(TestCase):
+
+    def test_from_hit(self):
+        """It should keep only the fields of the bulk action."""
+        hit = json.loads(HIT.format(1))
+        hit['fields'] = {'_parent': 'p'}
+        doc = record.Doc.from_hit(hit)
+        self.assertEqual(doc.to_action(), {
+            '_op_type': 'index', '_index': 'event', '_type': 'click',
+            '_id': '1', '_routing': 'r1', '_parent': 'p',
+            '_source': {'timestamp': '2015-01-01', 'user': 'u1'}})
+        self.assertEqual(doc['_index'], 'event')
+        self.assertEqual(doc.get('_op_type'), 'index')
+        self.assertIsNone(doc.get('sort'))
+
+    def test_expand(self):
+        """It should expand like helpers.expand_action."""
+        hit = json.loads(HIT.format(1))
+        doc = record.Doc.from_hit(hit)
+        action = dict(hit, _op_type='index')
+        del action['_score'], action['sort']
+        self.assertEqual(record.expand_action(doc),
+                         helpers.expand_action(action))
+
+        delete = record.Doc.from_hit(hit, op_type='delete')
+        self.assertEqual(delete.expand(),
+                         ({'delete': {'_index': 'event', '_type': 'click',
+                                      '_id': '1', '_routing': 'r1'}}, None))
+
+    def test_raw_source(self):
+        """It should pass raw sources through as text."""
+        doc = record.Doc('event', 'click', '1', source=b'{"n": 1}')
+        self.assertEqual(doc.expand()[1], '{"n": 1}')
+        self.assertEqual(doc.decoded_source(), {'n': 1})
+        self.assertEqual(doc.size(), 108)
+
+    def test_pickle(self):
+        """It should be sent to worker processes."""
+        doc = record.Doc.from_hit(json.loads(HIT.format(1)))
+        self.assertEqual(pickle.loads(pickle.dumps(doc)), doc)
+
+
+class TestDocMemory(TestCase):
+    """Benchmarks of the memory that the records of a pipeline hold."""
+
+    def test_delete_memory(self):
+        """A delete record should take less memory than an action dict."""
+        def _action(hit):
+            return {'_op_type': 'delete', '_index': hit['_index'],
+                    '_type': hit['_type'], '_id': hit['_id'],
+                    '_routing': hit['_routing']}
+
+        def _doc(hit):
+            return record.Doc.from_hit(hit, op_type='delete')
+
+        self.assertLess(_memory(_doc), _memory(_action) * 0.6)
+
+    def test_reindex_memory(self):
+        """A re-index record should take less memory than a hit."""
+        def _hit(hit):
+            hit['_index'] = 'event2'
+            return hit
+
+        def _doc(hit):
+            doc = record.Doc.from_hit(hit)
+            doc.index = 'event2'
+            return doc
+
+        self.assertLess(_memory(_doc), _memory(_hit) * 0.6)
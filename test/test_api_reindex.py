@@ -1,9 +1,13 @@
 """Reindex test functions."""
-from unittest import TestCase
+import io
+import json
+import threading
+from unittest import TestCase, mock
 
+from companion import error
 from companion.api import reindex, util
 
-from . import create_test_data, es_url
+from . import create_test_data, es_url, bulk_client, health_client
 
 
 class TestDateReindex(TestCase):
@@ -123,3 +127,356 @@ class TestDateReindex(TestCase):
 
         cnt = self.client.count(index='companiontesttarget')
         self.assertEqual(cnt['count'], 1)
+
+    def test_source_filtering(self):
+        """It should only copy the included fields"""
+        create_test_data()
+        reindex.date_reindex(es_url,
+                             'companiontest',
+                             'companiontesttarget',
+                             source_include=['id'])
+
+        # Remember to refresh
+        self.client.indices.refresh(index='companiontesttarget')
+
+        doc = self.client.get(index='companiontesttarget',
+                              doc_type='simple',
+                              id='foo')
+        self.assertEqual(doc['_source'], {'id': 'foo'})
+
+    def test_transform(self):
+        """It should apply a field transform"""
+        create_test_data()
+        reindex.date_reindex(es_url,
+                             'companiontest',
+                             'companiontesttarget',
+                             transform={'rename': {'id': 'name'},
+                                        'drop': ['timestamp']})
+
+        # Remember to refresh
+        self.client.indices.refresh(index='companiontesttarget')
+
+        doc = self.client.get(index='companiontesttarget',
+                              doc_type='simple',
+                              id='foo')
+        self.assertEqual(doc['_source'], {'name': 'foo'})
+
+    def test_optimize_ingest(self):
+        """It should restore the target settings after re-indexing"""
+        create_test_data()
+        reindex.date_reindex(es_url,
+                             'companiontest',
+                             'companiontesttarget-{:%Y-%m-%d}',
+                             date_field='timestamp',
+                             optimize_ingest=True,
+                             force_merge=1,
+                             wait_for_status='yellow')
+
+        self.client.indices.refresh(index='companiontesttarget*')
+        cnt = self.client.count(index='companiontesttarget*')
+        self.assertEqual(cnt['count'], 4)
+
+        res = self.client.indices.get_settings(
+            index='companiontesttarget-2015-01-01')
+        settings = res['companiontesttarget-2015-01-01']['settings']['index']
+        self.assertNotIn('refresh_interval', settings)
+
+    def test_plan_targets(self):
+        """It should plan target indexes with their document counts"""
+        create_test_data()
+        plan = reindex.plan_targets(es_url,
+                                    'companiontest',
+                                    'companiontesttarget-{:%Y-%m-%d}',
+                                    date_field='timestamp')
+        self.assertEqual(plan, [('companiontesttarget-2015-01-01', 2),
+                                ('companiontesttarget-2015-01-02', 1),
+                                ('companiontesttarget-2015-01-03', 1)])
+
+        plan = reindex.plan_targets(es_url,
+                                    'companiontest',
+                                    'companiontesttarget-{:%Y}',
+                                    date_field='timestamp')
+        self.assertEqual(plan, [('companiontesttarget-2015', 4)])
+
+    def test_precreate(self):
+        """It should create the target indexes before re-indexing"""
+        create_test_data()
+        reindex.create_targets(es_url,
+                               [('companiontesttarget-a', 10),
+                                ('companiontesttarget-b', 30)],
+                               docs_per_shard=10)
+        res = self.client.indices.get_settings(index='companiontesttarget-*')
+        shards = {name: s['settings']['index']['number_of_shards']
+                  for name, s in res.items()}
+        self.assertEqual(shards, {'companiontesttarget-a': '1',
+                                  'companiontesttarget-b': '3'})
+
+
+class TestCreateTargetsTimeout(TestCase):
+    def test_health_timeout(self):
+        """It should warn and go on when the new indexes are not allocated."""
+        client = mock.Mock()
+        client.cluster = health_client().cluster
+        with mock.patch('companion.api.util.get_client',
+                        return_value=client), \
+                self.assertLogs('companion.api.reindex', 'WARNING') as logs:
+            reindex.create_targets('url', [('a', 10), ('b', 10)],
+                                   batch_size=1)
+        self.assertEqual(client.indices.create.call_count, 2)
+        self.assertEqual(len(logs.output), 2)
+
+
+class TestHistogramInterval(TestCase):
+
+    def test_intervals(self):
+        """It should find the finest interval of a name template"""
+        self.assertEqual(reindex._histogram_interval('a-{:%Y}'), 'year')
+        self.assertEqual(reindex._histogram_interval('a-{:%Y-%m}'), 'month')
+        self.assertEqual(reindex._histogram_interval('a-{:%Y-%m-%d}'), 'day')
+        self.assertEqual(reindex._histogram_interval('a-{:%Y.%W}'), 'day')
+        self.assertEqual(reindex._histogram_interval('a-{:%Y%m%d%H}'), 'hour')
+        self.assertIsNone(reindex._histogram_interval('a'))
+
+    def test_shard_count(self):
+        """It should size shards between 1 and the maximum"""
+        self.assertEqual(reindex.shard_count(0, 100), 1)
+        self.assertEqual(reindex.shard_count(250, 100), 3)
+        self.assertEqual(reindex.shard_count(10000, 100, max_shards=5), 5)
+
+
+class TestGroupedReindex(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontesttarget*', ignore=[404])
+
+    def test_group_buffer(self):
+        """It should re-index all documents when grouping by target"""
+        create_test_data()
+        reindex.date_reindex(es_url,
+                             'companiontest',
+                             'companiontesttarget-{:%Y-%m-%d}',
+                             date_field='timestamp',
+                             delete_docs=True,
+                             group_buffer=2)
+
+        self.client.indices.refresh(index='companiontest*')
+        cnt = self.client.count(index='companiontesttarget*')
+        self.assertEqual(cnt['count'], 4)
+        cnt = self.client.count(index='companiontest')
+        self.assertEqual(cnt['count'], 0)
+
+
+def skip_foo(hit):
+    """A document transform for the tests."""
+    if hit['_id'] == 'foo':
+        return None
+    hit['_source']['copied'] = True
+    return hit
+
+
+class TestSourceFilter(TestCase):
+
+    def reindex(self, **kwargs):
+        searches = []
+
+        def _engine(client, **scan_kwargs):
+            searches.append(scan_kwargs)
+            return iter([])
+
+        with mock.patch('companion.api.util.get_client',
+                        return_value=bulk_client()):
+            reindex.date_reindex('url', 'source', 'target-{:%Y}',
+                                 date_field='meta.ts', scan_engine=_engine,
+                                 **kwargs)
+        return searches[0]
+
+    def test_exclude_date_field(self):
+        """It should never exclude the date field"""
+        scan_kwargs = self.reindex(source_exclude=['raw', 'meta.ts'])
+        self.assertEqual(scan_kwargs['_source_exclude'], ['raw'])
+        scan_kwargs = self.reindex(source_exclude=['meta.ts'])
+        self.assertNotIn('_source_exclude', scan_kwargs)
+
+        for pattern in ('meta', 'meta.*', '*'):
+            with self.assertRaises(error.CompanionException):
+                self.reindex(source_exclude=[pattern])
+
+
+class TestSerializeBatch(TestCase):
+
+    def options(self, **kwargs):
+        values = dict(target_index_name='target-{:%Y}',
+                      date_field='timestamp', delete_docs=False,
+                      use_same_id=True, transform=None, doc_transform=None)
+        values.update(kwargs)
+        return reindex._ActionOptions(**values)
+
+    def hits(self):
+        return [{'_index': 'source', '_type': 'doc', '_id': doc_id,
+                 '_source': {'timestamp': '2015-01-01'}}
+                for doc_id in ('foo', 'bar')]
+
+    def test_serialize(self):
+        """It should serialize the hits to a bulk request body"""
+        body, index_names = reindex._serialize_batch(
+            self.hits(), self.options(delete_docs=True))
+        lines = body.splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(json.loads(lines[0]),
+                         {'index': {'_index': 'target-2015', '_type': 'doc',
+                                    '_id': 'foo'}})
+        self.assertEqual(json.loads(lines[2]),
+                         {'delete': {'_index': 'source', '_type': 'doc',
+                                     '_id': 'foo'}})
+        self.assertEqual(index_names, {'target-2015'})
+
+    def test_doc_transform(self):
+        """It should skip documents that the doc transform drops"""
+        body, _ = reindex._serialize_batch(
+            self.hits(), self.options(delete_docs=True,
+                                      doc_transform=skip_foo))
+        lines = body.splitlines()
+        self.assertEqual([json.loads(line) for line in lines[:2]],
+                         [{'index': {'_index': 'target-2015', '_type': 'doc',
+                                     '_id': 'bar'}},
+                          {'timestamp': '2015-01-01', 'copied': True}])
+        self.assertEqual(len(lines), 3)
+
+    def test_client_bulk(self):
+        """It should send the bodies of the processes with the client"""
+        client = bulk_client()
+        hits = self.hits()
+
+        def _engine(client, **kwargs):
+            return iter(hits)
+
+        with mock.patch('companion.api.util.get_client',
+                        return_value=client):
+            success, _ = reindex.date_reindex(
+                'url', 'source', 'target-{:%Y}', date_field='timestamp',
+                scan_engine=_engine, processes=1)
+        self.assertEqual(success, 2)
+        body, = client.transport.get_connection().bodies
+        self.assertIn(b'"_index": "target-2015"', body)
+
+
+class TestProcessReindex(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontesttarget*', ignore=[404])
+
+    def test_processes(self):
+        """It should re-index with processes and a doc transform"""
+        create_test_data()
+        success, _ = reindex.date_reindex(
+            es_url,
+            'companiontest',
+            'companiontesttarget-{:%Y-%m-%d}',
+            date_field='timestamp',
+            processes=2,
+            doc_transform='test.test_api_reindex:skip_foo')
+        self.assertEqual(success, 3)
+
+        self.client.indices.refresh(index='companiontesttarget*')
+        cnt = self.client.count(index='companiontesttarget*')
+        self.assertEqual(cnt['count'], 3)
+
+
+class FakeSourceIndices:
+    def get_settings(self, index, name):
+        return {name: {'settings': {'index': {'number_of_shards': shards}}}
+                for name, shards in (('e-1', '1'), ('e-2', '5'),
+                                     ('e-3', '2'), ('e-4', '1'))}
+
+
+class TestPatternReindex(TestCase):
+
+    def test_plan_sources(self):
+        """It should order the matching indexes largest first."""
+        client = mock.Mock(indices=FakeSourceIndices())
+        client.search.return_value = {'aggregations': {'sources': {
+            'buckets': [{'key': 'e-1', 'doc_count': 10},
+                        {'key': 'e-3', 'doc_count': 30},
+                        {'key': 'e-2', 'doc_count': 30}]}}}
+        with mock.patch('companion.api.util.get_client',
+                        return_value=client):
+            plan = reindex.plan_sources('url', 'e-*')
+        self.assertEqual(plan, [('e-2', 30, 5), ('e-3', 30, 2),
+                                ('e-1', 10, 1)])
+        body = client.search.call_args[1]['body']
+        self.assertEqual(body['aggs']['sources']['terms']['size'], 4)
+
+    def test_budget(self):
+        """It should run sources in parallel within the slice budget and
+        report each of them.
+
+        """
+        lock = threading.Lock()
+        used = {'slices': 0, 'peak': 0}
+        started = []
+
+        def _reindex(url, index_name, target, scan_engine, dead_letter_path,
+                     **kwargs):
+            with lock:
+                started.append(index_name)
+                used['slices'] += scan_engine.slices
+                used['peak'] = max(used['peak'], used['slices'])
+            try:
+                if index_name == 'e-3':
+                    raise ValueError('mapping conflict')
+                self.assertEqual(dead_letter_path, 'dead.' + index_name)
+                self.assertEqual(kwargs['date_field'], 'ts')
+                return 10, 0
+            finally:
+                with lock:
+                    used['slices'] -= scan_engine.slices
+
+        plan = [('e-2', 30, 5), ('e-3', 30, 2), ('e-1', 10, 1),
+                ('e-4', 5, 3)]
+        output = io.StringIO()
+        with mock.patch('companion.api.reindex.date_reindex', _reindex):
+            results = reindex.pattern_reindex(
+                'url', 'e-*', 'e-{:%Y}', plan=plan, max_parallel=3,
+                max_slices=4, slices_per_index=3, dead_letter_path='dead',
+                output=output, date_field='ts')
+
+        self.assertEqual(list(results), ['e-2', 'e-3', 'e-1', 'e-4'])
+        self.assertEqual(sorted(started), ['e-1', 'e-2', 'e-3', 'e-4'])
+        self.assertLessEqual(used['peak'], 4)
+        self.assertEqual(results['e-2']['slices'], 3)
+        self.assertEqual(results['e-1']['slices'], 1)
+        self.assertEqual(results['e-1']['success'], 10)
+        self.assertEqual(results['e-3']['status'], 'failed')
+        self.assertIn('mapping conflict', results['e-3']['error'])
+        self.assertEqual(len(output.getvalue().splitlines()), 4)
+
+
+class TestPatternReindexCluster(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontesttarget*', ignore=[404])
+        self.client.indices.delete(index='companiontestcopy', ignore=[404])
+        create_test_data()
+        self.client.indices.create(index='companiontestcopy',
+                                   body={'index': {'number_of_shards': 2}})
+        self.client.index(index='companiontestcopy', doc_type='simple',
+                          id='qux', body={'timestamp': '2015-02-01'},
+                          refresh=True)
+
+    def test_pattern(self):
+        """It should re-index every matching index."""
+        results = reindex.pattern_reindex(
+            es_url, 'companiontest,companiontestcopy',
+            'companiontesttarget-{:%Y-%m}', date_field='timestamp')
+        self.assertEqual(list(results), ['companiontest',
+                                         'companiontestcopy'])
+        self.assertEqual(results['companiontestcopy']['slices'], 2)
+
+        self.client.indices.refresh(index='companiontesttarget*')
+        cnt = self.client.count(index='companiontesttarget-2015-01')
+        self.assertEqual(cnt['count'], 4)
+        cnt = self.client.count(index='companiontesttarget-2015-02')
+        self.assertEqual(cnt['count'], 1)
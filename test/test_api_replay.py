@@ -0,0 +1,46 @@
+"""Dead letter replay test functions."""
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from companion import error
+from companion.api import replay, pipeline, util
+
+from . import create_test_data, es_url
+
+
+class TestReplay(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'failed.ndjson')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_same_file(self):
+        """It should not write failures to the replayed file."""
+        with self.assertRaises(error.CompanionException):
+            replay.replay(es_url, self.path, dead_letter_path=self.path)
+
+    def test_replay(self):
+        """It should send the failed actions again."""
+        create_test_data()
+        with pipeline.DeadLetters(self.path) as dead_letters:
+            dead_letters.write([
+                ({'_op_type': 'update', '_index': 'companiontest',
+                  '_type': 'simple', '_id': 'foo', 'doc': {'n': 1}},
+                 404, 'index_not_found_exception'),
+                ({'_op_type': 'update', '_index': 'companiontest',
+                  '_type': 'simple', '_id': 'missing', 'doc': {'n': 1}},
+                 404, 'document_missing_exception')])
+
+        self.assertEqual(replay.replay(es_url, self.path), (1, 1))
+        doc = self.client.get(index='companiontest', doc_type='simple',
+                              id='foo')
+        self.assertEqual(doc['_source']['n'], 1)
+
+        failed = list(pipeline.read_dead_letters(self.path + '.replay'))
+        self.assertEqual([action['_id'] for action in failed], ['missing'])
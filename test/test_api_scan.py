@@ -0,0 +1,92 @@
+"""Scan engine test functions."""
+from unittest import TestCase
+
+from companion import error
+from companion.api import scan, util
+
+from . import create_test_data, es_url
+
+
+class TestMerge(TestCase):
+    def test_merge(self):
+        """It should yield the hits of all readers."""
+        readers = [lambda stop, i=i: iter(range(i * 10, i * 10 + 10))
+                   for i in range(3)]
+        self.assertEqual(sorted(scan._merge(readers)), list(range(30)))
+
+    def test_merge_error(self):
+        """It should raise errors from the readers."""
+        def _failing(stop):
+            yield 1
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            list(scan._merge([_failing]))
+
+    def test_merge_stop(self):
+        """It should stop the readers when the consumer stops."""
+        def _endless(stop):
+            while not stop.is_set():
+                yield 1
+
+        hits = scan._merge([_endless, _endless], max_buffered=5)
+        self.assertEqual(next(hits), 1)
+        hits.close()
+
+    def test_merge_max_bytes(self):
+        """It should limit the buffered hits by their size."""
+        def _endless(stop):
+            while not stop.is_set():
+                yield {'value': 'x' * 100}
+
+        hits = scan._merge([_endless, _endless], max_bytes=1000)
+        for _ in range(50):
+            next(hits)
+        hits.close()
+
+
+class TestGetEngine(TestCase):
+    def test_engines(self):
+        """It should create engines by name."""
+        self.assertIsInstance(scan.get_engine('scroll'), scan.ScrollEngine)
+        engine = scan.get_engine('search_after', sort_field='timestamp',
+                                 workers=2)
+        self.assertIsInstance(engine, scan.SearchAfterEngine)
+
+    def test_errors(self):
+        """It should reject unknown engines and unpartitionable fields."""
+        with self.assertRaises(error.CompanionException):
+            scan.get_engine('foo')
+        with self.assertRaises(error.CompanionException):
+            scan.get_engine('search_after', workers=2)
+
+
+class TestEngines(TestCase):
+    def setUp(self):
+        create_test_data()
+        self.client = util.get_client(es_url)
+
+    def scan_ids(self, engine, **kwargs):
+        return sorted('{}/{}'.format(h['_type'], h['_id'])
+                      for h in engine(self.client, index='companiontest',
+                                      **kwargs))
+
+    def test_all_engines(self):
+        """It should read all documents with every engine."""
+        expected = ['advanced/foo', 'simple/bar', 'simple/baz', 'simple/foo']
+        engines = [
+            scan.ScrollEngine(),
+            scan.ScrollEngine(slices=2),
+            scan.SearchAfterEngine(size=1),
+            scan.SearchAfterEngine(sort_field='timestamp', size=1, workers=3)
+        ]
+        for engine in engines:
+            self.assertEqual(self.scan_ids(engine), expected)
+
+    def test_query(self):
+        """It should use the query and scan arguments."""
+        query = {'query': {'range': {'timestamp': {'gte': '2015-01-02'}}}}
+        engine = scan.SearchAfterEngine(sort_field='timestamp', workers=2)
+        self.assertEqual(self.scan_ids(engine, query=query,
+                                       doc_type='simple'),
+                         ['simple/bar', 'simple/baz'])
@@ -0,0 +1,82 @@
+"""Job service test functions."""
+import json
+import threading
+import urllib.error
+import urllib.request
+from unittest import TestCase, mock
+
+from companion.api import jobs, server
+
+
+class TestJobServer(TestCase):
+    def setUp(self):
+        self.release = threading.Event()
+
+        def _blocking(url, args, scan_engine):
+            self.release.wait(5)
+            return 'released'
+
+        patcher = mock.patch.dict(jobs.JOB_TYPES, {
+            'reindex': lambda url, args, scan_engine: args,
+            'delete': _blocking
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        limits = jobs.Limits(max_jobs=1)
+        self.scheduler = jobs.Scheduler('http://es:9200', limits=limits)
+        self.server = server.JobServer(('127.0.0.1', 0), self.scheduler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.addCleanup(self.scheduler.shutdown)
+        self.addCleanup(self.release.set)
+        self.base = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.base + path, data=data,
+                                         method=method)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read().decode())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read().decode())
+
+    def test_jobs(self):
+        """It should submit jobs, report their state and cancel them."""
+        status, states = self.request('POST', '/jobs', [
+            {'id': 'block', 'type': 'delete'},
+            {'type': 'reindex', 'args': {'name': 'a'}}])
+        self.assertEqual(status, 201)
+        job_id = states[1]['id']
+        self.assertTrue(job_id.startswith('reindex-'))
+
+        # The only job thread is busy, so the second job waits.
+        status, state = self.request('DELETE', '/jobs/' + job_id)
+        self.assertEqual((status, state['status']), (200, 'cancelled'))
+        status, _ = self.request('DELETE', '/jobs/unknown')
+        self.assertEqual(status, 404)
+
+        status, metrics = self.request('GET', '/metrics')
+        self.assertEqual(metrics['finished'], {'cancelled': 1})
+        self.assertIn('peak_memory_mb', metrics)
+
+        self.release.set()
+        self.scheduler.wait(timeout=5)
+        status, state = self.request('GET', '/jobs/block')
+        self.assertEqual((status, state['status'], state['result']),
+                         (200, 'succeeded', 'released'))
+        status, states = self.request('GET', '/jobs')
+        self.assertEqual([s['id'] for s in states], ['block', job_id])
+
+    def test_invalid(self):
+        """It should reject invalid jobs and paths."""
+        for body in ({'type': 'nothing'}, [1], {'id': 'x'}):
+            status, response = self.request('POST', '/jobs', body)
+            self.assertEqual(status, 400)
+            self.assertIn('error', response)
+        status, _ = self.request('GET', '/nothing')
+        self.assertEqual(status, 404)
@@ -1,5 +1,9 @@
 """Setup test functions."""
-from unittest import TestCase
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase, mock
 
 from companion import error
 from companion.api import setup as api_setup
@@ -17,3 +21,90 @@ class TestIndexMapper(TestCase):
         """It should raise an exception if a directory does not exist."""
         with self.assertRaises(error.CompanionException):
             api_setup.IndexMapper(es_url, data_path='./hejhej')
+
+
+def write_json(path, value):
+    with open(path, 'w') as f:
+        json.dump(value, f)
+
+
+class FakeIndices:
+    def __init__(self, existing):
+        self.existing = existing
+        self.requests = []
+
+    def create(self, index, body, ignore):
+        self.requests.append(('create', index))
+        if index in self.existing:
+            return {'error': {'type': 'index_already_exists_exception'},
+                    'status': 400}
+        return {'acknowledged': True}
+
+    def put_mapping(self, index, doc_type, body):
+        self.requests.append(('mapping', index, doc_type))
+
+    def put_template(self, name, body):
+        self.requests.append(('template', name))
+
+
+class FakeClient:
+    def __init__(self, existing=(), fail=False):
+        self.indices = FakeIndices(existing)
+        self.fail = fail
+
+    def put_script(self, id, lang, body):
+        if self.fail:
+            raise ValueError('script failed')
+
+
+class TestSetupClusters(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for folder in ('index', 'mapping', 'template', 'scripts'):
+            os.mkdir(os.path.join(self.tmpdir, folder))
+        for name in ('a', 'b'):
+            write_json(os.path.join(self.tmpdir, 'index', name + '.json'),
+                       {'index': name, 'setup': {}})
+        write_json(os.path.join(self.tmpdir, 'mapping', 'a.json'),
+                   {'index': 'a', 'type': 'doc', 'mapping': {}})
+        write_json(os.path.join(self.tmpdir, 'template', 't.json'),
+                   {'name': 't', 'body': {}})
+        write_json(os.path.join(self.tmpdir, 'scripts', 's.json'),
+                   {'id': 's', 'lang': 'painless', 'body': 'return 1'})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_data(self):
+        """It should parse the data directory without a cluster."""
+        data = api_setup.IndexMapper(None, data_path=self.tmpdir).read_data()
+        self.assertEqual(sorted(data.indexes), ['a', 'b'])
+        self.assertEqual(data.mappings, {'a': {'doc': {}}})
+        self.assertEqual(data.scripts[0]['body'], {'script': 'return 1'})
+
+    def test_load_inventory(self):
+        """It should read urls with optional names."""
+        path = os.path.join(self.tmpdir, 'inventory')
+        with open(path, 'w') as f:
+            f.write('# regions\neu http://eu:9200\n\nhttp://us:9200\n')
+        self.assertEqual(list(api_setup.load_inventory(path).items()),
+                         [('eu', 'http://eu:9200'),
+                          ('http://us:9200', 'http://us:9200')])
+
+    def test_setup_clusters(self):
+        """It should set up every cluster and report the changes."""
+        clients = {'http://eu': FakeClient(existing=['a']),
+                   'http://us': FakeClient(fail=True)}
+        with mock.patch('companion.api.util.get_client', clients.get):
+            results = api_setup.setup_clusters(
+                {'eu': 'http://eu', 'us': 'http://us'},
+                data_path=self.tmpdir)
+
+        self.assertEqual(results['eu']['status'], 'succeeded')
+        self.assertEqual(results['eu']['changes'],
+                         {'indexes_created': 1, 'indexes_existing': 1,
+                          'mappings': 1, 'templates': 1, 'scripts': 1})
+        requests = clients['http://eu'].indices.requests
+        self.assertEqual(requests.index(('mapping', 'a', 'doc')), 2)
+        self.assertEqual(results['us']['status'], 'failed')
+        self.assertIn('script failed', results['us']['error'])
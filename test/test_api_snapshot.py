@@ -0,0 +1,157 @@
+"""Snapshot test functions."""
+import os
+from unittest import TestCase, mock
+
+from companion import error
+from companion.api import snapshot, util
+
+from . import create_test_data, es_url, health_client
+
+# A directory in the path.repo setting of the test cluster.
+repo_path = os.environ.get('ELASTICSEARCH_REPO_PATH',
+                           '/tmp/companiontest-snapshots')
+
+
+class FakeSnapshots:
+    def __init__(self, states, final='SUCCESS'):
+        self.states = list(states)
+        self.final = final
+        self.created = []
+        self.deleted = []
+
+    def create(self, repository, snapshot, body, params):
+        self.created.append((snapshot, body, params))
+
+    def status(self, repository, snapshot):
+        return {'snapshots': [{'state': self.states.pop(0),
+                               'shards_stats': {'done': 1, 'total': 2}}]}
+
+    def get(self, repository, snapshot):
+        return {'snapshots': [{'state': self.final, 'indices': ['a'],
+                               'failures': []}]}
+
+    def delete(self, repository, snapshot, ignore=None):
+        self.deleted.append(snapshot)
+
+
+class TestSnapshotPolling(TestCase):
+
+    def _snapshot(self, snapshots, **kwargs):
+        client = mock.Mock(snapshot=snapshots)
+        with mock.patch('companion.api.util.get_client',
+                        return_value=client):
+            return snapshot.snapshot('url', 'repo', 'Event-*,other',
+                                     poll_interval=0, **kwargs)
+
+    def test_polls_status(self):
+        """It should start the snapshot without waiting and poll it."""
+        snapshots = FakeSnapshots(['INIT', 'STARTED', 'SUCCESS'])
+        name = self._snapshot(snapshots)
+        self.assertTrue(name.startswith('event-_other-'))
+        self.assertEqual(snapshots.states, [])
+        _, body, params = snapshots.created[0]
+        self.assertEqual(body['indices'], 'Event-*,other')
+        self.assertEqual(params, {'wait_for_completion': 'false'})
+
+    def test_failed(self):
+        """It should raise for partial and failed snapshots."""
+        with self.assertRaises(error.CompanionException):
+            self._snapshot(FakeSnapshots(['SUCCESS'], final='PARTIAL'),
+                           name='snap')
+
+    def test_abort_on_interrupt(self):
+        """It should delete the snapshot when waiting is interrupted."""
+        snapshots = FakeSnapshots(['STARTED'])
+        with mock.patch('time.sleep', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self._snapshot(snapshots, name='snap')
+        self.assertEqual(snapshots.deleted, ['snap'])
+
+    def test_restored_names(self):
+        """It should filter and rename like Elasticsearch."""
+        names = snapshot._restored_names(['event-1', 'event-2', 'user'],
+                                         'event-*', 'event-(.+)',
+                                         'restored-$1')
+        self.assertEqual(names, ['restored-1', 'restored-2'])
+        self.assertEqual(snapshot._restored_names(['a', 'b'], None, None,
+                                                  None), ['a', 'b'])
+
+
+class FakeRestoreClient:
+    def __init__(self, shard_state, reason=None, timeouts=None):
+        self.snapshot = mock.Mock()
+        self.snapshot.get.return_value = {'snapshots': [{'indices': ['a']}]}
+        self.indices = mock.Mock()
+        self.indices.recovery.return_value = {}
+        self.rows = [{'index': 'a', 'shard': '0', 'prirep': 'p',
+                      'state': shard_state, 'unassigned.reason': reason}]
+        self.cat = self
+        # Health waits time out with a 408 until the restore finishes.
+        self.cluster = health_client(timeouts).cluster
+
+    def shards(self, index, format, h):
+        return self.rows
+
+
+class TestRestorePolling(TestCase):
+
+    def _restore(self, client, **kwargs):
+        with mock.patch('companion.api.util.get_client',
+                        return_value=client):
+            return snapshot.restore('url', 'repo', 'snap',
+                                    poll_interval=0.01, **kwargs)
+
+    def test_slow_restore(self):
+        """It should keep polling while the health waits time out."""
+        client = FakeRestoreClient('INITIALIZING', timeouts=3)
+        self.assertEqual(self._restore(client), ['a'])
+        self.assertEqual(
+            client.cluster.transport.get_connection().requests, 4)
+
+    def test_failed_shards(self):
+        """It should raise when a primary shard fails to restore."""
+        client = FakeRestoreClient('UNASSIGNED', 'ALLOCATION_FAILED')
+        with self.assertRaises(error.CompanionException):
+            self._restore(client)
+
+    def test_max_wait(self):
+        """It should give up after max_wait."""
+        client = FakeRestoreClient('INITIALIZING')
+        with self.assertRaises(error.CompanionException):
+            self._restore(client, max_wait=0.01)
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontestrestored',
+                                   ignore=[404])
+        create_test_data()
+
+    def test_snapshot_restore(self):
+        """It should snapshot an index and restore it with a new name."""
+        snapshot.ensure_repository(es_url, 'companiontest',
+                                   location=repo_path)
+        # A second call reuses the repository.
+        snapshot.ensure_repository(es_url, 'companiontest',
+                                   location=repo_path)
+        name = snapshot.snapshot(es_url, 'companiontest', 'companiontest',
+                                 poll_interval=0.1)
+        names = snapshot.restore(
+            es_url, 'companiontest', name, rename_pattern='(.+)',
+            rename_replacement='$1restored',
+            index_settings={'index.number_of_replicas': 0},
+            poll_interval=1)
+        self.assertEqual(names, ['companiontestrestored'])
+
+        self.client.indices.refresh(index='companiontestrestored')
+        cnt = self.client.count(index='companiontestrestored')
+        self.assertEqual(cnt['count'], 4)
+        self.client.snapshot.delete(repository='companiontest',
+                                    snapshot=name)
+
+    def test_missing_repository(self):
+        """It should require a location for new repositories."""
+        with self.assertRaises(error.CompanionException):
+            snapshot.ensure_repository(es_url, 'companiontestmissing')
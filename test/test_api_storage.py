@@ -0,0 +1,187 @@
+"""Storage test functions."""
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+import boto3.exceptions
+import botocore.exceptions
+
+from companion import error
+from companion.api import storage
+
+
+class TestLocalStorage(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.storage = storage.LocalStorage(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_get(self):
+        """It should store and read objects with nested keys."""
+        self.storage.put('foo/bar/baz.json', b'{}')
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.tmpdir, 'foo', 'bar', 'baz.json')))
+        self.assertEqual(self.storage.get('foo/bar/baz.json'), b'{}')
+
+    def test_exists(self):
+        """It should tell whether a key exists."""
+        self.assertFalse(self.storage.exists('foo'))
+        self.storage.put('foo', b'bar')
+        self.assertTrue(self.storage.exists('foo'))
+
+    def test_list_prefix(self):
+        """It should list keys with a given prefix in sorted order."""
+        self.storage.put('b/2', b'')
+        self.storage.put('b/1', b'')
+        self.storage.put('a/1', b'')
+        self.assertEqual(self.storage.list(), ['a/1', 'b/1', 'b/2'])
+        self.assertEqual(self.storage.list('b/'), ['b/1', 'b/2'])
+
+    def test_delete(self):
+        """It should delete objects."""
+        self.storage.put('foo', b'bar')
+        self.storage.delete('foo')
+        self.assertFalse(self.storage.exists('foo'))
+
+    def test_open_write(self):
+        """It should store streamed writes when the file is closed."""
+        with self.storage.open_write('foo/bar') as f:
+            f.write(b'abc')
+            f.write(b'def')
+            self.assertFalse(self.storage.exists('foo/bar'))
+        self.assertEqual(self.storage.get('foo/bar'), b'abcdef')
+        with self.storage.open_read('foo/bar') as f:
+            self.assertEqual(f.read(), b'abcdef')
+
+    def test_open_write_error(self):
+        """It should discard streamed writes on errors."""
+        with self.assertRaises(ValueError):
+            with self.storage.open_write('foo/bar') as f:
+                f.write(b'abc')
+                raise ValueError()
+        self.assertFalse(self.storage.exists('foo/bar'))
+        self.assertEqual(self.storage.list(), [])
+
+    def test_upload_download_file(self):
+        """It should copy whole files in and out of the storage."""
+        source = os.path.join(self.tmpdir, 'source.bin')
+        target = os.path.join(self.tmpdir, 'target.bin')
+        with open(source, 'wb') as f:
+            f.write(os.urandom(100000))
+        self.assertEqual(self.storage.upload_file('foo/bar', source), 100000)
+        self.assertEqual(self.storage.download_file('foo/bar', target), 100000)
+        with open(source, 'rb') as f1, open(target, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+
+class TestGetStorage(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_local(self):
+        """It should create a local storage for paths."""
+        target = storage.get_storage(self.tmpdir)
+        self.assertIsInstance(target, storage.LocalStorage)
+        target = storage.get_storage('file://' + self.tmpdir)
+        self.assertEqual(target.root_path, self.tmpdir)
+
+    def test_s3(self):
+        """It should create an S3 storage for s3 urls."""
+        target = storage.get_storage('s3://mybucket/some/prefix/',
+                                     region='eu-west-1')
+        self.assertIsInstance(target, storage.S3Storage)
+        self.assertEqual(target.bucket_name, 'mybucket')
+        self.assertEqual(target.prefix, 'some/prefix')
+
+    def test_s3_no_bucket(self):
+        """It should raise an exception when the bucket name is missing."""
+        with self.assertRaises(error.CompanionException):
+            storage.get_storage('s3://')
+
+
+class FakeS3Client:
+    """Serves get_object and head_object from a bytes object."""
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.data)}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = Range[len('bytes='):].split('-')
+        self.ranges.append((int(start), int(end)))
+        return {'Body': io.BytesIO(self.data[int(start):int(end) + 1])}
+
+
+class TestS3Storage(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_download_ranges(self):
+        """It should download large objects as parallel byte ranges."""
+        data = os.urandom(1000)
+        target = storage.S3Storage('mybucket', region='eu-west-1',
+                                   multipart_threshold=100, part_size=300)
+        target.client = FakeS3Client(data)
+        path = os.path.join(self.tmpdir, 'download')
+        self.assertEqual(target.download_file('foo', path), 1000)
+        self.assertEqual(sorted(target.client.ranges),
+                         [(0, 299), (300, 599), (600, 899), (900, 999)])
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_download_small(self):
+        """It should download small objects with a single request."""
+        target = storage.S3Storage('mybucket', region='eu-west-1')
+        target.client = FakeS3Client(b'abc')
+        path = os.path.join(self.tmpdir, 'download')
+        self.assertEqual(target.download_file('foo', path), 3)
+        self.assertEqual(target.client.ranges, [(0, 2)])
+
+
+def upload_failure(status):
+    """An upload error of the transfer manager, caused by a client error."""
+    try:
+        raise botocore.exceptions.ClientError(
+            {'ResponseMetadata': {'HTTPStatusCode': status}}, 'UploadPart')
+    except botocore.exceptions.ClientError:
+        try:
+            raise boto3.exceptions.S3UploadFailedError('Failed to upload')
+        except boto3.exceptions.S3UploadFailedError as e:
+            return e
+
+
+class TestRetry(TestCase):
+    def run_retry(self, errors):
+        calls = []
+
+        def _func():
+            calls.append(1)
+            if errors:
+                raise errors.pop(0)
+            return 'done'
+
+        with mock.patch('time.sleep'):
+            return storage._retry(_func, 3, 'Upload'), len(calls)
+
+    def test_upload_failed(self):
+        """It should retry uploads that failed with server errors."""
+        self.assertEqual(self.run_retry([upload_failure(500),
+                                         upload_failure(503)]),
+                         ('done', 3))
+
+    def test_client_error(self):
+        """It should not retry uploads that failed with client errors."""
+        with self.assertRaises(boto3.exceptions.S3UploadFailedError):
+            self.run_retry([upload_failure(403)])
@@ -0,0 +1,123 @@
+"""NDJSON export and import test functions."""
+import os
+import gzip
+import json
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from companion import error
+from companion.api import stream, util
+
+from . import create_test_data, es_url, bulk_client
+
+HITS = [{'_index': 'i', '_type': 't', '_id': str(i), '_score': 1.0,
+         '_source': {'n': i}} for i in range(5)]
+
+
+class TestFiles(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_part_paths(self):
+        """It should number the part files before the extension."""
+        self.assertEqual(stream.part_paths('/d/event.ndjson.gz', 2),
+                         ['/d/event.part0.ndjson.gz',
+                          '/d/event.part1.ndjson.gz'])
+        self.assertEqual(stream.part_paths('event', 1), ['event'])
+        self.assertEqual(stream.part_paths('event', 2),
+                         ['event.part0', 'event.part1'])
+
+    def test_roundtrip(self):
+        """It should write hits without scores and read them back, with and
+        without compression.
+
+        """
+        for name in ('hits.ndjson', 'hits.ndjson.gz'):
+            path = os.path.join(self.tmpdir, name)
+            with stream.open_output(path) as f:
+                self.assertEqual(stream._write_hits(iter(HITS), f), 5)
+            with stream.open_input(path) as f:
+                docs = [json.loads(line.decode('utf-8')) for line in f]
+            self.assertEqual(docs[1], {'_index': 'i', '_type': 't',
+                                       '_id': '1', '_source': {'n': 1}})
+            self.assertEqual(len(docs), 5)
+
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(2), b'\x1f\x8b')
+
+    def test_import_bodies(self):
+        """It should read files in parallel into bulk request bodies."""
+        paths = []
+        for i in range(2):
+            path = os.path.join(self.tmpdir, 'hits{}.ndjson.gz'.format(i))
+            with stream.open_output(path) as f:
+                stream._write_hits(iter(HITS), f)
+            paths.append(path)
+
+        bodies = []
+
+        def _send(client, items, threads):
+            bodies.extend(items)
+            return 10
+
+        with mock.patch('companion.api.util.get_client'), \
+                mock.patch('companion.api.pipeline.send_bulk', _send):
+            imported = stream.import_files('url', paths, index_name='j',
+                                           chunk_size=2)
+        self.assertEqual(imported, 10)
+        self.assertEqual(len(bodies), 6)
+        lines = ''.join(bodies).splitlines()
+        self.assertEqual(len(lines), 20)
+        self.assertEqual(json.loads(lines[0])['index']['_index'], 'j')
+
+    def test_client_bulk(self):
+        """It should send the imported bodies with the client."""
+        path = os.path.join(self.tmpdir, 'hits.ndjson')
+        with stream.open_output(path) as f:
+            stream._write_hits(iter(HITS), f)
+        client = bulk_client()
+        with mock.patch('companion.api.util.get_client',
+                        return_value=client):
+            self.assertEqual(stream.import_files('url', [path]), 5)
+        body, = client.transport.get_connection().bodies
+        self.assertEqual(body.count(b'\n'), 10)
+
+    def test_stdout_parts(self):
+        """It should require a file name for part files."""
+        with self.assertRaises(error.CompanionException):
+            stream.export('url', 'i', parts=2)
+
+
+class TestExportImport(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontestimport', ignore=[404])
+        self.tmpdir = tempfile.mkdtemp()
+        create_test_data()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_export_import(self):
+        """It should export part files and import them into another index."""
+        output = os.path.join(self.tmpdir, 'test.ndjson.gz')
+        count = stream.export(es_url, 'companiontest', output, parts=2)
+        self.assertEqual(count, 4)
+
+        paths = stream.part_paths(output, 2)
+        with gzip.open(paths[0]) as f:
+            self.assertIn(b'"_source"', f.readline())
+
+        imported = stream.import_files(es_url, paths,
+                                       index_name='companiontestimport')
+        self.assertEqual(imported, 4)
+        self.client.indices.refresh(index='companiontestimport')
+        cnt = self.client.count(index='companiontestimport',
+                                doc_type='simple')
+        self.assertEqual(cnt['count'], 3)
@@ -0,0 +1,131 @@
+"""Throttle test functions."""
+import os
+import json
+import shutil
+import tempfile
+from unittest import TestCase
+
+from companion import error
+from companion.api import throttle
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeNodes:
+    def __init__(self):
+        self.queue = 0
+        self.rejected = 0
+
+    def stats(self, metric=None, filter_path=None):
+        pool = {'queue': self.queue, 'rejected': self.rejected}
+        return {'nodes': {'n1': {'thread_pool': {'search': pool,
+                                                 'bulk': pool}}}}
+
+
+class FakeClient:
+    def __init__(self):
+        self.nodes = FakeNodes()
+
+
+class TestTokenBucket(TestCase):
+    def test_rate(self):
+        """It should allow rate tokens per second after the first burst."""
+        clock = FakeClock()
+        bucket = throttle.TokenBucket(10, clock=clock, sleep=clock.sleep)
+        for _ in range(30):
+            bucket.take()
+        self.assertAlmostEqual(clock.now, 2.0)
+
+    def test_large_request(self):
+        """It should let requests larger than the bucket through."""
+        clock = FakeClock()
+        bucket = throttle.TokenBucket(10, clock=clock, sleep=clock.sleep)
+        bucket.take(100)
+        bucket.take(1)
+        self.assertAlmostEqual(clock.now, 9.1)
+
+    def test_unlimited(self):
+        """It should not block without a rate."""
+        clock = FakeClock()
+        bucket = throttle.TokenBucket(None, clock=clock, sleep=clock.sleep)
+        bucket.take(1000)
+        self.assertEqual(clock.now, 0)
+
+
+class TestThrottle(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_control_file(self):
+        """It should read the limits from the control file when it changes."""
+        path = os.path.join(self.tmpdir, 'throttle.json')
+        with open(path, 'w') as f:
+            json.dump({'docs_per_sec': 100}, f)
+        job_throttle = throttle.Throttle(control_file=path)
+        self.assertEqual(job_throttle.docs.rate, 100)
+
+        with open(path, 'w') as f:
+            json.dump({'docs_per_sec': 50, 'bytes_per_sec': 1000}, f)
+        job_throttle.reload()
+        job_throttle.load_control_file()
+        self.assertEqual(job_throttle.docs.rate, 50)
+        self.assertEqual(job_throttle.bytes.rate, 1000)
+
+    def test_adaptive_requires_client(self):
+        """It should require a client for adaptive throttling."""
+        with self.assertRaises(error.CompanionException):
+            throttle.Throttle(adaptive=True)
+
+    def test_adapt(self):
+        """It should back off on rejections and recover afterwards."""
+        client = FakeClient()
+        job_throttle = throttle.Throttle(docs_per_sec=1000, client=client,
+                                         adaptive=True)
+        job_throttle.adapt(observed=1000)
+        self.assertEqual(job_throttle.docs.rate, 1000)
+
+        client.nodes.rejected = 5
+        job_throttle.adapt(observed=1000)
+        self.assertEqual(job_throttle.docs.rate, 500)
+
+        client.nodes.queue = 1000
+        job_throttle.adapt(observed=500)
+        self.assertEqual(job_throttle.docs.rate, 250)
+
+        client.nodes.queue = 0
+        for _ in range(10):
+            job_throttle.adapt(observed=250)
+        self.assertEqual(job_throttle.docs.rate, 1000)
+
+    def test_adapt_unlimited(self):
+        """It should back off from the observed rate without a limit."""
+        client = FakeClient()
+        job_throttle = throttle.Throttle(client=client, adaptive=True)
+        job_throttle.adapt(observed=800)
+        client.nodes.rejected = 1
+        job_throttle.adapt(observed=800)
+        self.assertEqual(job_throttle.docs.rate, 400)
+        for _ in range(5):
+            job_throttle.adapt(observed=150)
+        self.assertIsNone(job_throttle.docs.rate)
+
+    def test_engine(self):
+        """It should throttle the hits of a scan engine."""
+        job_throttle = throttle.Throttle(docs_per_sec=1000)
+        engine = throttle.ThrottledEngine(
+            lambda client, index=None, query=None: iter(range(10)),
+            job_throttle)
+        self.assertEqual(list(engine(None, index='i')), list(range(10)))
+        self.assertEqual(job_throttle.count, 10)
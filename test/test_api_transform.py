@@ -0,0 +1,59 @@
+"""Field transform test functions."""
+import json
+from unittest import TestCase
+
+from companion import error
+from companion.api import transform
+
+
+class TestFieldTransform(TestCase):
+    def test_drop(self):
+        """It should drop top level and nested fields."""
+        t = transform.FieldTransform(drop=['a', 'b.c', 'missing.field'])
+        source = t({'a': 1, 'b': {'c': 2, 'd': 3}, 'e': 4})
+        self.assertEqual(source, {'b': {'d': 3}, 'e': 4})
+
+    def test_rename(self):
+        """It should rename fields, creating nested objects if needed."""
+        t = transform.FieldTransform(rename={'ts': 'timestamp',
+                                             'user_name': 'user.name',
+                                             'missing': 'other'})
+        source = t({'ts': 1, 'user_name': 'foo'})
+        self.assertEqual(source, {'timestamp': 1, 'user': {'name': 'foo'}})
+
+    def test_cast(self):
+        """It should cast fields after renaming them."""
+        t = transform.FieldTransform(rename={'p': 'price'},
+                                     cast={'price': 'float', 'n': 'int',
+                                           'flag': 'bool', 'empty': 'int'})
+        source = t({'p': '1.5', 'n': '2', 'flag': 'true', 'empty': None})
+        self.assertEqual(source, {'price': 1.5, 'n': 2, 'flag': True,
+                                  'empty': None})
+
+    def test_cast_error(self):
+        """It should raise an exception for values that cannot be cast."""
+        t = transform.FieldTransform(cast={'n': 'int'})
+        with self.assertRaises(error.CompanionException):
+            t({'n': 'abc'})
+
+    def test_from_dict(self):
+        """It should create transforms from a dict and reject unknown keys."""
+        t = transform.FieldTransform.from_dict({'drop': ['a']})
+        self.assertEqual(t({'a': 1, 'b': 2}), {'b': 2})
+        with self.assertRaises(error.CompanionException):
+            transform.FieldTransform.from_dict({'remove': ['a']})
+        with self.assertRaises(error.CompanionException):
+            transform.FieldTransform.from_dict({'cast': {'a': 'long'}})
+
+
+class TestLoadFunction(TestCase):
+    def test_load(self):
+        """It should import a function by module and name."""
+        self.assertIs(transform.load_function('json:dumps'), json.dumps)
+
+    def test_errors(self):
+        """It should raise errors for invalid paths."""
+        with self.assertRaises(error.CompanionException):
+            transform.load_function('json')
+        with self.assertRaises(error.CompanionException):
+            transform.load_function('json:nothing')
@@ -0,0 +1,158 @@
+"""Update test functions."""
+from unittest import TestCase, mock
+
+from companion import error
+from companion.api import update, util
+
+from . import create_test_data, es_url
+
+
+class FakeTasks:
+    def __init__(self, statuses, response=None):
+        self.statuses = list(statuses)
+        self.response = response or {'updated': 3, 'total': 3,
+                                     'failures': []}
+        self.cancelled = []
+
+    def get(self, task_id):
+        status = self.statuses.pop(0)
+        task = {'completed': not self.statuses,
+                'task': {'id': 1, 'status': status}}
+        if task['completed']:
+            task['response'] = self.response
+        return task
+
+    def cancel(self, task_id, ignore=None):
+        self.cancelled.append(task_id)
+
+
+class FakeClient:
+    def __init__(self, tasks):
+        self.tasks = tasks
+        self.requests = []
+
+    def update_by_query(self, **kwargs):
+        self.requests.append(kwargs)
+        return {'task': 'node:1'}
+
+
+class TestUpdateByQueryTask(TestCase):
+
+    def _update(self, client, **kwargs):
+        with mock.patch('companion.api.util.get_client',
+                        return_value=client):
+            return update.update_by_query('url', 'index',
+                                          {'inline': 'ctx._source.n = 1'},
+                                          poll_interval=0, **kwargs)
+
+    def test_polls_task(self):
+        """It should start a task and poll it until it completes."""
+        client = FakeClient(FakeTasks([{'total': 3, 'updated': 1},
+                                       {'total': 3, 'updated': 3}]))
+        res = self._update(client, slices=2, requests_per_second=100)
+        self.assertEqual(res['updated'], 3)
+        params = client.requests[0]['params']
+        self.assertEqual(params['slices'], 2)
+        self.assertEqual(params['requests_per_second'], 100)
+        self.assertEqual(params['wait_for_completion'], 'false')
+        self.assertEqual(client.requests[0]['body']['script'],
+                         {'inline': 'ctx._source.n = 1'})
+
+    def test_failures(self):
+        """It should raise when the task has failures."""
+        tasks = FakeTasks([{}], response={'failures': [{'id': 'foo'}]})
+        with self.assertRaises(error.CompanionException):
+            self._update(FakeClient(tasks))
+
+    def test_cancel_on_interrupt(self):
+        """It should cancel the task when waiting is interrupted."""
+        tasks = FakeTasks([{}, {}])
+        client = FakeClient(tasks)
+        with mock.patch('time.sleep', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self._update(client)
+        self.assertEqual(tasks.cancelled, ['node:1'])
+
+
+class TestBulkUpdateActions(TestCase):
+
+    def _actions(self, **kwargs):
+        hits = [{'_index': 'i', '_type': 't', '_id': '1', '_routing': 'r',
+                 '_source': {'n': 1}},
+                {'_index': 'i', '_type': 't', '_id': '2',
+                 '_source': {'n': 2}}]
+        actions = []
+
+        def _bulk(client, actions_iter, **kwargs):
+            actions.extend(actions_iter)
+            return len(actions), 0
+
+        with mock.patch('companion.api.util.get_client'), \
+                mock.patch('elasticsearch.helpers.bulk', _bulk):
+            update.bulk_update('url', 'i',
+                               scan_engine=lambda client, **kw: iter(hits),
+                               **kwargs)
+        return actions
+
+    def test_script(self):
+        """It should build partial update actions with the script."""
+        actions = self._actions(script={'inline': 'x'})
+        self.assertEqual(actions[0], {'_op_type': 'update', '_index': 'i',
+                                      '_type': 't', '_id': '1',
+                                      '_routing': 'r',
+                                      '_retry_on_conflict': 3,
+                                      'script': {'inline': 'x'}})
+        self.assertEqual(actions[1]['_id'], '2')
+
+    def test_update_func(self):
+        """It should skip hits that the update function leaves as they are."""
+        def _update(hit):
+            if hit['_source']['n'] > 1:
+                return {'doc': {'n': 0}}
+
+        actions = self._actions(update_func=_update)
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]['doc'], {'n': 0})
+
+    def test_one_update(self):
+        """It should require exactly one kind of update."""
+        with self.assertRaises(error.CompanionException):
+            update.bulk_update('url', 'i')
+        with self.assertRaises(error.CompanionException):
+            update.bulk_update('url', 'i', script={'inline': 'x'},
+                               doc={'n': 1})
+
+
+class TestUpdate(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        create_test_data()
+
+    def test_update_by_query(self):
+        """It should update the documents matching the query."""
+        query = {'query': {'term': {'id': 'foo'}}}
+        res = update.update_by_query(
+            es_url, 'companiontest',
+            {'inline': 'ctx._source.n = params.n', 'params': {'n': 7}},
+            query=query, doc_type='simple', poll_interval=0.1)
+        self.assertEqual(res['updated'], 1)
+
+        doc = self.client.get(index='companiontest', doc_type='simple',
+                              id='foo')
+        self.assertEqual(doc['_source']['n'], 7)
+        doc = self.client.get(index='companiontest', doc_type='advanced',
+                              id='foo')
+        self.assertNotIn('n', doc['_source'])
+
+    def test_bulk_update(self):
+        """It should merge the partial document into all documents."""
+        updated, failed = update.bulk_update(es_url, 'companiontest',
+                                             doc={'n': 1},
+                                             doc_type='simple')
+        self.assertEqual((updated, failed), (3, 0))
+
+        doc = self.client.get(index='companiontest', doc_type='simple',
+                              id='bar')
+        self.assertEqual(doc['_source'], {'id': 'bar', 'n': 1,
+                                          'timestamp': '2015-01-02T00:00:00'})
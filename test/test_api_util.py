@@ -35,6 +35,28 @@ class TestGetClient(TestCase):
         self.assertIsInstance(client, Elasticsearch)
         self.assertTrue(client.transport.retry_on_timeout)
 
+    def test_client_cache(self):
+        """It should share clients per url while the cache is enabled."""
+        util.enable_client_cache(maxsize=5)
+        try:
+            client = util.get_client(es_url)
+            self.assertIs(util.get_client(es_url), client)
+        finally:
+            util.disable_client_cache()
+        self.assertIsNot(util.get_client(es_url), client)
+
+    def test_nested_client_cache(self):
+        """It should keep the cache of an outer caller."""
+        util.enable_client_cache(maxsize=5)
+        try:
+            client = util.get_client(es_url)
+            util.enable_client_cache(maxsize=1)
+            util.disable_client_cache()
+            self.assertIs(util.get_client(es_url), client)
+        finally:
+            util.disable_client_cache()
+        self.assertIsNot(util.get_client(es_url), client)
+
 
 class TestTarGzDirectory(TestCase):
     def setUp(self):
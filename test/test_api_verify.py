@@ -0,0 +1,161 @@
+"""Verify test functions."""
+import fnmatch
+from unittest import TestCase, mock
+
+from companion.api import reindex, verify, util
+
+from . import create_test_data, es_url
+
+
+class TestHelpers(TestCase):
+    def test_target_pattern(self):
+        """It should turn name templates into index patterns."""
+        self.assertEqual(verify._target_pattern('event-{:%Y-%m-%d}'),
+                         'event-*')
+        self.assertEqual(verify._target_pattern('event'), 'event')
+
+    def test_target_regex(self):
+        """It should only match the names that a template makes."""
+        regex = verify._target_regex('event-{:%Y.%m}')
+        self.assertTrue(regex.match('event-2015.01'))
+        self.assertFalse(regex.match('event-2015.01.01'))
+        self.assertFalse(regex.match('event-2015x01'))
+        self.assertTrue(verify._target_regex('event').match('event'))
+        self.assertFalse(verify._target_regex('event').match('events'))
+
+    def test_doc_hashes(self):
+        """It should hash documents independent of the key order."""
+        hit1 = {'_type': 't', '_id': '1', '_source': {'a': 1, 'b': 2}}
+        hit2 = {'_type': 't', '_id': '1', '_source': {'b': 2, 'a': 1}}
+        hit3 = {'_type': 't', '_id': '1', '_source': {'a': 1, 'b': 3}}
+        self.assertEqual(verify._doc_hashes(hit1), verify._doc_hashes(hit2))
+        self.assertNotEqual(verify._doc_hashes(hit1),
+                            verify._doc_hashes(hit3))
+        self.assertEqual(verify._doc_hashes(hit1, ids_only=True),
+                         verify._doc_hashes(hit3, ids_only=True))
+
+
+def hit(index, doc_id, timestamp):
+    return {'_index': index, '_type': 't', '_id': doc_id,
+            '_source': {'ts': timestamp}}
+
+
+class FakeEngine:
+    """Scans fake indexes and records the searches."""
+    def __init__(self, docs):
+        self.docs = docs
+        self.searches = []
+
+    def __call__(self, client, index, query, **kwargs):
+        self.searches.append((index, query))
+        patterns = index.split(',')
+        excluded = [p[1:] for p in patterns if p.startswith('-')]
+        return iter([h for h in self.docs
+                     if any(fnmatch.fnmatch(h['_index'], p)
+                            for p in patterns) and
+                     not any(fnmatch.fnmatch(h['_index'], p)
+                             for p in excluded)])
+
+
+class TestVerifyScans(TestCase):
+    def verify(self, docs, source='source', target='target-{:%Y-%m-%d}'):
+        engine = FakeEngine(docs)
+        with mock.patch('companion.api.util.get_client'), \
+                mock.patch('companion.api.scan.ScrollEngine',
+                           return_value=engine):
+            result = verify.verify('url', source, target, date_field='ts')
+        return result, engine.searches
+
+    def test_source_matches_targets(self):
+        """It should not count source indexes that match the targets."""
+        docs = [hit('event-2015.01.01', '1', '2015-01-01T10:00:00'),
+                hit('event-2015.01.02', '2', '2015-01-02T10:00:00'),
+                hit('event-2015.01', '1', '2015-01-01T10:00:00'),
+                hit('event-2015.01', '2', '2015-01-02T10:00:00')]
+        target_indexes = []
+        for source in ['event-2015.01.01,event-2015.01.02', 'event-2015.01.*']:
+            result, searches = self.verify(docs, source=source,
+                                           target='event-{:%Y.%m}')
+            self.assertTrue(result['match'])
+            self.assertEqual(result['buckets'],
+                             {'event-2015.01': {'source_count': 2,
+                                                'target_count': 2,
+                                                'match': True}})
+            target_indexes.append(searches[1][0])
+        self.assertEqual(target_indexes, [
+            'event-*,-event-2015.01.01,-event-2015.01.02', 'event-*'])
+
+    def test_time_zones(self):
+        """It should count documents with time zones in their targets."""
+        docs = [hit('source', '1', '2015-01-01T23:30:00-02:00'),
+                hit('source', '2', '2015-01-02T01:00:00+02:00'),
+                hit('target-2015-01-01', '1', '2015-01-01T23:30:00-02:00'),
+                hit('target-2015-01-02', '2', '2015-01-02T01:00:00+02:00')]
+        result, searches = self.verify(docs)
+        self.assertTrue(result['match'])
+        self.assertEqual(result['buckets']['target-2015-01-01'],
+                         {'source_count': 1, 'target_count': 1,
+                          'match': True})
+        self.assertEqual(len(searches), 2)
+
+    def test_differing_only(self):
+        """It should only scan the differing buckets again."""
+        docs = [hit('source', '1', '2015-01-01T10:00:00'),
+                hit('source', '2', '2015-01-02T10:00:00'),
+                hit('source', '3', '2015-01-03T10:00:00+01:00'),
+                hit('target-2015-01-01', '1', '2015-01-01T10:00:00'),
+                hit('target-2015-01-02', '2', '2015-01-02T10:00:00'),
+                hit('target-2015-01-03', '3', 'changed')]
+        result, searches = self.verify(docs)
+        self.assertEqual(result['changed'], [('target-2015-01-03', 't', '3')])
+        (_, source_query), (target_index, _) = searches[2:]
+        date_range = source_query['query']['bool']['filter']['range']['ts']
+        self.assertEqual(date_range['gte'], 1420275600000)
+        self.assertEqual(date_range['lte'], 1420275600000)
+        self.assertEqual(target_index, 'target-2015-01-03')
+
+
+class TestVerify(TestCase):
+
+    def setUp(self):
+        self.client = util.get_client(es_url)
+        self.client.indices.delete(index='companiontesttarget*', ignore=[404])
+        create_test_data()
+        reindex.date_reindex(es_url,
+                             'companiontest',
+                             'companiontesttarget-{:%Y-%m-%d}',
+                             date_field='timestamp')
+        self.client.indices.refresh(index='companiontesttarget*')
+
+    def verify(self):
+        return verify.verify(es_url,
+                             'companiontest',
+                             'companiontesttarget-{:%Y-%m-%d}',
+                             date_field='timestamp',
+                             slices=2)
+
+    def test_match(self):
+        """It should verify a complete re-index"""
+        result = self.verify()
+        self.assertTrue(result['match'])
+        self.assertEqual(len(result['buckets']), 3)
+
+    def test_differences(self):
+        """It should find missing and changed documents"""
+        self.client.delete(index='companiontesttarget-2015-01-01',
+                           doc_type='simple', id='foo')
+        self.client.index(index='companiontesttarget-2015-01-02',
+                          doc_type='simple', id='bar',
+                          body={'id': 'changed', 'timestamp': '2015-01-02'})
+        self.client.indices.refresh(index='companiontesttarget*')
+
+        result = self.verify()
+        self.assertFalse(result['match'])
+        self.assertFalse(
+            result['buckets']['companiontesttarget-2015-01-01']['match'])
+        self.assertTrue(
+            result['buckets']['companiontesttarget-2015-01-03']['match'])
+        self.assertEqual(result['missing'],
+                         [('companiontesttarget-2015-01-01', 'simple', 'foo')])
+        self.assertEqual(result['changed'],
+                         [('companiontesttarget-2015-01-02', 'simple', 'bar')])
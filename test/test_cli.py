@@ -0,0 +1,90 @@
+"""CLI test functions."""
+import io
+import sys
+import contextlib
+import subprocess
+from unittest import TestCase
+
+HEAVY_MODULES = ['boto3', 'botocore', 'dateutil', 'elasticsearch']
+
+
+def run_python(code):
+    """Run code in a fresh interpreter and return its output."""
+    return subprocess.check_output([sys.executable, '-c', code],
+                                   universal_newlines=True)
+
+
+def heavy_modules(code):
+    """The heavy and companion.api modules that code imports."""
+    code += ('\nimport sys\n'
+             'print("modules:" + ",".join(sorted(\n'
+             '    m for m in sys.modules if m.split(".")[0] in {!r} or\n'
+             '    m.startswith("companion.api."))))\n'
+             .format(HEAVY_MODULES))
+    last_line = run_python(code).strip().splitlines()[-1]
+    return [m for m in last_line[len('modules:'):].split(',') if m]
+
+
+def loaded_modules(argv):
+    code = ('import sys\n'
+            'from companion.cli import cli\n'
+            'cli.parser.parse_args({!r})\n'
+            'print(",".join(m for m in {!r} if m in sys.modules))\n'
+            .format(argv, HEAVY_MODULES))
+    return run_python(code).strip().split(',')
+
+
+class TestLazyImports(TestCase):
+    def test_parse(self):
+        """It should not import any command dependencies for parsing."""
+        self.assertEqual(loaded_modules(['health']), [''])
+        self.assertEqual(loaded_modules(['backup', 'local', 'i', '/tmp']),
+                         [''])
+
+    def test_lazy_command(self):
+        """It should import the command module when the command runs."""
+        code = ('import sys\n'
+                'from companion.cli import cli\n'
+                'cli.lazy("health", "run")\n'
+                'print("companion.cli.health" in sys.modules)\n'
+                'from companion.cli import health\n'
+                'print(health.run.__module__)\n')
+        self.assertEqual(run_python(code).split(),
+                         ['False', 'companion.cli.health'])
+
+
+class TestStartup(TestCase):
+    def test_help(self):
+        """It should show the help without loading any command modules."""
+        modules = heavy_modules('import sys\n'
+                                'from companion import main\n'
+                                'sys.argv = ["companion", "-h"]\n'
+                                'try:\n'
+                                '    main()\n'
+                                'except SystemExit:\n'
+                                '    pass\n')
+        self.assertEqual(modules, [])
+
+    def test_health(self):
+        """It should only load the dependencies of the health command."""
+        modules = heavy_modules('from companion.cli import cli, health')
+        self.assertEqual([m for m in modules
+                          if m.startswith(('boto', 'dateutil'))], [])
+        self.assertEqual([m for m in modules
+                          if m.startswith('companion.api.')],
+                         ['companion.api.health', 'companion.api.util'])
+
+
+class TestUpdate(TestCase):
+    def test_client_side_options(self):
+        """It should reject client-side options for updates on the cluster."""
+        from companion.cli import cli, update
+        args = cli.parser.parse_args(['update', 'myindex', '--script', 's',
+                                      '--max-mb-per-sec', '5',
+                                      '--scan-engine', 'search_after'])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            update.run(args)
+        self.assertEqual(output.getvalue(),
+                         '--scan-engine, --max-mb-per-sec only apply with '
+                         '--client-side\n')